@@ -0,0 +1,68 @@
+"""
+Answers a stream of query/evidence records against a program which is loaded once.
+    python -m metaproblog.batch PROGRAM.pl [...] [--input FILE] [--format jsonl|csv] [--output FILE] [--type SPEC]
+                                [--workers N] [--chunk-size N] [--session-queries N] [--unordered] [--cache-mb MB] [--disk-cache DIR]
+                                [--compiler ddnnf|sdd|bdd|auto]
+Each input record gives a query, and optionally an id, evidence and a query type, e.g.
+    {"id": 1, "query": "path(0,5)", "evidence": "edge(0,1), \\+edge(1,2)"}
+Results are written as one json object per record, in input order unless --unordered is given.
+Exits with status 1 if any record failed; its result then has an "error" instead.
+"""
+import argparse
+import json
+import sys
+
+from metaproblog.batch.runner import BatchRunner
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m metaproblog.batch", description="metaproblog batch query runner")
+    parser.add_argument("program", nargs="+", help="ProbLog files, loaded in order")
+    parser.add_argument("--input", metavar="FILE", help="records to answer (default: stdin)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="input format (default: from the file extension, else jsonl)")
+    parser.add_argument("--output", metavar="FILE", help="where to write the results (default: stdout)")
+    parser.add_argument("--type", default=BatchRunner.DEFAULT_QUERY_TYPE,
+                            help="query type for records without one, as in the kernel, e.g. 'sample(100, seed(1))' (default %(default)s)")
+    parser.add_argument("--workers", type=int, default=1, help="processes answering groups of records in parallel")
+    parser.add_argument("--chunk-size", type=int, default=BatchRunner.DEFAULT_CHUNK_SIZE,
+                            help="records read (and grouped by evidence) at a time; bounds memory (default %(default)s)")
+    parser.add_argument("--session-queries", type=int, default=BatchRunner.DEFAULT_SESSION_QUERIES,
+                            help="distinct query terms compiled into one circuit (default %(default)s)")
+    parser.add_argument("--unordered", action="store_true", help="write results as soon as their group is done")
+    parser.add_argument("--cache-mb", type=float, default=None, help="budget of the circuit cache shared by all groups")
+    parser.add_argument("--disk-cache", metavar="DIR", help="keep compiled circuits in DIR, for the next run")
+    parser.add_argument("--compiler", choices=["ddnnf", "sdd", "bdd", "auto"],
+                            help="knowledge compiler for exact queries; auto picks one per formula (default ddnnf)")
+    args = parser.parse_args(argv)
+
+    program_texts = []
+    for path in args.program:
+        with open(path) as f:
+            program_texts.append(f.read())
+    runner = BatchRunner(program_texts, args.type, args.workers, args.chunk_size, args.cache_mb, args.session_queries, args.disk_cache,
+                            args.compiler)
+
+    input_format = args.format or ("csv" if args.input and args.input.endswith(".csv") else "jsonl")
+    in_stream = open(args.input, newline="") if args.input else sys.stdin
+    out_stream = open(args.output, "w") if args.output else sys.stdout
+    failed = 0
+    try:
+        records = BatchRunner.read_csv(in_stream) if input_format == "csv" else BatchRunner.read_jsonl(in_stream)
+        for output in runner.run(records, ordered=not args.unordered):
+            failed += "error" in output
+            out_stream.write(json.dumps(output) + "\n")
+            out_stream.flush()
+    finally:
+        if args.input:
+            in_stream.close()
+        if args.output:
+            out_stream.close()
+
+    if failed:
+        print("%d records failed"%failed, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+from sys import stderr as sys_stderr
+from collections import OrderedDict
+import csv
+import json
+import multiprocessing
+
+from problog.logic import And, Not, Term
+from problog.engine_unify import subsumes, UnifyError
+from problog.program import PrologString
+
+from metaproblog.jupyterkernel.problog_wrapper import ProblogWrapper
+from metaproblog.querying.amc_query import AMCQuery
+from metaproblog.querying.compiler_selector import CompilerSelector
+from metaproblog.querying.disk_cache import DiskCache
+from metaproblog.querying.mcmc_query import MCMCQuery
+from metaproblog.querying.anytime_query import AnytimeQuery
+from metaproblog.querying.sample_query import SampleQuery
+from metaproblog.querying.weighted_sample_query import WeightedSampleQuery
+
+
+class BatchRecord:
+    """
+    One line of input: queries under evidence, answered with a query type (a spec as in the kernel, e.g. probability or sample(100, seed(1))).
+    index is the position in the input, which is the order results are written in.
+    """
+    def __init__(self, index, record_id, queries, evidence, query_type):
+        self.index = index
+        self.record_id = record_id
+        self.queries = queries
+        self.evidence = evidence
+        self.query_type = query_type
+
+    """ Records with the same group_key share a QuerySession, and so the grounding and compilation """
+    def group_key(self):
+        return (str(self.query_type), tuple(sorted((str(term), value) for term, value in self.evidence)))
+
+
+class BatchRunner:
+    """
+    Answers many query/evidence records against one program, which is loaded (and prepared) once.
+    Input is read in chunks of chunk_size records. Within a chunk, records with the same evidence and query type share
+    QuerySessions, so they are grounded into one formula and compiled once. A session takes at most session_queries distinct
+    query terms, since one circuit for many unrelated queries can cost more to compile than several small ones.
+    The records of a session have the same evidence, so for exact query types (probability, mpe) the session asks the
+    union of their queries once: the evidence is grounded and conditioned on once, and repeated queries cost nothing.
+    Across chunks, the circuit cache of the ProblogWrapper avoids recompiling what was seen before.
+    Memory is bounded by chunk_size and the cache budget.
+    With workers > 1, the groups of a chunk are spread over forked processes which inherit the prepared program.
+    """
+
+    DEFAULT_CHUNK_SIZE = 1000
+    DEFAULT_QUERY_TYPE = "probability"
+    DEFAULT_SESSION_QUERIES = 8
+    EXACT_TYPES = ("probability", "mpe", "minpe") # Answered with one circuit, so queries can be merged
+
+    def __init__(self, program_texts, query_type=DEFAULT_QUERY_TYPE, workers=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                    circuit_cache_mb=None, session_queries=DEFAULT_SESSION_QUERIES, disk_cache=None, compiler=None):
+        self.pbl = ProblogWrapper()
+        if compiler is not None:
+            CompilerSelector.target_class(compiler) # Fails early if it is unknown or not installed
+            self.pbl.compiler = compiler
+        if circuit_cache_mb is not None:
+            self.pbl.circuit_cache.resize(int(circuit_cache_mb * 1024 * 1024))
+        if disk_cache is not None:
+            self.pbl.circuit_cache.attach_disk(DiskCache(disk_cache))
+        for i, text in enumerate(program_texts):
+            queries, evidence, questions = self.pbl.process_cell("batch_program_%d"%i, PrologString(text))
+            if queries or evidence or questions:
+                print("Ignoring the queries, evidence and ?-queries in the program; they come from the records.", file=sys_stderr)
+        self.query_type = BatchRunner.parse_term(query_type)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.session_queries = session_queries
+
+    """ Runs every record, yielding one output dict per record. In input order unless ordered=False """
+    def run(self, records, ordered=True):
+        for chunk in BatchRunner._chunks(self._parse_records(records), self.chunk_size):
+            groups = []
+            for group in BatchRunner.group(chunk).values():
+                groups.extend(BatchRunner.split_group(group, self.session_queries))
+            outputs = self._run_groups(groups)
+            if ordered:
+                done = {}
+                for group_output in outputs:
+                    done.update(group_output)
+                for record in chunk:
+                    yield done[record.index]
+            else:
+                for group_output in outputs:
+                    yield from group_output.values()
+
+    def _parse_records(self, records):
+        for index, raw in enumerate(records):
+            try:
+                yield BatchRunner.parse_record(index, raw, self.query_type)
+            except Exception as e:
+                yield BatchRecord(index, raw.get("id", index) if isinstance(raw, dict) else index, None, [], "%s: %s"%(type(e).__name__, e))
+
+    def _run_groups(self, groups):
+        if self.workers > 1 and len(groups) > 1 and "fork" in multiprocessing.get_all_start_methods():
+            pool = multiprocessing.get_context("fork").Pool(min(self.workers, len(groups)), _init_batch_worker, (self,))
+            try:
+                for group_output in pool.imap_unordered(_run_batch_group, groups):
+                    yield group_output
+                pool.close()
+            except BaseException: # Including the consumer abandoning the generator
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for group in groups:
+                yield self.run_group(group)
+
+    """ Answers a list of records with the same group_key (see split_group) in one QuerySession. {index: output dict}
+        If the shared session fails, each record is retried in a session of its own, so one bad query only fails itself.
+    """
+    def run_group(self, group):
+        outputs = {}
+        runnable = []
+        for record in group:
+            if record.queries is None: # Could not be parsed; query_type holds the error
+                outputs[record.index] = {"id": record.record_id, "error": record.query_type}
+            else:
+                runnable.append(record)
+        if not runnable:
+            return outputs
+
+        try:
+            outputs.update(self._run_session(runnable))
+        except Exception as e:
+            if len(runnable) == 1:
+                outputs[runnable[0].index] = {"id": runnable[0].record_id, "error": "%s: %s"%(type(e).__name__, e)}
+            else:
+                for record in runnable:
+                    outputs.update(self.run_group([record]))
+        return outputs
+
+    def _run_session(self, records):
+        qs = self.pbl.create_query_session()
+        if BatchRunner.is_exact(records[0].query_type):
+            # Same evidence and an exact query type: ask the union of the queries once and hand each record its part
+            queries = list(OrderedDict((str(q), q) for record in records for q in record.queries).values())
+            qobj = qs.prepare_query(queries, records[0].evidence, records[0].query_type)
+            qs.evaluate_queries()
+            values, evidence = qobj.results
+            evidence_json = BatchRunner._evidence_to_json(evidence)
+            outputs = {}
+            for record in records:
+                record_values = [(name, value) for name, value in values if any(BatchRunner._matches(q, name) for q in record.queries)]
+                outputs[record.index] = {"id": record.record_id,
+                    "results": {str(name): BatchRunner._value_to_json(value) for name, value in record_values}, "evidence": evidence_json}
+            return outputs
+
+        qobjs = [qs.prepare_query(record.queries, record.evidence, record.query_type) for record in records]
+        qs.evaluate_queries()
+        return {record.index: dict({"id": record.record_id}, **BatchRunner.result_to_json(qobj)) for record, qobj in zip(records, qobjs)}
+
+    """ Whether the ground result name is an answer to query """
+    @staticmethod
+    def _matches(query, name):
+        if query.is_ground():
+            return query == name
+        try:
+            return subsumes(query, name)
+        except UnifyError:
+            return False
+
+    @staticmethod
+    def is_exact(query_type):
+        return isinstance(query_type, Term) and query_type.functor in BatchRunner.EXACT_TYPES
+
+    @staticmethod
+    def group(records):
+        groups = OrderedDict()
+        for record in records:
+            key = record.group_key() if record.queries is not None else ("_error", record.index)
+            groups.setdefault(key, []).append(record)
+        return groups
+
+    """ Splits a group into runs of records which together ask at most max_queries distinct query terms.
+        Records asking the same queries are kept together, so duplicates land in the same session. """
+    @staticmethod
+    def split_group(group, max_queries):
+        by_queries = OrderedDict()
+        for record in group:
+            key = tuple(str(q) for q in record.queries) if record.queries is not None else ("_error", record.index)
+            by_queries.setdefault(key, []).append(record)
+
+        parts, current, current_terms = [], [], set()
+        for key, records in by_queries.items():
+            terms = set(key)
+            if current and len(current_terms | terms) > max_queries:
+                parts.append(current)
+                current, current_terms = [], set()
+            current.extend(records)
+            current_terms |= terms
+        if current:
+            parts.append(current)
+        return parts
+
+    @staticmethod
+    def _chunks(iterable, size):
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    """ A json-friendly view of query.results """
+    @staticmethod
+    def result_to_json(query):
+        if isinstance(query, AnytimeQuery):
+            bounds, evidence = query.results
+            return {"bounds": {str(q): list(b) for q, b in bounds}, "evidence": BatchRunner._evidence_to_json(evidence)}
+        elif isinstance(query, AMCQuery) or isinstance(query, MCMCQuery):
+            values, evidence = query.results
+            return {"results": {str(q): BatchRunner._value_to_json(v) for q, v in values}, "evidence": BatchRunner._evidence_to_json(evidence)}
+        elif isinstance(query, WeightedSampleQuery):
+            samples, evidence, weights = query.results
+            return {"results": {str(q): p for q, p in (WeightedSampleQuery.estimate(samples, weights) or {}).items()},
+                    "effective_sample_size": WeightedSampleQuery.effective_sample_size(weights),
+                    "evidence": BatchRunner._evidence_to_json(evidence)}
+        elif isinstance(query, SampleQuery):
+            samples, evidence = query.results
+            result = {"samples": [{str(q): BatchRunner._value_to_json(v) for q, v in sample.items()} for sample in samples],
+                        "evidence": BatchRunner._evidence_to_json(evidence)}
+            if getattr(samples, "convergence", None) is not None: # Adaptive sampling; see SampleQuery.evaluate_adaptive
+                result["convergence"] = samples.convergence
+            return result
+        else:
+            return {"results": str(query.results)}
+
+    @staticmethod
+    def _evidence_to_json(evidence):
+        return {str(term): value for term, value in evidence.items()}
+
+    @staticmethod
+    def _value_to_json(value):
+        if isinstance(value, (bool, int, float)) or value is None:
+            return value
+        if isinstance(value, (tuple, list, set)):
+            return [BatchRunner._value_to_json(v) for v in value]
+        return str(value)
+
+    """ A record is a dict with 'query' and optionally 'id', 'evidence' and 'type'.
+        query: a term, a conjunction 'a, b' or a list of terms.
+        evidence: a conjunction 'a, \\+b', a list of literals, a list of [term, bool] or a dict term -> bool.
+    """
+    @staticmethod
+    def parse_record(index, raw, default_query_type):
+        if "query" not in raw:
+            raise ValueError("record has no query")
+        queries = []
+        for item in BatchRunner._as_list(raw["query"]):
+            queries.extend(BatchRunner.parse_conjunction(item))
+        if not queries:
+            raise ValueError("record has no query")
+
+        evidence = []
+        raw_evidence = raw.get("evidence") or []
+        if isinstance(raw_evidence, dict):
+            raw_evidence = list(raw_evidence.items())
+        for item in BatchRunner._as_list(raw_evidence):
+            if isinstance(item, (list, tuple)):
+                term, value = item
+                evidence.append((BatchRunner.parse_term(term), BatchRunner._parse_bool(value)))
+            else:
+                for literal in BatchRunner.parse_conjunction(item):
+                    evidence.append((literal.args[0], False) if isinstance(literal, Not) else (literal, True))
+
+        query_type = BatchRunner.parse_term(raw["type"]) if raw.get("type") else default_query_type
+        return BatchRecord(index, raw.get("id", index), queries, evidence, query_type)
+
+    @staticmethod
+    def parse_term(text):
+        if isinstance(text, Term):
+            return text
+        statements = list(PrologString(str(text).strip().rstrip(".") + "."))
+        if len(statements) != 1:
+            raise ValueError("expected one term: %s"%text)
+        return statements[0]
+
+    @staticmethod
+    def parse_conjunction(text):
+        conj = BatchRunner.parse_term(text)
+        terms = []
+        while isinstance(conj, And):
+            terms.append(conj.args[0])
+            conj = conj.args[1]
+        terms.append(conj)
+        return terms
+
+    @staticmethod
+    def _as_list(value):
+        return list(value) if isinstance(value, (list, tuple)) else ([value] if value != "" else [])
+
+    @staticmethod
+    def _parse_bool(value):
+        if isinstance(value, str):
+            return value.strip().lower() in ("true", "1", "yes", "t")
+        return bool(value)
+
+    """ Records from a jsonl stream: one json object per line, blank lines skipped """
+    @staticmethod
+    def read_jsonl(stream):
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    """ Records from a csv stream with a header naming the columns: query, and optionally id, evidence and type.
+        query and evidence are conjunctions, e.g. "a, \\+b".
+    """
+    @staticmethod
+    def read_csv(stream):
+        for row in csv.DictReader(stream):
+            yield {key: value for key, value in row.items() if key is not None and value not in (None, "")}
+
+
+_batch_worker_runner = None
+
+def _init_batch_worker(runner):
+    global _batch_worker_runner
+    _batch_worker_runner = runner
+
+def _run_batch_group(group):
+    return _batch_worker_runner.run_group(group)
+
+
+# Devtime testing
+def _run_tests():
+    program = """
+    0.3::burglary. 0.2::earthquake.
+    0.9::alarm :- burglary. 0.8::alarm :- earthquake.
+    0.7::calls(john) :- alarm. 0.6::calls(mary) :- alarm.
+    """
+    records = [
+        {"id": "a", "query": "burglary"},
+        {"id": "b", "query": ["burglary", "earthquake"], "evidence": "calls(john)"},
+        {"id": "c", "query": "earthquake", "evidence": ["calls(john)"]},
+        {"id": "d", "query": "burglary", "evidence": {"calls(john)": True, "calls(mary)": False}},
+        {"id": "e", "query": "nonexistent"},
+        {"id": "f", "query": "burglary", "type": "sample(3, seed(1))"},
+        {"id": "g"},
+    ]
+    for workers in [1, 2]:
+        runner = BatchRunner([program], workers=workers, chunk_size=4)
+        for output in runner.run(records):
+            print(json.dumps(output))
+        print("---")
+
+if __name__ == "__main__":
+    _run_tests()
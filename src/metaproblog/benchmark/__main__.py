@@ -0,0 +1,49 @@
+"""
+Runs the benchmark suite.
+    python -m metaproblog.benchmark [--quick] [--repeat N] [--filter NAME] [--save FILE] [--compare FILE] [--tolerance T]
+With --compare, exits with status 1 if any case is slower than the baseline by more than the tolerance.
+"""
+import argparse
+import sys
+
+from metaproblog.benchmark.suite import BenchmarkSuite
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m metaproblog.benchmark", description="metaproblog benchmark suite")
+    parser.add_argument("--quick", action="store_true", help="small instances, for a fast check")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the median is reported")
+    parser.add_argument("--filter", default=None, help="only run cases whose name contains this")
+    parser.add_argument("--save", metavar="FILE", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a baseline written with --save")
+    parser.add_argument("--tolerance", type=float, default=BenchmarkSuite.DEFAULT_TOLERANCE,
+                            help="relative slowdown counted as a regression (default %(default)s)")
+    args = parser.parse_args(argv)
+
+    baseline = BenchmarkSuite.load(args.compare) if args.compare else {}
+
+    def _log(name, result):
+        line = "%-24s %9.1f ms %12.1f %s"%(name, result["wall_s"] * 1000, result["throughput"], result["unit"])
+        if name in baseline:
+            line += "   (baseline %9.1f ms, x%.2f)"%(baseline[name]["wall_s"] * 1000, result["wall_s"] / baseline[name]["wall_s"])
+        phases = ", ".join("%s %.1f"%(phase, seconds * 1000) for phase, seconds in sorted(result["phases_s"].items()))
+        print(line)
+        print("%-24s phases (ms): %s"%("", phases))
+
+    suite = BenchmarkSuite(BenchmarkSuite.default_cases(args.quick))
+    results = suite.run(args.repeat, args.filter, log=_log)
+
+    if args.save:
+        BenchmarkSuite.save(results, args.save)
+        print("Saved baseline to %s"%args.save)
+
+    if args.compare:
+        slower = BenchmarkSuite.regressions(results, baseline, args.tolerance)
+        for name, before, after, ratio in slower:
+            print("REGRESSION %s: %.1f ms -> %.1f ms (x%.2f)"%(name, before * 1000, after * 1000, ratio), file=sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
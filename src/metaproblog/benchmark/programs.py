@@ -0,0 +1,68 @@
+import random
+
+from problog.logic import Term, Constant
+
+
+class ProgramGenerator:
+    """
+    Synthetic, scalable ProbLog programs for the benchmarks. Every generator is deterministic given its arguments (and seed).
+    Each returns (program text, queries, evidence), with queries and evidence as Terms / (Term, bool) ready for QuerySession.
+    """
+
+    PATH_RULES = "path(X,Y) :- edge(X,Y).\npath(X,Y) :- edge(X,Z), path(Z,Y).\n"
+
+    """ Nodes 0..n in a line, with skip edges i -> i+2. Compiles easily, grounds linearly. """
+    @staticmethod
+    def chain(n, p=0.6):
+        lines = []
+        for i in range(n):
+            lines.append("%s::edge(%d,%d)."%(p, i, i + 1))
+            if i + 2 <= n:
+                lines.append("%s::edge(%d,%d)."%(p, i, i + 2))
+        text = "\n".join(lines) + "\n" + ProgramGenerator.PATH_RULES
+        return text, [Term("path", Constant(0), Constant(n))], []
+
+    """ A width x height grid with right and down edges; connectivity from corner to corner. Hard to compile as it grows. """
+    @staticmethod
+    def grid(width, height, p=0.5):
+        def _node(x, y):
+            return y * width + x
+        lines = []
+        for y in range(height):
+            for x in range(width):
+                if x + 1 < width:
+                    lines.append("%s::edge(%d,%d)."%(p, _node(x, y), _node(x + 1, y)))
+                if y + 1 < height:
+                    lines.append("%s::edge(%d,%d)."%(p, _node(x, y), _node(x, y + 1)))
+        text = "\n".join(lines) + "\n" + ProgramGenerator.PATH_RULES
+        return text, [Term("path", Constant(0), Constant(_node(width - 1, height - 1)))], []
+
+    """ A random DAG over n nodes (edges only go from lower to higher numbers, so grounding is acyclic) with evidence """
+    @staticmethod
+    def random_graph(n, edge_prob, seed=0):
+        rng = random.Random(seed)
+        lines = []
+        for i in range(n):
+            for j in range(i + 1, n):
+                if rng.random() < edge_prob:
+                    lines.append("%.2f::edge(%d,%d)."%(rng.uniform(0.1, 0.9), i, j))
+        text = "\n".join(lines) + "\n" + ProgramGenerator.PATH_RULES
+        queries = [Term("path", Constant(0), Constant(j)) for j in range(n - 3, n)]
+        evidence = [(Term("path", Constant(0), Constant(n // 2)), True)]
+        return text, queries, evidence
+
+    """ n_cells notebook cells, each defining a few facts and a rule over the previous cell's predicate """
+    @staticmethod
+    def notebook(n_cells, facts_per_cell=5, seed=0):
+        rng = random.Random(seed)
+        cells = []
+        for c in range(n_cells):
+            lines = ["%.2f::f%d(%d)."%(rng.uniform(0.1, 0.9), c, k) for k in range(facts_per_cell)]
+            if c == 0:
+                lines.append("r0 :- f0(X).")
+            else:
+                lines.append("r%d :- r%d, f%d(X)."%(c, c - 1, c))
+                lines.append("r%d :- f%d(0), f%d(1)."%(c, c, c))
+            cells.append(("cell_%d"%c, "\n".join(lines) + "\n"))
+        queries = [Term("r%d"%(n_cells - 1))]
+        return cells, queries, []
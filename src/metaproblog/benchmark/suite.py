@@ -0,0 +1,169 @@
+import json
+import platform
+import statistics
+import time
+
+from problog.program import PrologString
+
+from metaproblog.profiler import Profiler
+from metaproblog.jupyterkernel.problog_wrapper import ProblogWrapper
+from metaproblog.querying.query_factory import QueryFactory
+from metaproblog.benchmark.programs import ProgramGenerator
+
+
+class BenchmarkCase:
+    """
+    One benchmark: setup() builds fresh state, run(state) is the timed part and returns how many units of work it did.
+    Phases are collected with the Profiler (without memory tracing, which would distort the timings).
+    """
+    def __init__(self, name, setup, run, unit):
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.unit = unit
+
+
+class BenchmarkSuite:
+    """
+    Runs BenchmarkCases headlessly through ProblogWrapper and QuerySession, the way the kernel does, and compares against a baseline.
+    A result per case is the median over the repeats of the total wall time, of each phase and of the throughput.
+    """
+
+    DEFAULT_TOLERANCE = 0.25 # Relative slowdown of the median wall time that counts as a regression
+    NESTED_PHASES = ("compile", "ground (deferred)", "evaluate_circuit") # Reported besides the top-level phases
+
+    def __init__(self, cases):
+        self.cases = cases
+
+    @staticmethod
+    def default_cases(quick=False):
+        scale = (lambda full, small: small) if quick else (lambda full, small: full)
+        cases = []
+
+        for n in [scale(60, 20), scale(200, 40)]:
+            cases.append(BenchmarkSuite.probability_case("chain_%d"%n, *ProgramGenerator.chain(n)))
+        for w in [scale(4, 3), scale(5, 4)]:
+            cases.append(BenchmarkSuite.probability_case("grid_%dx%d"%(w, w), *ProgramGenerator.grid(w, w)))
+        n = scale(20, 12)
+        cases.append(BenchmarkSuite.probability_case("random_graph_%d"%n, *ProgramGenerator.random_graph(n, 0.3)))
+
+        text, queries, evidence = ProgramGenerator.chain(scale(30, 10))
+        cases.append(BenchmarkSuite.sample_case("sample_chain", text, queries, evidence, scale(500, 100)))
+
+        n_cells = scale(100, 20)
+        cases.append(BenchmarkSuite.notebook_case("notebook_%d_cells"%n_cells, n_cells, reruns=scale(20, 10)))
+        return cases
+
+    """ Prepares the program and answers the queries exactly (AMCQuery), cold: a new wrapper each repeat """
+    @staticmethod
+    def probability_case(name, text, queries, evidence):
+        def _setup():
+            return ProblogWrapper()
+
+        def _run(pbl):
+            pbl.process_cell(name, PrologString(text))
+            qs = pbl.create_query_session()
+            qs.prepare_query(queries, evidence, QueryFactory.QueryType.PROBABILITY)
+            qs.evaluate_queries()
+            return len(queries)
+        return BenchmarkCase(name, _setup, _run, "queries")
+
+    @staticmethod
+    def sample_case(name, text, queries, evidence, n_samples):
+        def _setup():
+            pbl = ProblogWrapper()
+            pbl.process_cell(name, PrologString(text))
+            return pbl
+
+        def _run(pbl):
+            qs = pbl.create_query_session()
+            qs.prepare_query(queries, evidence, QueryFactory.QueryType.SAMPLE)
+            qs.queries[-1].n_samples = n_samples
+            qs.queries[-1].seed = 0 # Same samples every run, through the chunked sampler
+            qs.evaluate_queries()
+            return n_samples
+        return BenchmarkCase(name, _setup, _run, "samples")
+
+    """ Loads a notebook, then repeatedly re-executes a cell in the middle and re-queries, as when editing a notebook """
+    @staticmethod
+    def notebook_case(name, n_cells, reruns):
+        cells, queries, evidence = ProgramGenerator.notebook(n_cells)
+
+        def _setup():
+            pbl = ProblogWrapper()
+            for cell_id, text in cells:
+                pbl.process_cell(cell_id, PrologString(text))
+            return pbl
+
+        def _run(pbl):
+            cell_id, text = cells[len(cells) // 2]
+            for i in range(reruns):
+                pbl.process_cell(cell_id, PrologString(text + "%% run %d\n"%i))
+                qs = pbl.create_query_session()
+                qs.prepare_query(queries, evidence, QueryFactory.QueryType.PROBABILITY)
+                qs.evaluate_queries()
+            return reruns
+        return BenchmarkCase(name, _setup, _run, "reruns")
+
+    def run(self, repeat=3, name_filter=None, log=None):
+        results = {}
+        for case in self.cases:
+            if name_filter and name_filter not in case.name:
+                continue
+            walls, throughputs, phases = [], [], {}
+            for _ in range(repeat):
+                state = case.setup()
+                Profiler.stop()
+                Profiler.start(trace_memory=False)
+                try:
+                    start = time.perf_counter()
+                    units = case.run(state)
+                    wall = time.perf_counter() - start
+                finally:
+                    profiler = Profiler.stop()
+                walls.append(wall)
+                throughputs.append(units / wall if wall > 0 else 0.0)
+                run_phases = {}
+                for entry in profiler.entries:
+                    if entry["depth"] == 0 or entry["phase"] in BenchmarkSuite.NESTED_PHASES:
+                        run_phases[entry["phase"]] = run_phases.get(entry["phase"], 0.0) + entry.get("wall_s", 0.0)
+                for phase, seconds in run_phases.items():
+                    phases.setdefault(phase, []).append(seconds)
+
+            results[case.name] = {
+                "wall_s": statistics.median(walls),
+                "throughput": statistics.median(throughputs),
+                "unit": case.unit + "/s",
+                "phases_s": {phase: statistics.median(values) for phase, values in phases.items()},
+            }
+            if log is not None:
+                log(case.name, results[case.name])
+        return results
+
+    @staticmethod
+    def environment():
+        import problog
+        return {"python": platform.python_version(), "problog": getattr(problog, "__version__", None),
+                "machine": platform.machine(), "platform": platform.platform()}
+
+    @staticmethod
+    def save(results, path):
+        with open(path, "w") as f:
+            json.dump({"environment": BenchmarkSuite.environment(), "results": results}, f, indent=2, sort_keys=True)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return json.load(f)["results"]
+
+    """ [(case, baseline wall, current wall, ratio)] for cases that got slower than baseline * (1 + tolerance) """
+    @staticmethod
+    def regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+        slower = []
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            before, after = baseline[name]["wall_s"], result["wall_s"]
+            if before > 0 and after > before * (1 + tolerance):
+                slower.append((name, before, after, after / before))
+        return slower
@@ -0,0 +1,118 @@
+from problog.logic import Term, Var, Clause, AnnotatedDisjunction, Or
+
+class DependencyGraph:
+    """
+    Predicate-level call graph over the theories of a TheoryManager.
+    Predicates are identified by functor name only, which over-approximates (e.g. for call/N) but never misses a dependency.
+    Any name that occurs in a clause body counts as a call, since it could be meta-called.
+    """
+
+    ANY = None # Stands for "could depend on / define any predicate"
+
+    # Arguments which are executed as goals. A variable there can call anything.
+    GOAL_ARGS = {
+        "','": (0, 1), "';'": (0, 1), "'->'": (0, 1), "'*->'": (0, 1), "\\+": (0,), "not": (0,),
+        "call": (0,), "once": (0,), "forall": (0, 1), "findall": (1,), "all": (1,), "all_or_none": (1,),
+        "subquery": (0,), "try_call": (0,),
+    }
+    # Goals which change the database at runtime
+    DYNAMIC = {"assert", "asserta", "assertz", "retract", "retractall", "consult", "use_module", "load_external"}
+
+    def __init__(self):
+        self._defines = {} # TheoryKey -> set of predicate names, or ANY for theories with directives
+        self._calls = {} # TheoryKey -> { predicate name -> set of names called from its clauses (may contain ANY) }
+        self._definers = {} # predicate name -> set of TheoryKeys defining it
+        self._opaque = set() # TheoryKeys which run directives, so may define anything
+
+    def add_theory(self, theory_key, statement_list):
+        defines = set()
+        calls = {}
+        for stmt in statement_list:
+            heads, body = DependencyGraph._heads_and_body(stmt)
+            if heads is None:
+                self._opaque.add(theory_key)
+                continue
+            body_calls = DependencyGraph._body_calls(body) if body is not None else set()
+            for head in heads:
+                defines.add(head.functor)
+                calls.setdefault(head.functor, set()).update(body_calls)
+
+        self._defines[theory_key] = defines
+        self._calls[theory_key] = calls
+        for name in defines:
+            self._definers.setdefault(name, set()).add(theory_key)
+
+    def remove_theory(self, theory_key):
+        for name in self._defines.pop(theory_key, ()):
+            definers = self._definers[name]
+            definers.discard(theory_key)
+            if not definers:
+                self._definers.pop(name)
+        self._calls.pop(theory_key, None)
+        self._opaque.discard(theory_key)
+
+    """ Names defined by the theory, or ANY """
+    def defined_by(self, theory_key):
+        if theory_key in self._opaque:
+            return DependencyGraph.ANY
+        return frozenset(self._defines.get(theory_key, ()))
+
+    """ All predicate names the given terms can (transitively) call, or ANY """
+    def reachable(self, terms):
+        seen = set()
+        pending = set()
+        for term in terms:
+            pending |= DependencyGraph._body_calls(term)
+        while pending:
+            name = pending.pop()
+            if name is DependencyGraph.ANY:
+                return DependencyGraph.ANY
+            if name in seen:
+                continue
+            seen.add(name)
+            for theory_key in self._definers.get(name, ()):
+                pending |= self._calls[theory_key].get(name, set()) - seen
+        return frozenset(seen)
+
+    """ (TheoryKeys the answers to terms may depend on, predicate names they can reach or ANY) """
+    def dependencies(self, terms):
+        names = self.reachable(terms)
+        if names is DependencyGraph.ANY:
+            return frozenset(self._defines), DependencyGraph.ANY
+        theories = set(self._opaque)
+        for name in names:
+            theories |= self._definers.get(name, set())
+        return frozenset(theories), names
+
+    @staticmethod
+    def _heads_and_body(stmt):
+        if isinstance(stmt, Clause) and stmt.head.functor == "_directive":
+            return None, None
+        elif isinstance(stmt, Clause):
+            return [stmt.head], stmt.body
+        elif isinstance(stmt, AnnotatedDisjunction):
+            return stmt.heads, stmt.body
+        elif isinstance(stmt, Or):
+            return stmt.to_list(), None
+        else:
+            return [stmt], None
+
+    @staticmethod
+    def _body_calls(body):
+        calls = set()
+        stack = [(body, True)]
+        while stack:
+            term, is_goal = stack.pop()
+            if isinstance(term, Var) or term is None:
+                if is_goal:
+                    calls.add(DependencyGraph.ANY)
+                continue
+            if not isinstance(term, Term) or not isinstance(term.functor, str):
+                continue
+            calls.add(term.functor)
+            if term.functor in DependencyGraph.DYNAMIC:
+                calls.add(DependencyGraph.ANY)
+            goal_args = DependencyGraph.GOAL_ARGS.get(term.functor, ()) if is_goal else ()
+            for i, arg in enumerate(term.args):
+                stack.append((arg, i in goal_args))
+        return calls
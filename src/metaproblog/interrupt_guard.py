@@ -0,0 +1,48 @@
+from contextlib import contextmanager
+import ctypes
+import threading
+
+
+class InterruptGuard:
+    """
+    Interrupts a thread by raising a KeyboardInterrupt in it (PyThreadState_SetAsyncExc), which can happen at any
+    bytecode. Code which must not be left half done (e.g. a cache updating an entry and its size accounting together)
+    runs in a deferred() section: an interrupt of a thread inside one is only noted, and raised when the outermost
+    section ends. Sections are cheap, and may be nested.
+    """
+
+    _lock = threading.Lock()
+    _depths = {} # thread ident -> how many deferred sections it is in
+    _pending = set() # idents of the threads interrupted while in a section
+
+    @staticmethod
+    @contextmanager
+    def deferred():
+        ident = threading.get_ident()
+        entered = False
+        try:
+            with InterruptGuard._lock:
+                InterruptGuard._depths[ident] = InterruptGuard._depths.get(ident, 0) + 1
+                entered = True
+            yield
+        finally:
+            interrupted = False
+            if entered:
+                with InterruptGuard._lock:
+                    depth = InterruptGuard._depths.pop(ident) - 1
+                    if depth > 0:
+                        InterruptGuard._depths[ident] = depth
+                    elif ident in InterruptGuard._pending:
+                        InterruptGuard._pending.discard(ident)
+                        interrupted = True
+            if interrupted:
+                raise KeyboardInterrupt("Interrupted by user")
+
+    """ Raises a KeyboardInterrupt in the thread with the given ident now, or when it leaves its deferred sections """
+    @staticmethod
+    def interrupt(ident):
+        with InterruptGuard._lock:
+            if ident in InterruptGuard._depths:
+                InterruptGuard._pending.add(ident)
+            else:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), ctypes.py_object(KeyboardInterrupt))
@@ -0,0 +1,82 @@
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import signal
+import threading
+
+from metaproblog.interrupt_guard import InterruptGuard
+
+
+class CellExecution:
+    """
+    Runs a cell in a thread of its own, so the kernel's event loop is not blocked while it grounds, compiles and evaluates.
+    While it runs, an interrupt (SIGINT, which is how Jupyter interrupts a kernel) cancels it: a KeyboardInterrupt is
+    raised in the thread, but only inside an interruptible() block. Elsewhere (e.g. while a cell's theory is being
+    added) it is only noted, and raised when the next interruptible block starts, so no half-added theory is left behind.
+    Inside one, updates which must not be cut short (e.g. of the caches) defer it too, see InterruptGuard.
+    Code blocked in C (e.g. waiting on a pipe) only sees the interrupt once it returns to Python; see CompilationScheduler.
+    """
+
+    POLL_SECONDS = 0.05 # How often the event loop looks in on the thread
+
+    def __init__(self, target, *args):
+        self.target = target # Called as target(execution, *args) in the thread
+        self.args = args
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._interruptible = False
+        self._interrupted = False # A KeyboardInterrupt was sent to the thread already
+        self._thread = None
+        self._result = None
+        self._error = None
+
+    """ Runs target in the thread and returns what it returns, or raises what it raises """
+    async def run(self):
+        context = contextvars.copy_context() # e.g. the kernel's parent message, for the outputs sent from the thread
+        self._thread = threading.Thread(target=context.run, args=(self._run,), name="problog-cell", daemon=True)
+        with self._handling_interrupts():
+            self._thread.start()
+            while self._thread.is_alive():
+                await asyncio.sleep(CellExecution.POLL_SECONDS)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _run(self):
+        try:
+            self._result = self.target(self, *self.args)
+        except BaseException as e:
+            self._error = e
+
+    """ Inside this, cancel raises a KeyboardInterrupt in the thread. Raises it right away if cancel was called before. """
+    @contextmanager
+    def interruptible(self):
+        with self._lock:
+            if self.cancelled:
+                self._interrupted = True
+                raise KeyboardInterrupt("Interrupted by user")
+            self._interruptible = True
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._interruptible = False
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._interruptible and not self._interrupted and self._thread is not None and self._thread.ident is not None:
+                self._interrupted = True
+                InterruptGuard.interrupt(self._thread.ident)
+
+    @contextmanager
+    def _handling_interrupts(self):
+        try:
+            previous = signal.signal(signal.SIGINT, lambda _signum, _frame: self.cancel())
+        except ValueError: # Not the main thread; interrupts reach whoever handles them there
+            previous = None
+        try:
+            yield
+        finally:
+            if previous is not None:
+                signal.signal(signal.SIGINT, previous)
@@ -2,6 +2,17 @@ from metaproblog.querying.query_factory import QueryFactory
 from problog.logic import Term
 class OptionKeys:
     QUERY_TYPE = Term("query_type")
+    COMPACTION_RATIO = Term("compaction_ratio")
+    CIRCUIT_CACHE_MB = Term("circuit_cache_mb")
+    RESULT_CACHE = Term("result_cache") # set? result_cache=100. (or 0) Answers of that many exact queries are kept, to be reused while their theories are unchanged
+    DISK_CACHE = Term("disk_cache") # set? disk_cache. (or disk_cache='dir', disk_cache=none) Keeps compiled circuits across restarts
+    LAMBDA_CELLS = Term("lambda_cells") # set? lambda_cells=16. (or none) Keeps the theories of that many cells without a %# id
+    COMPILER = Term("compiler") # set? compiler=sdd. (ddnnf, sdd, bdd or auto) Compiles exact queries with that backend
+    COMPILE_WORKERS = Term("compile_workers") # set? compile_workers=4. (or auto) Compiles independent parts of a cell in parallel
+    TIMEOUT = Term("timeout") # set? timeout=30. (or none) Queries run in a worker process, each stopped after that many seconds
+    MAX_MEMORY = Term("max_memory") # set? max_memory='4G'. (or a number of MB, or none) Likewise, each stopped if it allocates more than that
+    PROFILE = Term("profile") # set? profile. Shows the time, memory and sizes of each phase under the results
+    PROFILE_LOG = Term("profile_log") # set? profile_log='file.jsonl'. Appends the profile of each cell as one json line
 
 default_options = {
     OptionKeys.QUERY_TYPE: QueryFactory.QueryType.PROBABILITY,
@@ -2,7 +2,11 @@ from sys import stderr as sys_stderr
 from html import escape as html_escape
 
 from metaproblog.querying.sample_query import SampleQuery
+from metaproblog.querying.sample_set import SampleSet
+from metaproblog.querying.weighted_sample_query import WeightedSampleQuery
 from metaproblog.querying.amc_query import AMCQuery
+from metaproblog.querying.mcmc_query import MCMCQuery
+from metaproblog.querying.anytime_query import AnytimeQuery
 from .query_session import QuerySession
 
 class OutputFormat:
@@ -12,6 +16,8 @@ class OutputFormat:
 
 class HTMLOutput(OutputFormat):
 
+    MAX_RAW_SAMPLES = 100 # More samples than this are only shown aggregated, unless the query asks for them
+
     def format_all(self, queries, query_info):
         from html import escape as html_escape
         resp = "<div class=\"reponse\">"
@@ -23,14 +29,51 @@ class HTMLOutput(OutputFormat):
 
 
     def format_result(self, query, query_info):
-        if isinstance(query, AMCQuery):
+        if getattr(query, "resource_exceeded", None) is not None:
+            return self._format_resource_exceeded(query, query_info)
+        elif isinstance(query, AMCQuery) or isinstance(query, MCMCQuery): # MCMCQuery estimates look like AMCQuery results
             return self._format_result_amcquery(query, query_info)
+        elif isinstance(query, AnytimeQuery):
+            return self._format_result_amcquery(query, query_info, value_format=HTMLOutput._format_bounds)
+        elif isinstance(query, WeightedSampleQuery):
+            return self._format_result_weightedsamplequery(query, query_info)
         elif isinstance(query, SampleQuery):
             return self._format_result_samplequery(query, query_info)
         else:
             return "<pre>Unsupported yet<br/>: %s</pre>"%(str(query.results))
 
-    def _format_result_amcquery(self, query, query_info):
+    """ A query stopped for going over its time or memory limit (see QueryWorker) """
+    def _format_resource_exceeded(self, query, query_info):
+        exceeded = query.resource_exceeded
+        title = html_escape(str(query_info["inline_query"])) if "inline_query" in query_info else "(Cell queries)"
+        if exceeded["resource_exceeded"] == "timeout":
+            reason = "timeout: stopped after %.1fs"%exceeded["seconds"]
+        elif exceeded["limit"] is None: # A MemoryError, without a limit of our own (e.g. only a timeout was set)
+            reason = "memory: ran out of memory after %.1fs"%exceeded["seconds"]
+        else:
+            reason = "memory: needed more than %.0f MB (after %.1fs)"%(exceeded["limit"] / (1024 * 1024), exceeded["seconds"])
+        resp = "<table class=\"query_results\">"
+        resp += "\t<tr><th colspan=\"2\"><b>?</b> %s</th></tr>\n"%title
+        resp += "\t<tr class=\"query_model\"><td colspan=\"2\"><b>RESOURCE EXCEEDED</b> (%s)</td></tr>\n"%html_escape(reason)
+        resp += "</table>"
+        return resp
+
+    @staticmethod
+    def _format_bounds(bounds):
+        lower, upper = bounds
+        return "[%f, %f]"%(lower, upper) if upper - lower > 1e-9 else "%f"%lower
+
+    """ Status line for queries which report progress while they run (see AnytimeQuery.progress_callback) """
+    def format_progress(self, query, query_info):
+        progress = query.progress
+        if progress["done"]:
+            return "<div class=\"query_progress\">bounds: %d nodes expanded in %.2fs</div>"%(progress["expanded"], progress["elapsed"])
+        resp = "<div class=\"query_progress\">bounds after %d nodes, %.2fs:"%(progress["expanded"], progress["elapsed"])
+        resp += self._format_result_amcquery(query, query_info, value_format=HTMLOutput._format_bounds)
+        resp += "</div>"
+        return resp
+
+    def _format_result_amcquery(self, query, query_info, value_format="%f".__mod__):
         resp = ""
         resp += "<table class=\"query_results\">"
         query_probs, evidence = query.results
@@ -47,7 +90,7 @@ class HTMLOutput(OutputFormat):
             else:
                 for q,p in query_probs:
                     subs =  html_escape(", ".join( ("%s=%s"%(varname,varval)) for varname,varval in zip(q_terms[0].args,q.args) ))
-                    resp += "\t<tr class=\"query_model\"><td>%f</td><td>%s</td></tr>\n"%(p, subs)
+                    resp += "\t<tr class=\"query_model\"><td>%s</td><td>%s</td></tr>\n"%(value_format(p), subs)
         else:
             resp += "\t<tr><th colspan=\"2\">(Cell queries)</th></tr>\n"
             if evidence:
@@ -55,12 +98,14 @@ class HTMLOutput(OutputFormat):
             if len(query_probs)==1 and isinstance(query_probs[0][1], dict):
                 resp += "\t<tr class=\"query_model\"><td colspan=\"2\"><b>FAILED</b></td></tr>\n"
             else:
-                resp += "\n".join(["<tr><td>%f</td><td>%s</td></tr>\n"%(p, html_escape(str(q))) for q,p in query_probs])
+                resp += "\n".join(["<tr><td>%s</td><td>%s</td></tr>\n"%(value_format(p), html_escape(str(q))) for q,p in query_probs])
         resp += "</table>"
 
         return resp
 
 
+    """ How often each answer came up, with a confidence interval, then the samples themselves if there are at most
+        MAX_RAW_SAMPLES of them or the query asked for them (sample(N, raw)) """
     def _format_result_samplequery(self, query, query_info):
 
         def _str_sample_term(term, query_info):
@@ -78,23 +123,108 @@ class HTMLOutput(OutputFormat):
         q_terms, ev_terms = query_info["query"]
         if "inline_query" in query_info:
             original_iq = query_info["inline_query"]
-            resp += "\t<tr><th><b>?</b> %s</th></tr>\n"%html_escape(str(original_iq))
+            resp += "\t<tr><th colspan=\"3\"><b>?</b> %s</th></tr>\n"%html_escape(str(original_iq))
         else:
-            resp += "\t<tr><th>(Cell queries)</th></tr>\n"
+            resp += "\t<tr><th colspan=\"3\">(Cell queries)</th></tr>\n"
 
 
         if evidence:
-            resp += "\t<th><b>evidence:</b> %s</th></tr>\n"%html_escape(str(evidence))
-        if False: # TODO: What does sampling look like on failure?
-            resp += "\t<tr class=\"query_model\"><td colspan=\"2\"><b>FAILED</b></td></tr>\n"
-        else:
+            resp += "\t<tr><th colspan=\"3\"><b>evidence:</b> %s</th></tr>\n"%html_escape(str(evidence))
+        if not isinstance(samples, SampleSet):
+            samples = SampleSet(samples)
+        confidence = getattr(query, "confidence", SampleSet.DEFAULT_CONFIDENCE)
+        resp += "\t<tr><th>frequency</th><th>%g%% interval</th><th>%d samples</th></tr>\n"%(confidence * 100, len(samples))
+        if samples.convergence is not None:
+            resp += "\t<tr><th colspan=\"3\">%s</th></tr>\n"%html_escape(HTMLOutput._format_convergence(samples.convergence))
+        for term, estimate, (low, high) in samples.marginals(confidence):
+            resp += "\t<tr class=\"query_model\"><td>%f</td><td>[%f, %f]</td><td>%s</td></tr>\n"%(
+                        estimate, low, high, _str_sample_term(term, query_info))
+
+        if getattr(query, "raw", False) or len(samples) <= HTMLOutput.MAX_RAW_SAMPLES:
+            resp += "\t<tr><th colspan=\"3\">samples</th></tr>\n"
             for sample_dict in samples:
                 sample_str = ", ".join(_str_sample_term(k, query_info)
                                     for k in sample_dict if sample_dict[k])
-                resp += "\t<tr class=\"query_model\"><td>%s</td></tr>\n"%( sample_str )
+                resp += "\t<tr class=\"query_model\"><td colspan=\"3\">%s</td></tr>\n"%( sample_str )
+        else:
+            resp += "\t<tr><th colspan=\"3\">samples not shown; sample(N, raw) shows them</th></tr>\n"
+
+        resp += "</table>"
+
+        return resp
+
+    """ How adaptive sampling went (see SampleQuery.evaluate_adaptive) """
+    @staticmethod
+    def _format_convergence(convergence):
+        reasons = {
+            "converged": "reached the target",
+            "max_samples": "stopped at the most samples allowed",
+            "timeout": "stopped by the timeout",
+            "evidence": "stopped: no sample satisfies the evidence",
+            "interrupted": "interrupted",
+        }
+        width = "n/a" if convergence["width"] is None else "%f"%convergence["width"]
+        return "widest interval %s (target %g), %s after %d samples (%d rejected) in %.2fs"%(
+                    width, convergence["target_width"], reasons.get(convergence["stopped"], convergence["stopped"]),
+                    convergence["samples"], convergence["rejected"], convergence["seconds"])
+
+    """ The weighted estimates, with Wilson intervals for as many samples as the effective sample size, then the samples
+        themselves as for _format_result_samplequery """
+    def _format_result_weightedsamplequery(self, query, query_info):
+        def _str_sample_term(term):
+            if "inline_query" in query_info:
+                sub_dict = {k:v for (k,v) in zip(query_info["query"][0][0].args, term.args)}
+                return "[%s]"%html_escape(str( query_info["inline_query"].apply(sub_dict) ))
+            else:
+                return html_escape(str(term))
+
+        resp = ""
+        resp += "<table class=\"query_results\">"
+        samples, evidence, weights = query.results
+        if "inline_query" in query_info:
+            resp += "\t<tr><th colspan=\"3\"><b>?</b> %s</th></tr>\n"%html_escape(str(query_info["inline_query"]))
+        else:
+            resp += "\t<tr><th colspan=\"3\">(Cell queries)</th></tr>\n"
+        if evidence:
+            resp += "\t<tr><th colspan=\"3\"><b>evidence:</b> %s</th></tr>\n"%html_escape(str(evidence))
+
+        estimates = WeightedSampleQuery.estimate(samples, weights)
+        if estimates is None:
+            resp += "\t<tr class=\"query_model\"><td colspan=\"3\"><b>All %d samples have weight 0</b></td></tr>\n"%len(samples)
+        else:
+            confidence = getattr(query, "confidence", SampleSet.DEFAULT_CONFIDENCE)
+            ess = WeightedSampleQuery.effective_sample_size(weights)
+            resp += "\t<tr><th>estimate</th><th>%g%% interval</th><th>effective sample size %.1f of %d</th></tr>\n"%(
+                        confidence * 100, ess, len(samples))
+            for term, p in estimates.items():
+                if not term.is_ground(): # The query itself, in samples without an answer (see SampleSet.frequencies)
+                    continue
+                low, high = SampleSet.wilson_interval(p * ess, ess, confidence)
+                resp += "\t<tr class=\"query_model\"><td>%f</td><td>[%f, %f]</td><td>%s</td></tr>\n"%(p, low, high, _str_sample_term(term))
+            if getattr(query, "raw", False) or len(samples) <= HTMLOutput.MAX_RAW_SAMPLES:
+                resp += "\t<tr><th>weight</th><th colspan=\"2\">samples</th></tr>\n"
+                for sample_dict, weight in zip(samples, weights):
+                    sample_str = ", ".join(_str_sample_term(k) for k in sample_dict if sample_dict[k])
+                    resp += "\t<tr class=\"query_model\"><td>%g</td><td colspan=\"2\">%s</td></tr>\n"%(weight, sample_str)
+            else:
+                resp += "\t<tr><th colspan=\"3\">samples not shown; sample(N, weighted, raw) shows them</th></tr>\n"
 
         resp += "</table>"
+        return resp
 
+    """ rows: Profiler.export() """
+    def format_profile(self, rows):
+        standard = ("phase", "query", "depth", "wall_s", "peak_mem_bytes")
+        resp = "<table class=\"query_profile\">"
+        resp += "\t<tr><th>phase</th><th>query</th><th>wall (ms)</th><th>peak mem (KB)</th><th>details</th></tr>\n"
+        for row in rows:
+            details = ", ".join("%s=%s"%(k, v) for k, v in row.items() if k not in standard)
+            resp += "\t<tr><td>%s%s</td><td>%s</td><td>%.1f</td><td>%s</td><td>%s</td></tr>\n"%(
+                "&nbsp;&nbsp;" * row["depth"], html_escape(row["phase"]), html_escape(row["query"] or ""),
+                row.get("wall_s", 0.0) * 1000,
+                ("%.1f"%(row["peak_mem_bytes"] / 1024)) if "peak_mem_bytes" in row else "",
+                html_escape(details))
+        resp += "</table>"
         return resp
 
 #TODO: Add TextOutputter
@@ -1,6 +1,6 @@
-from os import stat
+import os
+from uuid import uuid4
 
-from traitlets.traitlets import _deprecated_method
 from .output_formatting import HTMLOutput
 from sys import stderr as sys_stderr
 import traceback
@@ -9,10 +9,15 @@ from ipykernel.kernelbase import Kernel
 from problog.program import PrologString, DefaultPrologFactory
 from problog.parser import PrologParser, Token
 
+from .cell_execution import CellExecution
 from .problog_wrapper import ProblogWrapper
+from .query_worker import QueryWorker
 from .query_session import QuerySession
 from .kernel_options import default_options, OptionKeys
 from metaproblog.querying.query_factory import QueryFactory
+from metaproblog.profiler import Profiler
+from metaproblog.querying.disk_cache import DiskCache
+from problog.logic import unquote
 
 class ProblogKernelException(RuntimeError):
     pass
@@ -39,12 +44,23 @@ class ProblogKernel(Kernel):
         self.options = {}
         self.options.update( default_options )
 
-    def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False):
+    """ The cell runs in a thread (see CellExecution), so an interrupt cancels it without stopping the kernel """
+    async def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False):
+        return await CellExecution(self._execute, code, silent).run()
+
+    """ Runs a cell. Each query's result is sent as soon as it is evaluated; after an interrupt, those already sent stay """
+    def _execute(self, execution, code, silent):
+        qs = None
+        queries = []
+        finished = []
         try:
             active_options = dict(self.options)
+            if self._option_enabled(active_options, OptionKeys.PROFILE):
+                Profiler.start()
 
             if not hasattr(self, "pbl") or self.pbl is None:
                 self.pbl = ProblogWrapper()
+            self._apply_wrapper_options(active_options)
 
             # First: Get the cell_id if it has one. The first line with a %#
             # TODO: A version with a generator would be cooler
@@ -59,40 +75,58 @@ class ProblogKernel(Kernel):
                     break
 
 
-            cell_queries, cell_evidence, questions = self.pbl.process_cell(cell_id, PrologString(code, parser=self.custom_parser))
+            cell_queries, cell_evidence, questions = self.pbl.process_cell(cell_id, PrologString(code, parser=self.custom_parser), code,
+                                                                            self._frontend_cell_id())
 
             # TODO: Handle prepare failures
             qs = self.pbl.create_query_session()
-            queries = []
             query_info = {}
 
-            for q in questions:
-                mode, inlineq = (q.args[0], q.args[1]) if q.arity == 2 else (None, q.args[0])
-                if mode is not None and mode.functor == "set":
-                    self._update_options(inlineq, self.options)
-                    self._update_options(inlineq, active_options)
-                elif mode is not None and mode.functor == "with":
-                    self._update_options(inlineq, active_options)
-                else:
-                    query_type_spec = active_options[OptionKeys.QUERY_TYPE] if mode is None else mode
-                    iq_query, iq_evidence = qs.transform_inline_query(inlineq)
+            with execution.interruptible():
+                for q in questions:
+                    mode, inlineq = (q.args[0], q.args[1]) if q.arity == 2 else (None, q.args[0])
+                    if mode is not None and mode.functor == "set":
+                        self._update_options(inlineq, self.options)
+                        self._update_options(inlineq, active_options)
+                        if self._option_enabled(active_options, OptionKeys.PROFILE):
+                            Profiler.start() # Profiles the rest of this cell already
+                    elif mode is not None and mode.functor == "with":
+                        self._update_options(inlineq, active_options)
+                        if self._option_enabled(active_options, OptionKeys.PROFILE):
+                            Profiler.start()
+                    else:
+                        query_type_spec = active_options[OptionKeys.QUERY_TYPE] if mode is None else mode
+                        iq_query, iq_evidence = qs.transform_inline_query(inlineq)
+
+                        qobj = qs.prepare_query(iq_query, iq_evidence, query_type_spec, self._compiler(active_options), self._limits(active_options))
+                        queries.append(qobj)
+                        query_info[qobj] = {"query": (iq_query, iq_evidence), "inline_query": inlineq}
 
-                    qobj = qs.prepare_query(iq_query, iq_evidence, query_type_spec)
+                if cell_queries:
+                    qobj = qs.prepare_query(cell_queries, cell_evidence, active_options[OptionKeys.QUERY_TYPE], self._compiler(active_options),
+                                                self._limits(active_options))
                     queries.append(qobj)
-                    query_info[qobj] = {"query": (iq_query, iq_evidence), "inline_query": inlineq}
+                    query_info[qobj] = {"query": (cell_queries, cell_evidence)}
 
-            if cell_queries:
-                qobj = qs.prepare_query(cell_queries, cell_evidence, active_options[OptionKeys.QUERY_TYPE])
-                queries.append(qobj)
-                query_info[qobj] = {"query": (cell_queries, cell_evidence)}
+                if not silent:
+                    for qobj in queries:
+                        if getattr(qobj, "progress_callback", False) is None:
+                            qobj.progress_callback = self._progress_display(query_info[qobj])
 
-            results = qs.evaluate_queries()
-            # TODO: Error handling / acknowledgement of cells without queries running successfully
+                def _send_result(qobj):
+                    finished.append(qobj)
+                    if not silent:
+                        with Profiler.phase("format"):
+                            output_type, content = self.outputter.format_all([qobj], query_info)
+                        self.send_response(self.iopub_socket, output_type, content)
 
-            if not silent:
-                # Format and send the response
-                output_type, content = self.outputter.format_all(queries, query_info)
-                self.send_response(self.iopub_socket, output_type, content)
+                results = qs.evaluate_queries(_send_result)
+                # TODO: Error handling / acknowledgement of cells without queries running successfully
+            qs.close()
+
+            profiler = Profiler.stop()
+            if profiler is not None:
+                self._report_profile(profiler, query_info, active_options, cell_id, silent)
 
 
             return {'status': 'ok',
@@ -101,7 +135,20 @@ class ProblogKernel(Kernel):
                     'payload': [],
                     'user_expressions': {},
                 }
+        except KeyboardInterrupt:
+            Profiler.stop()
+            if qs is not None:
+                qs.close()
+            self.send_response(self.iopub_socket, 'stream', {'name': 'stderr',
+                'text': "Interrupted. %d of %d queries finished.\n"%(len(finished), len(queries))})
+            return {'status': 'error',
+                'execution_count': self.execution_count,
+                'ename': 'KeyboardInterrupt',
+                'evalue': 'Interrupted by user',
+                'traceback': [],
+            }
         except Exception as e:
+            Profiler.stop()
             error_text = "An error occured: %s\nTraceback:\n %s\n"%(str(e), traceback.format_exc())
             stream_content = {'name': 'stdout', 'text': error_text}
             self.send_response(self.iopub_socket, 'stream', stream_content)
@@ -113,6 +160,38 @@ class ProblogKernel(Kernel):
             }
             print(traceback)
 
+    """ Shows the profile under the results (html, plus the same rows as application/json) and appends it to the profile_log """
+    def _report_profile(self, profiler, query_info, options, cell_id, silent):
+        def _label(qobj):
+            info = query_info.get(qobj)
+            if info is None:
+                return str(qobj)
+            return str(info["inline_query"]) if "inline_query" in info else "(cell queries)"
+
+        rows = profiler.export(_label)
+        if not silent:
+            content = {'data': {'text/html': self.outputter.format_profile(rows), 'application/json': {"phases": rows}}, 'metadata': {}}
+            self.send_response(self.iopub_socket, 'display_data', content)
+        if OptionKeys.PROFILE_LOG in options:
+            with open(unquote(str(options[OptionKeys.PROFILE_LOG])), "a") as log:
+                log.write(profiler.to_json(_label, cell_id=cell_id, execution_count=self.execution_count) + "\n")
+
+    @staticmethod
+    def _option_enabled(options, key):
+        value = options.get(key)
+        return value is True or str(value) == "true"
+
+    """ A progress_callback for queries which report while running: one display, updated in place """
+    def _progress_display(self, query_info):
+        display_id = uuid4().hex
+        shown = [False]
+        def _callback(query):
+            content = {'data': {'text/html': self.outputter.format_progress(query, query_info)},
+                        'metadata': {}, 'transient': {'display_id': display_id}}
+            self.send_response(self.iopub_socket, 'update_display_data' if shown[0] else 'display_data', content)
+            shown[0] = True
+        return _callback
+
     """ deprecating """
     def format_results_text(self, results, tasks, q_desc):
         resp = ""
@@ -141,9 +220,52 @@ class ProblogKernel(Kernel):
 
         return resp
 
+    def _apply_wrapper_options(self, options):
+        if OptionKeys.COMPACTION_RATIO in options:
+            ratio = options[OptionKeys.COMPACTION_RATIO]
+            self.pbl.theory_manager.compaction_ratio = None if ratio.functor == "none" else float(ratio)
+        if OptionKeys.CIRCUIT_CACHE_MB in options:
+            self.pbl.circuit_cache.resize(int(float(options[OptionKeys.CIRCUIT_CACHE_MB]) * 1024 * 1024))
+        if OptionKeys.RESULT_CACHE in options:
+            self.pbl.result_cache.resize(int(options[OptionKeys.RESULT_CACHE]))
+        if OptionKeys.DISK_CACHE in options:
+            value = options[OptionKeys.DISK_CACHE]
+            path = None if value is True else unquote(str(value))
+            disk = self.pbl.circuit_cache.disk
+            if path == "none":
+                self.pbl.circuit_cache.attach_disk(None)
+            elif disk is None or disk.path != os.path.expanduser(path or DiskCache.default_path()):
+                self.pbl.circuit_cache.attach_disk(DiskCache(path))
+        if OptionKeys.LAMBDA_CELLS in options:
+            limit = options[OptionKeys.LAMBDA_CELLS]
+            self.pbl.max_lambda_cells = None if str(limit) == "none" else int(limit)
+        if OptionKeys.COMPILE_WORKERS in options:
+            workers = options[OptionKeys.COMPILE_WORKERS]
+            self.pbl.compile_workers = "auto" if str(workers) == "auto" else int(workers)
+
+    """ The id the frontend (e.g. JupyterLab) gives the cell being run, if it sends one. Re-running a cell without a %# id
+        then replaces what it added last time, even if its text changed. """
+    def _frontend_cell_id(self):
+        parent = self.get_parent() if hasattr(self, "get_parent") else getattr(self, "_parent_header", None)
+        return (parent or {}).get("metadata", {}).get("cellId")
+
+    @staticmethod
+    def _compiler(options):
+        return unquote(str(options[OptionKeys.COMPILER])) if OptionKeys.COMPILER in options else None
+
+    """ (timeout seconds, max_memory bytes) for QuerySession.prepare_query, or None if neither is set """
+    @staticmethod
+    def _limits(options):
+        limits = (QueryWorker.parse_seconds(options.get(OptionKeys.TIMEOUT)), QueryWorker.parse_size(options.get(OptionKeys.MAX_MEMORY)))
+        return None if limits == (None, None) else limits
+
     def _update_options(self, body, which_options):
-        key, value = (body.args[0], body.args[1]) if body.functor == "'='" \
-                            else (body.args[0], True)
+        if body.functor == "'='":
+            key, value = body.args[0], body.args[1]
+        elif body.arity == 0: # A flag, e.g. set? profile.
+            key, value = body, True
+        else:
+            key, value = body.args[0], True
         which_options[key] = value
 
     @staticmethod
@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import hashlib
+
 from problog import get_evaluatable
 from problog.engine import DefaultEngine
 from problog.formula import LogicFormula
@@ -6,23 +9,63 @@ from problog.program import PrologString
 from problog.logic import And, Not, Term, AnnotatedDisjunction, Clause
 
 from .query_session import QuerySession
+from .query_worker import QueryWorker
 
 
 from metaproblog.theory_manager import TheoryManager
+from metaproblog.profiler import Profiler
+from metaproblog.querying.circuit_cache import CircuitCache
+from metaproblog.querying.compiler_selector import CompilerSelector
+from metaproblog.querying.result_cache import ResultCache
 
 class ProblogWrapper:
 
+    MAX_PARSED = 256 # Cell texts whose statements are kept
+    MAX_LAMBDA_CELLS = 64 # Theories of cells without an id that are kept; the least recently run are removed
+
     def __init__(self):
-        self.db = self.create_engine().prepare([])
+        self.engine = self.create_engine() # Used to prepare the db. Queries get their own engines.
+        self.db = self.engine.prepare([])
         self.theory_manager = TheoryManager.initialize(self.db)
+        self.circuit_cache = CircuitCache()
+        self.theory_manager.add_listener(self.circuit_cache.invalidate_theory)
         self.lambda_cell_id = 0
+        self.compile_workers = 1 # Processes for compiling the independent parts of a query session; "auto" for one per cpu
+        self.compiler = "ddnnf" # Or sdd, bdd, or auto to let the compiler_selector pick, learning from the compile times it sees
+        self.compiler_selector = CompilerSelector()
+        self.result_cache = ResultCache() # Answers of exact queries asked before, while the theories they depend on are the same
+        self.query_worker = QueryWorker(self) # For queries with a time or memory limit; forks a process once one comes
+        self._parsed = OrderedDict() # hash of a cell's text -> its statements, least recently used first
+        self._cell_sources = {} # cell theory id -> hash of the text it was last processed from
+        self.max_lambda_cells = ProblogWrapper.MAX_LAMBDA_CELLS # None keeps them all
+        self._lambda_theories = OrderedDict() # lambda cell theory id -> its slot (or None), least recently run first
+        self._lambda_slots = {} # slot -> lambda cell theory id
 
     # public
-    def process_cell(self, cell_id_user, code: "problog.program.PrologString"):
-        cell_id = self._cell_theory_id(cell_id_user) # Rename it a little
-
-        if cell_id is not None and self.theory_manager.theory_exists(cell_id):
-            self.theory_manager.remove_theory(cell_id)
+    """ source: the text code was made from, if known. Then code is not parsed again if that text was parsed before,
+        and a cell (with an id) whose text did not change since it was last processed is left as it is: its theory is
+        still there, so the db is not prepared again, and what was compiled from it stays cached.
+        slot: for cells without an id, what identifies where the cell runs from (e.g. the frontend's cell id).
+        Running a slot again replaces the theory it added last time. Without a slot, the text identifies the cell. """
+    def process_cell(self, cell_id_user, code: "problog.program.PrologString", source=None, slot=None):
+        source_key = hashlib.sha1(source.encode()).hexdigest() if source is not None else None
+        if cell_id_user is None and slot is None:
+            slot = source_key
+        cell_id = self._cell_theory_id(cell_id_user, slot) # Rename it a little
+
+        with Profiler.phase("parse"):
+            parsed = self._parsed.get(source_key) if source_key is not None else None
+            if parsed is None:
+                parsed = list(code) # PrologString parses lazily
+                if source_key is not None:
+                    self._parsed[source_key] = parsed
+                    while len(self._parsed) > ProblogWrapper.MAX_PARSED:
+                        self._parsed.popitem(last=False)
+            else:
+                self._parsed.move_to_end(source_key)
+                Profiler.annotate(cached=True)
+            code = parsed
+            Profiler.annotate(statements=len(code))
 
         statement_list = []
         queries = []
@@ -39,18 +82,70 @@ class ProblogWrapper:
             else:
                 statement_list.append(stmt)
 
-        if statement_list:
-            self.theory_manager.add_theory(cell_id, statement_list)
-            self.db = self.create_engine().prepare(self.db) # Does a process_directives
+        with Profiler.phase("prepare", statements=len(statement_list)):
+            if self._is_unchanged(cell_id, source_key, statement_list):
+                Profiler.annotate(unchanged=True)
+                return queries, evidence, questions
+
+            if cell_id is not None and self.theory_manager.theory_exists(cell_id):
+                self.theory_manager.remove_theory(cell_id)
+                if self.theory_manager.needs_compaction():
+                    self.compact()
+                    Profiler.annotate(compacted=True)
+
+            if statement_list:
+                self.theory_manager.add_theory(cell_id, statement_list)
+                self.db = self.engine.prepare(self.db) # Runs the directives not run yet, i.e. this cell's
+            Profiler.annotate(db_nodes=len(self.db))
+            self._cell_sources[cell_id] = source_key
 
         return queries, evidence, questions
 
-    def _cell_theory_id(self, cell_id):
-        if cell_id is None:
-            self.lambda_cell_id += 1
-            return "_pbl_lambda_cell_%d"%self.lambda_cell_id
-        else:
+    """ Directives are run again even if the cell did not change: what they load (e.g. consult) may have """
+    def _is_unchanged(self, cell_id, source_key, statement_list):
+        if source_key is None or self._cell_sources.get(cell_id) != source_key:
+            return False
+        if any(isinstance(stmt, Clause) and stmt.head.functor == "_directive" for stmt in statement_list):
+            return False
+        return not statement_list or self.theory_manager.theory_exists(cell_id)
+
+    """ Rebuilds the db from the live theories, dropping the nodes of removed ones """
+    def compact(self):
+        new_db = self.theory_manager.compact(self.engine.prepare([]))
+        self.db = self.engine.prepare(new_db) # The rebuilt db needs all its directives run again
+        return self.theory_manager.stats()
+
+    def _cell_theory_id(self, cell_id, slot=None):
+        if cell_id is not None:
             return "_pbl_cell_%s"%cell_id
+        theory_id = self._lambda_slots.get(slot) if slot is not None else None
+        if theory_id is None:
+            self.lambda_cell_id += 1
+            theory_id = "_pbl_lambda_cell_%d"%self.lambda_cell_id
+            if slot is not None:
+                self._lambda_slots[slot] = theory_id
+        self._lambda_theories[theory_id] = slot
+        self._lambda_theories.move_to_end(theory_id)
+        self._evict_lambda_cells(keep=theory_id)
+        return theory_id
+
+    """ Removes the theories of the least recently run cells without an id, beyond max_lambda_cells """
+    def _evict_lambda_cells(self, keep=None):
+        removed = False
+        while self.max_lambda_cells is not None and len(self._lambda_theories) > max(self.max_lambda_cells, 1):
+            theory_id, slot = next(iter(self._lambda_theories.items()))
+            if theory_id == keep:
+                break
+            self._lambda_theories.pop(theory_id)
+            if slot is not None:
+                self._lambda_slots.pop(slot, None)
+            self._cell_sources.pop(theory_id, None)
+            if self.theory_manager.theory_exists(theory_id):
+                self.theory_manager.remove_theory(theory_id)
+                removed = True
+        if removed and self.theory_manager.needs_compaction():
+            self.compact()
+            Profiler.annotate(compacted=True)
 
     """ Run a single query - ground, compile and evaluate. For multiple queries, Use a QuerySession """
     def query(self, queries: "List[problog.logic.Term]", evidence: "List[problog.logic.Term]"):
@@ -58,7 +153,8 @@ class ProblogWrapper:
         return get_evaluatable().create_from(lf).evaluate()
 
     def create_query_session(self):
-        return QuerySession(self.create_engine(), self.db)
+        return QuerySession(self.create_engine(), self.db, self.circuit_cache, self.theory_manager, self.compile_workers,
+                                self.compiler, self.compiler_selector, self.result_cache, self.query_worker)
 
     def create_engine(self):
         return DefaultEngine()
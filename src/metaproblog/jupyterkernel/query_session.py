@@ -6,73 +6,177 @@ from sys import stderr as sys_stderr
 import sys
 
 from problog.formula import LogicFormula, LogicDAG
-from problog.logic import And, Not, Term, Clause
+from problog.logic import And, Not, Term, Clause, unquote
 from problog.ddnnf_formula import DDNNF
 from problog.cnf_formula import CNF
 
+from metaproblog.querying.compiler_selector import CompilerSelector
 from metaproblog.querying.formula_wrapper import FormulaWrapper
 from metaproblog.querying.query_factory import QueryFactory
+from metaproblog.querying.result_cache import ResultCache
+from metaproblog.profiler import Profiler
 
 class QuerySession:
 
     TIQ_HEAD_PREFIX = "_tiq"
-    TIQ_COUNT = 0
+    EXACT_TYPES = (QueryFactory.QueryType.PROBABILITY, QueryFactory.QueryType.MPE, QueryFactory.QueryType.MINPE) # Compiled to circuits
 
-    def __init__(self, engine, base_db):
+    def __init__(self, engine, base_db, circuit_cache=None, theory_manager=None, compile_workers=1, compiler="ddnnf", compiler_selector=None,
+                    result_cache=None, query_worker=None):
         self.engine = engine
+        self.compiler = compiler # For exact queries which do not say: ddnnf, sdd, bdd or auto
         self.db = self.engine.prepare(base_db.extend())
-        self.tiq_count = 0 # transformed_inline_query
+        self.tiq_count = 0 # transformed_inline_query. Per session, so the names are the same each time a cell runs.
 
         self._compiled = False
-        self.lf_wrapper = FormulaWrapper(self.db)
+        self.lf_wrapper = FormulaWrapper(self.db, circuit_cache, theory_manager, compile_workers, compiler_selector)
         self.queries = []
+        self.result_cache = result_cache if theory_manager is not None else None # Needs the theories' versions
+        self._result_keys = {} # query -> its key in the result_cache, for queries it did not have
+        self._cached = set() # queries answered from the result_cache
+        self.query_worker = query_worker # Evaluates the queries prepared with limits (see QueryWorker)
+        self._isolated = {} # query -> what the query_worker needs to evaluate it
 
     def _compile(self):
         self._compiled = True
 
-    def _process_query_type_spec(self, query_type_spec):
+    """ (query_type, kwargs for QueryFactory.create_query). Exact queries are compiled with the compiler in the spec,
+        e.g. probability(compiler(sdd)), else the given compiler, else the session's. """
+    def _process_query_type_spec(self, query_type_spec, compiler=None):
         # print(type(query_type_spec), query_type_spec, file=sys_stderr )
         if isinstance(query_type_spec, Term):
             query_type = QueryFactory.QueryType[ str.upper(query_type_spec.functor) ]  
             kwargs = {}
-            if query_type_spec.functor == 'sample':
-                if query_type_spec.arity >= 1:
-                    kwargs['n_samples'] = int(query_type_spec.args[0].functor)
+            if query_type_spec.functor in ('sample', 'weighted_sample', 'mcmc'):
+                options = list(query_type_spec.args)
+                if options and options[0].is_constant():
+                    kwargs['n_samples'] = int(options.pop(0).functor)
+                kwargs.update(QuerySession._spec_kwargs(options))
+                if kwargs.pop('weighted', False): # sample(N, weighted) is weighted_sample(N)
+                    query_type = QueryFactory.QueryType.WEIGHTED_SAMPLE
+                if 'ci' in kwargs and 'n_samples' in kwargs: # sample(N, ci(W, C)): at most N
+                    kwargs.setdefault('max_samples', kwargs.pop('n_samples'))
+            elif query_type_spec.functor == 'anytime': # anytime(Seconds, ...) or anytime(timeout(Seconds), nodes(N), epsilon(E))
+                options = list(query_type_spec.args)
+                if options and options[0].is_constant():
+                    kwargs['timeout'] = float(options.pop(0))
+                kwargs.update(QuerySession._spec_kwargs(options))
+            elif query_type in QuerySession.EXACT_TYPES:
+                kwargs.update(QuerySession._spec_kwargs(query_type_spec.args))
+                kwargs['target_class'] = CompilerSelector.target_class(kwargs.pop('compiler', compiler or self.compiler))
             
             return query_type, kwargs
         elif isinstance(query_type_spec, QueryFactory.QueryType):
+            if query_type_spec in QuerySession.EXACT_TYPES:
+                return query_type_spec, {'target_class': CompilerSelector.target_class(compiler or self.compiler)}
             return query_type_spec, {}
         else:
             raise ProblogKernelException("Unknown query_type_spec: %s(%s)"%(type(query_type_spec), query_type_spec))
         
 
-    """ Add a set of queries which share the same evidence """
-    def prepare_query(self, queries, evidence, query_type_spec):
+    """ Trailing options of a query type spec, e.g. sample(100, workers(4), seed(42), weighted), sample(10000, vectorized),
+        sample(ci(0.01, 0.95), max_samples(100000), timeout(60)) or mcmc(5000, burnin(500), thin(2)):
+        name(value), name(value, ...) for a tuple of values, or a flag name """
+    @staticmethod
+    def _spec_kwargs(option_terms):
+        kwargs = {}
+        for option in option_terms:
+            if option.arity == 0:
+                kwargs[option.functor] = True
+            else:
+                values = tuple(value.value if value.is_constant() and not isinstance(value.value, str) else unquote(value.functor)
+                                for value in option.args)
+                kwargs[option.functor] = values[0] if len(values) == 1 else values
+        return kwargs
+
+    """ Add a set of queries which share the same evidence. compiler: as in _process_query_type_spec.
+        limits: (timeout seconds, max_memory bytes), either None for no limit, to evaluate it in the query_worker """
+    def prepare_query(self, queries, evidence, query_type_spec, compiler=None, limits=None):
         if self._compiled:
             raise ProblogKernelException("QuerySession was compiled. You cannot prepare_query anymore.")
 
-        query_type, kwargs = self._process_query_type_spec(query_type_spec)
+        query_type, kwargs = self._process_query_type_spec(query_type_spec, compiler)
+        return self.prepare_typed_query(query_type, kwargs, queries, evidence, limits)
+
+    """ prepare_query, with the query type and the kwargs for QueryFactory.create_query made already """
+    def prepare_typed_query(self, query_type, kwargs, queries, evidence, limits=None):
         qobj = QueryFactory.create_query(query_type, queries, evidence, self.lf_wrapper, **kwargs)
         # print("Created query of type", type(qobj), file=sys_stderr)
 
         if qobj:
             self.queries.append(qobj)
-            qobj.ground(self.engine)
+            with Profiler.phase("ground", query=qobj):
+                if self.result_cache is not None and query_type in QuerySession.EXACT_TYPES:
+                    key = self._result_key(query_type, kwargs, queries, evidence)
+                    qobj.results = self.result_cache.get(key, queries)
+                    Profiler.annotate(result_cached=qobj.results is not None,
+                                        **{"result_cache_" + name: value for name, value in self.result_cache.stats().items()})
+                    if qobj.results is not None:
+                        self._cached.add(qobj)
+                        return qobj
+                    self._result_keys[qobj] = key
+                if limits is not None and self.query_worker is not None:
+                    self._isolated[qobj] = (query_type, kwargs, self.lf_wrapper.clauses_for(queries), limits)
+                    return qobj
+                qobj.ground(self.engine)
             return qobj
         else:
             return None
 
-    """ Evaluates all queries added with queries """
-    def evaluate_queries(self):
+    """ Key of the results of a query in the result_cache. The target class is left out: every compiler gives the same answers """
+    def _result_key(self, query_type, kwargs, queries, evidence):
+        clauses = self.lf_wrapper.clauses_for(queries)
+        theory_manager = self.lf_wrapper.theory_manager
+        theories, _predicates = theory_manager.dependencies(list(queries) + [clause.body for clause in clauses] + [term for term, _ in evidence])
+        versions = sorted((str(theory), theory_manager.theory_hash(theory)) for theory in theories)
+        options = (query_type.name,) + tuple(sorted((name, str(value)) for name, value in kwargs.items() if name != "target_class"))
+        return ResultCache.key(queries, evidence, {clause.head.functor: clause for clause in clauses}, options, versions)
+
+    """ Evaluates all queries added with queries, in order. on_result(query) is called as soon as each one is done """
+    def evaluate_queries(self, on_result=None):
         if not self._compiled:
             self._compile()
 
         results = []
         for q in self.queries:
-            results.append( q.evaluate(self.engine) )
+            if q in self._cached:
+                results.append(q.results)
+            elif q in self._isolated:
+                query_type, kwargs, clauses, (timeout, max_memory) = self._isolated[q]
+                with Profiler.phase("evaluate", query=q, isolated=True):
+                    q.results, q.resource_exceeded = self.query_worker.run(query_type, kwargs, q.queries, q.evidence, clauses, timeout, max_memory)
+                    if q.resource_exceeded is not None:
+                        Profiler.annotate(**q.resource_exceeded)
+                results.append(q.results)
+                if q in self._result_keys and q.resource_exceeded is None:
+                    self.result_cache.put(self._result_keys[q], q.queries, q.results)
+            else:
+                with Profiler.phase("evaluate", query=q):
+                    results.append( q.evaluate(self.engine) )
+                if q in self._result_keys:
+                    self.result_cache.put(self._result_keys[q], q.queries, q.results)
+            if on_result is not None:
+                on_result(q)
 
         return results
 
+    """ Lets go of what the session built: its extension of the db, with the clauses of its inline queries, and its
+        formulas. The queries keep their results, but can not be evaluated again. """
+    def close(self):
+        for q in self.queries:
+            q.formula_wrapper = None
+        self.queries = []
+        self._result_keys.clear()
+        self._cached.clear()
+        self._isolated.clear()
+        self.lf_wrapper = None
+        self.db = None
+
+    """ Adds a clause to the session's db only (e.g. of a transformed inline query) """
+    def add_clause(self, clause):
+        self.db.add_statement(clause)
+        self.lf_wrapper.note_clause(clause)
+
     """ Adds a query-node to the program and returns it's signature """
     def transform_inline_query(self, inline_query):
         def _conj2list(conj):
@@ -100,11 +204,11 @@ class QuerySession:
             qc = inline_query
             evidence = []
 
-        QuerySession.TIQ_COUNT += 1
+        self.tiq_count += 1
         varnames = qc.variables(exclude_local=True)
-        tiq_head_functor = "%s_%d"%(QuerySession.TIQ_HEAD_PREFIX, QuerySession.TIQ_COUNT)
+        tiq_head_functor = "%s_%d"%(QuerySession.TIQ_HEAD_PREFIX, self.tiq_count)
         tiq_head = Term(tiq_head_functor, *varnames)
-        self.db.add_statement(Clause(tiq_head, qc))
+        self.add_clause(Clause(tiq_head, qc))
 
         return [tiq_head], evidence
 
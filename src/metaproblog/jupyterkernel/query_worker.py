@@ -0,0 +1,219 @@
+import multiprocessing
+import os
+import pickle
+import signal
+import time
+
+from problog.logic import unquote
+
+
+class QueryWorker:
+    """
+    Runs queries in a forked process, with a time and a memory limit on each, so that a query which blows up (e.g. a
+    d-DNNF that explodes) is stopped and reported, rather than taking the kernel and all its theories down with it.
+    The process is forked from the kernel, so it has the program as it was then. It is reused for later queries, also
+    of later cells, until the program changes (see TheoryManager.fingerprint); its caches stay warm in the meantime.
+    A query over a limit gets no results but a resource_exceeded dict, e.g. {"resource_exceeded": "timeout", "limit": 30,
+    "seconds": 30.1}, and the process is replaced. The memory limit is on how much the resident memory of the process,
+    and of any compiler it runs (e.g. dsharp), grows while the query runs. It is checked every POLL_SECONDS, from /proc
+    (the process and its descendants); where there is none (i.e. not on linux), memory is not limited. An address space rlimit would not do: dsharp alone
+    reserves more than a GB of it when it starts.
+    """
+
+    POLL_SECONDS = 0.1 # Waits are cut into pieces this long, so an interrupt gets through (see CellExecution), and memory is checked
+    SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+    def __init__(self, pbl):
+        self.pbl = pbl # The ProblogWrapper the process is forked from
+        self.started = 0 # Processes forked so far
+        self._process = None
+        self._connection = None
+        self._fingerprint = None # Of the theories the process was forked with
+
+    """ Evaluates a query of query_type (with the kwargs of QueryFactory.create_query) in the process, within timeout
+        seconds and max_memory bytes (None: no limit): (results, None), or (None, resource_exceeded dict).
+        clauses: those the queries need which are not in the program, e.g. of transformed inline queries.
+        Errors of the query are raised here. """
+    def run(self, query_type, kwargs, queries, evidence, clauses=(), timeout=None, max_memory=None):
+        self._ensure_started()
+        start = time.time()
+        try:
+            memory_limit = None
+            if max_memory is not None:
+                baseline = self._group_memory()
+                memory_limit = None if baseline is None else baseline + max_memory
+            self._connection.send((query_type, kwargs, queries, evidence, list(clauses), self.pbl.compile_workers))
+            state = self._wait(timeout, memory_limit)
+            if state != "ready":
+                self.stop()
+                return None, {"resource_exceeded": state, "limit": timeout if state == "timeout" else max_memory, "seconds": time.time() - start}
+            try:
+                status, value = self._connection.recv()
+            except EOFError: # Killed; with a memory limit, most likely for going over it (e.g. by the OOM killer)
+                exit_code = self.stop()
+                if max_memory is None:
+                    raise RuntimeError("The query worker died (exit code %s)"%exit_code)
+                return None, {"resource_exceeded": "memory", "limit": max_memory, "seconds": time.time() - start, "exit_code": exit_code}
+        except BaseException:
+            self.stop()
+            raise
+
+        if status == "ok":
+            return value, None
+        elif status == "memory": # A MemoryError in the process itself
+            self.stop()
+            return None, {"resource_exceeded": "memory", "limit": max_memory, "seconds": time.time() - start}
+        raise value
+
+    """ Kills the process, if there is one. Returns its exit code. """
+    def stop(self):
+        process, connection = self._process, self._connection
+        self._process = self._connection = None
+        if process is None:
+            return None
+        try:
+            os.killpg(process.pid, signal.SIGKILL) # It leads its own process group, with any compiler it started
+        except (ProcessLookupError, PermissionError):
+            pass
+        process.join()
+        connection.close()
+        return process.exitcode
+
+    def _ensure_started(self):
+        fingerprint = self.pbl.theory_manager.fingerprint()
+        if self._process is not None and (fingerprint != self._fingerprint or not self._process.is_alive()):
+            self.stop()
+        if self._process is None:
+            context = multiprocessing.get_context("fork")
+            self._connection, child_connection = context.Pipe()
+            self._process = context.Process(target=_query_worker, args=(self.pbl, child_connection), daemon=True)
+            self._process.start()
+            try:
+                os.setpgid(self._process.pid, self._process.pid) # Also done by the worker; whichever comes first
+            except (ProcessLookupError, PermissionError):
+                pass
+            child_connection.close()
+            self._fingerprint = fingerprint
+            self.started += 1
+
+    """ "ready" once the process answered (or died), "timeout" or "memory" if it went over a limit first """
+    def _wait(self, timeout, memory_limit=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = QueryWorker.POLL_SECONDS if deadline is None else min(QueryWorker.POLL_SECONDS, deadline - time.time())
+            if self._connection.poll(max(remaining, 0)):
+                return "ready"
+            if deadline is not None and time.time() >= deadline:
+                return "timeout"
+            if not self._process.is_alive() and not self._connection.poll(0): # It died; recv will say so
+                return "ready"
+            if memory_limit is not None and (self._group_memory() or 0) > memory_limit:
+                return "memory"
+
+    """ Resident bytes of the process and its descendants (e.g. a compiler it runs), or None without /proc """
+    def _group_memory(self):
+        page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        pids = QueryWorker._descendants(self._process.pid)
+        if pids is None:
+            return None
+        total = 0
+        for pid in pids:
+            try:
+                with open("/proc/%d/statm"%pid) as statm_file:
+                    total += int(statm_file.read().split()[1]) * page_size
+            except (OSError, ValueError, IndexError): # Gone in the meantime
+                continue
+        return total
+
+    """ pid and the pids of its descendants, from the children files of their threads in /proc, or None if there are none.
+        Without those (a kernel built without them), the processes in pid's process group, which is led by pid. """
+    @staticmethod
+    def _descendants(pid):
+        if not os.path.exists("/proc/%d/task/%d/children"%(pid, pid)):
+            return QueryWorker._process_group(pid) if os.path.isdir("/proc") else None
+        found = [pid]
+        pending = [pid]
+        while pending:
+            parent = pending.pop()
+            try:
+                tasks = os.listdir("/proc/%d/task"%parent)
+            except OSError: # Gone in the meantime
+                continue
+            for task in tasks:
+                try:
+                    with open("/proc/%d/task/%s/children"%(parent, task)) as children_file:
+                        children = [int(child) for child in children_file.read().split()]
+                except (OSError, ValueError):
+                    continue
+                found.extend(children)
+                pending.extend(children)
+        return found
+
+    @staticmethod
+    def _process_group(pgrp):
+        pids = []
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open("/proc/%s/stat"%entry) as stat_file:
+                    stat = stat_file.read()
+                if int(stat[stat.rindex(")") + 2:].split()[2]) == pgrp: # state, ppid, pgrp, ...
+                    pids.append(int(entry))
+            except (OSError, ValueError, IndexError):
+                continue
+        return pids
+
+    """ Seconds from an option value: a number, or none """
+    @staticmethod
+    def parse_seconds(value):
+        if value is None or str(value) == "none":
+            return None
+        return float(unquote(str(value)))
+
+    """ Bytes from an option value: a number of megabytes, a quoted size like '4G' or '512M', or none """
+    @staticmethod
+    def parse_size(value):
+        if value is None or str(value) == "none":
+            return None
+        text = unquote(str(value)).strip().upper()
+        if text.endswith("B"):
+            text = text[:-1]
+        if text and text[-1] in QueryWorker.SIZE_UNITS:
+            return int(float(text[:-1]) * QueryWorker.SIZE_UNITS[text[-1]])
+        return int(float(text) * QueryWorker.SIZE_UNITS["M"])
+
+
+def _query_worker(pbl, connection):
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Interrupts are for the kernel, which then kills us
+    pbl.query_worker = None # Queries are evaluated right here
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        query_type, kwargs, queries, evidence, clauses, compile_workers = request
+        pbl.compile_workers = compile_workers
+        try:
+            qs = pbl.create_query_session()
+            for clause in clauses:
+                qs.add_clause(clause)
+            qs.prepare_typed_query(query_type, kwargs, queries, evidence)
+            reply = ("ok", qs.evaluate_queries()[0])
+            qs.close()
+        except MemoryError:
+            reply = ("memory", None)
+        except Exception as e:
+            try:
+                pickle.loads(pickle.dumps(e)) # Some (e.g. problog's UnknownClause) cannot be made again from their pickle
+                reply = ("error", e)
+            except Exception:
+                reply = ("error", RuntimeError("%s: %s"%(type(e).__name__, e)))
+        try:
+            connection.send(reply)
+        except Exception as e: # e.g. results which cannot be pickled
+            connection.send(("error", RuntimeError(str(e))))
+        if reply[0] == "memory": # What it was doing may have been left half done
+            break
+    connection.close()
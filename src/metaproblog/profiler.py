@@ -0,0 +1,150 @@
+import json
+import time
+import tracemalloc
+
+
+class Profiler:
+    """
+    Records wall time, peak memory and size metrics for the phases of a cell (parse, prepare, ground, compile, evaluate, ...).
+    There is at most one active profiler. Code reports through the static phase/annotate, which do nothing when none is active,
+        so instrumented code pays nothing unless profiling is switched on.
+    Peak memory comes from tracemalloc, which only traces while a profiler is active: it is the most that was allocated
+        on top of what was live when the phase started, including nested phases. Before Python 3.9 tracemalloc cannot
+        reset its peak, so there it is the most since tracing started, an upper bound.
+    """
+    _static_instance = None
+
+    def __init__(self, trace_memory=True):
+        self.entries = [] # One dict per finished phase, in the order they started
+        self.trace_memory = trace_memory
+        self._stack = [] # Open phases: (entry, start time, traced memory at start, peak of finished children)
+        self._started_tracing = False
+
+    @staticmethod
+    def start(trace_memory=True):
+        if Profiler._static_instance is None:
+            profiler = Profiler(trace_memory)
+            if trace_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                profiler._started_tracing = True
+            Profiler._static_instance = profiler
+        return Profiler._static_instance
+
+    """ Deactivates and returns the active profiler, or None """
+    @staticmethod
+    def stop():
+        profiler = Profiler._static_instance
+        Profiler._static_instance = None
+        if profiler is not None and profiler._started_tracing:
+            tracemalloc.stop()
+        return profiler
+
+    @staticmethod
+    def active():
+        return Profiler._static_instance
+
+    """ Context manager timing a phase. query is any object identifying the query, labelled when exporting. """
+    @staticmethod
+    def phase(name, query=None, **metrics):
+        profiler = Profiler._static_instance
+        if profiler is None:
+            return Profiler._NullPhase()
+        return Profiler._Phase(profiler, name, query, metrics)
+
+    """ Adds metrics to the innermost open phase """
+    @staticmethod
+    def annotate(**metrics):
+        profiler = Profiler._static_instance
+        if profiler is not None and profiler._stack:
+            profiler._stack[-1][0].update(metrics)
+
+    """ Node and atom counts of a formula or circuit, for annotate """
+    @staticmethod
+    def formula_size(formula, prefix):
+        metrics = {}
+        try:
+            metrics[prefix + "_nodes"] = len(formula)
+        except TypeError:
+            pass
+        atomcount = getattr(formula, "atomcount", None)
+        if atomcount is not None:
+            metrics[prefix + "_atoms"] = atomcount
+        return metrics
+
+    class _NullPhase:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    class _Phase:
+        def __init__(self, profiler, name, query, metrics):
+            self.profiler = profiler
+            if query is None and profiler._stack: # Nested phases belong to the enclosing query
+                query = profiler._stack[-1][0]["query"]
+            self.entry = {"phase": name, "query": query, "depth": len(profiler._stack)}
+            self.entry.update(metrics)
+
+        def __enter__(self):
+            profiler = self.profiler
+            profiler.entries.append(self.entry)
+            tracing = profiler.trace_memory and tracemalloc.is_tracing()
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                if profiler._stack: # Keep what the parent saw so far; resetting the peak loses it
+                    profiler._stack[-1][3] = max(profiler._stack[-1][3], peak)
+                if hasattr(tracemalloc, "reset_peak"): # Python >= 3.9
+                    tracemalloc.reset_peak()
+            else:
+                current = 0
+            profiler._stack.append([self.entry, time.perf_counter(), current, 0])
+            return self
+
+        def __exit__(self, exc_type, *exc):
+            profiler = self.profiler
+            entry, start, start_memory, child_peak = profiler._stack.pop()
+            entry["wall_s"] = time.perf_counter() - start
+            if profiler.trace_memory and tracemalloc.is_tracing():
+                peak = max(tracemalloc.get_traced_memory()[1], child_peak)
+                entry["peak_mem_bytes"] = max(0, peak - start_memory)
+                if profiler._stack:
+                    profiler._stack[-1][3] = max(profiler._stack[-1][3], peak)
+            if exc_type is not None:
+                entry["error"] = exc_type.__name__
+            return False
+
+    """ The entries with query replaced by label(query) (default: str), ready for json """
+    def export(self, label=None):
+        if label is None:
+            label = str
+        rows = []
+        for entry in self.entries:
+            row = dict(entry)
+            row["query"] = None if entry["query"] is None else label(entry["query"])
+            rows.append(row)
+        return rows
+
+    def to_json(self, label=None, **extra):
+        record = {"timestamp": time.time(), "phases": self.export(label)}
+        record.update(extra)
+        return json.dumps(record, default=str)
+
+
+def _run_tests():
+    Profiler.start()
+    with Profiler.phase("outer", query="q1"):
+        data = [0] * 100000
+        with Profiler.phase("inner", query="q1"):
+            more = [1] * 500000
+            Profiler.annotate(n=len(more))
+        del more
+    profiler = Profiler.stop()
+    for row in profiler.export():
+        print(row)
+    with Profiler.phase("ignored"):
+        pass
+    print(profiler.to_json())
+
+if __name__ == "__main__":
+    _run_tests()
@@ -4,6 +4,10 @@ from problog.formula import LogicFormula
 
 from problog.ddnnf_formula import DDNNF
 
+from .batched_evaluator import BatchedEvaluator
+from .formula_wrapper import FormulaWrapper
+from metaproblog.profiler import Profiler
+
 class AMCQuery:
 
     def __init__(self, queries, evidence, formula_wrapper, target_class=DDNNF, semiring=None):
@@ -17,19 +21,29 @@ class AMCQuery:
         self.result = None        
 
     def ground(self, engine):
+        share_key = ("amc", tuple(str(q) for q in self.queries), FormulaWrapper.evidence_key(self.evidence))
+        version = self.formula_wrapper.shared_version(share_key)
+        if version is not None: # Asked before in this session: use those labels (and so that circuit) instead
+            self.formula_version = version
+            return
+
         self.formula_version = self.formula_wrapper.next_version()
         labels = ((self.formula_version, LogicFormula.LABEL_QUERY), (self.formula_version, LogicFormula.LABEL_EVIDENCE_NEG),(self.formula_version, LogicFormula.LABEL_EVIDENCE_POS))
 
-        return AMCQuery.ground_query_evidence(
-            engine, self.formula_wrapper.db, 
-            self.queries, self.evidence,
-            self.formula_wrapper.lf, labels)
+        db = self.formula_wrapper.db
+        queries, evidence = self.queries, self.evidence
+        self.formula_wrapper.ground(
+            ("amc", labels, queries, evidence),
+            lambda target_lf: AMCQuery.ground_query_evidence(engine, db, queries, evidence, target_lf, labels),
+            list(queries) + [eterm for eterm, _ in evidence],
+            evidence_key=FormulaWrapper.evidence_key(evidence), share_key=share_key, target_class=self.target_class)
 
     def evaluate(self, _engine):
         labels = ((self.formula_version, LogicFormula.LABEL_QUERY), (self.formula_version, LogicFormula.LABEL_EVIDENCE_NEG),(self.formula_version, LogicFormula.LABEL_EVIDENCE_POS))
-        circuit = self.formula_wrapper.compile_to(self.target_class)
+        circuit = self.formula_wrapper.compile_to(self.target_class, self.formula_version)
 
-        self.results = AMCQuery.evaluate_circuit(circuit, labels, semiring=self.semiring)
+        with Profiler.phase("evaluate_circuit"):
+            self.results = AMCQuery.evaluate_circuit(circuit, labels, semiring=self.semiring)
         return self.results
 
     @staticmethod
@@ -68,8 +82,11 @@ class AMCQuery:
         q_nodes = circuit.get_names( q_label )
 
         qresult = []
-        for name,q in q_nodes:
-            qresult.append( (name, circuit.evaluate(q, evidence=ev_nodes, semiring=semiring)) )
+        if q_nodes:
+            # Condition on the evidence once, then evaluate all queries together
+            evaluator = circuit.get_evaluator(semiring=semiring, evidence=ev_nodes)
+            values = BatchedEvaluator.evaluate_all(evaluator, [q for _name, q in q_nodes])
+            qresult = [(name, value) for (name, _q), value in zip(q_nodes, values)]
         
         return qresult, ev_nodes
 
@@ -111,7 +128,6 @@ def run_test_with_query_instance():
     0.4::heads(C); 0.6::tails(C) :- coin(C).
     win :- heads(C).
     """)
-    from .formula_wrapper import FormulaWrapper
             
     s_qs, s_evs = ([Term("win")], [(Term("heads", Term("c1")), False)]) # For now
     
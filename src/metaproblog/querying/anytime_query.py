@@ -0,0 +1,226 @@
+from sys import stderr as sys_stderr
+import heapq
+import time
+
+from problog.errors import InconsistentEvidenceError
+
+from metaproblog.querying.query_base import QueryBase
+from metaproblog.querying.ground_program import GroundProgram
+
+
+class AnytimeQuery(QueryBase):
+    """
+    Anytime bounds on P(query | evidence), without compiling.
+    Best-first Shannon expansion over the choices of the ground program (see GroundProgram): a partial assignment whose
+        three-valued evaluation decides the query and the evidence is a closed leaf, anything else is split on a choice below
+        an undecided node. With a = P(q, e) and b = P(not q, e) proven so far and m the mass of the open assignments,
+        P(q | e) lies in [a / (a + b + m), (a + m) / (a + m + b)]. The bounds close as m goes to 0.
+    Stops at the first of: exact, upper - lower <= epsilon, timeout seconds (shared by the ground queries), nodes expansions per query.
+    progress_callback(query) is called at most every progress_interval seconds while running, and once at the end.
+    results is ([(query, (lower, upper))], evidence_dict).
+    ProbLog's own bounds (kbest, fsdd) run here too, but kbest ignores evidence, fsdd does not bound P(q | e) under it,
+        and both stop on a SIGALRM, which only the main thread can receive.
+    """
+
+    def __init__(self, queries, evidence, formula_wrapper, timeout=10.0, nodes=None, epsilon=0.0, progress_interval=0.5):
+        super().__init__(queries, evidence, formula_wrapper)
+        self.timeout = timeout
+        self.max_nodes = nodes
+        self.epsilon = epsilon
+        self.progress_interval = progress_interval
+        self.progress_callback = None
+
+        self.program = None
+        self.results = None
+        self.progress = {"expanded": 0, "elapsed": 0.0, "done": False}
+
+    def ground(self, engine):
+        self.program = GroundProgram.ground(engine, self.formula_wrapper.db, self.queries, self.evidence)
+
+    def evaluate(self, _engine):
+        q_nodes = self.program.queries
+        bounds = [(0.0, 1.0)] * len(q_nodes)
+        self.results = ([(name, b) for (name, _), b in zip(q_nodes, bounds)], dict(self.program.evidence_names))
+
+        start = time.time()
+        deadline = None if self.timeout is None else start + float(self.timeout)
+        last_report = [start]
+
+        def _report(force=False):
+            now = time.time()
+            if self.progress_callback is not None and (force or now - last_report[0] >= self.progress_interval):
+                last_report[0] = now
+                self.progress["elapsed"] = now - start
+                self.results = ([(name, b) for (name, _), b in zip(q_nodes, bounds)], self.results[1])
+                self.progress_callback(self)
+
+        try:
+            for i, (_name, lit) in enumerate(q_nodes):
+                # Time left is split evenly over the queries left, so a query that closes early leaves its time to the others
+                query_deadline = None if deadline is None else time.time() + (deadline - time.time()) / (len(q_nodes) - i)
+                for lower, upper in self.bound(lit, query_deadline):
+                    bounds[i] = (lower, upper)
+                    _report()
+        except KeyboardInterrupt:
+            print("Anytime bounds interrupted", file=sys_stderr)
+
+        self.progress["done"] = True
+        self.results = ([(name, b) for (name, _), b in zip(q_nodes, bounds)], self.results[1])
+        _report(force=True)
+        return self.results
+
+    """ Generates successively tighter (lower, upper) bounds on P(lit | evidence) """
+    def bound(self, lit, deadline=None):
+        program = self.program
+        n_vars = len(program.variables)
+
+        root = [None] * n_vars
+        for var in range(n_vars):
+            if program.clamped_value[var] is not None:
+                root[var] = program.clamped_value[var]
+
+        a = b = 0.0
+        open_mass = 1.0
+        counter = 0 # Tie breaker, so the heap never compares assignments
+        heap = [(-1.0, counter, root)]
+        expanded = 0
+
+        def _bounds():
+            m = max(open_mass, 0.0)
+            lower = a / (a + b + m) if a + b + m > 0 else 0.0
+            upper = (a + m) / (a + m + b) if a + m + b > 0 else 1.0
+            return lower, upper
+
+        while heap:
+            neg_mass, _c, assignment = heapq.heappop(heap)
+            mass = -neg_mass
+            open_mass -= mass
+            value = AnytimeQuery._evaluate(program, assignment)
+            evidence_value = AnytimeQuery._evidence_value(program, value)
+            query_value = AnytimeQuery._literal_value(value, lit)
+
+            if evidence_value is False:
+                pass # Outside the evidence: counts for neither bound
+            elif evidence_value is True and query_value is not None:
+                if query_value:
+                    a += mass
+                else:
+                    b += mass
+            else:
+                undecided = lit if query_value is None else \
+                    next(i for i, required in program.evidence.items() if value[i] is None)
+                var = AnytimeQuery._branch_variable(program, value, abs(undecided))
+                for k, w in program.candidates(var):
+                    child = list(assignment)
+                    child[var] = k
+                    counter += 1
+                    heapq.heappush(heap, (-mass * w, counter, child))
+                    open_mass += mass * w
+
+            expanded += 1
+            self.progress["expanded"] += 1
+            lower, upper = _bounds()
+            yield lower, upper
+            if upper - lower <= self.epsilon:
+                break
+            if self.max_nodes is not None and expanded >= self.max_nodes:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+
+        if not heap and a + b == 0:
+            raise InconsistentEvidenceError(context=" (no assignment satisfies the evidence)")
+
+    """ Three-valued (True, False, None for undecided) value of every node under a partial assignment """
+    @staticmethod
+    def _evaluate(program, assignment):
+        value = [None] * (program.n + 1)
+        for var, k in enumerate(assignment):
+            if k is None:
+                continue
+            atoms, _probs, _none_prob, none_atom = program.variables[var]
+            for m, atom in enumerate(atoms):
+                value[atom] = (m == k)
+            if none_atom is not None:
+                value[none_atom] = (k == -1)
+        for i in program.order:
+            kind = program.kinds[i]
+            if kind == "conj":
+                result = True
+                for c in program.children[i]:
+                    v = AnytimeQuery._literal_value(value, c)
+                    if v is False:
+                        result = False
+                        break
+                    elif v is None:
+                        result = None
+                value[i] = result
+            elif kind == "disj":
+                result = False
+                for c in program.children[i]:
+                    v = AnytimeQuery._literal_value(value, c)
+                    if v is True:
+                        result = True
+                        break
+                    elif v is None:
+                        result = None
+                value[i] = result
+        return value
+
+    @staticmethod
+    def _literal_value(value, lit):
+        if lit == 0:
+            return True
+        elif lit is None:
+            return False
+        v = value[abs(lit)]
+        return v if (v is None or lit > 0) else not v
+
+    @staticmethod
+    def _evidence_value(program, value):
+        result = True
+        for i, required in program.evidence.items():
+            if value[i] is None:
+                result = None
+            elif value[i] != required:
+                return False
+        return result
+
+    """ An unassigned choice below the undecided node, found by following undecided children """
+    @staticmethod
+    def _branch_variable(program, value, node):
+        while program.kinds[node] != "atom":
+            node = next(abs(c) for c in program.children[node] if AnytimeQuery._literal_value(value, c) is None)
+        return program.var_of_atom[node]
+
+
+# Devtime testing
+def _run_tests():
+    from problog.program import PrologString
+    from problog.engine import DefaultEngine
+    from problog.logic import Term, Constant
+    from .formula_wrapper import FormulaWrapper
+    p = PrologString("""
+    0.01::burglary. 0.02::earthquake.
+    0.9::alarm :- burglary. 0.4::alarm :- earthquake.
+    0.3::a; 0.5::b.
+    c :- a. c :- \\+a, b.
+    0.5::edge(1,2). 0.5::edge(2,3). 0.5::edge(1,3). 0.5::edge(3,4). 0.5::edge(2,4).
+    path(X,Y) :- edge(X,Y).
+    path(X,Y) :- edge(X,Z), path(Z,Y).
+    """)
+    engine = DefaultEngine()
+    fw = FormulaWrapper(engine.prepare(p))
+    tasks = [
+        ([Term("burglary"), Term("a")], [(Term("alarm"), True)]), # exact: 0.532, 0.3
+        ([Term("a")], [(Term("c"), True)]), # exact: 0.375
+        ([Term("path", Constant(1), Constant(4))], []), # exact: 0.46875
+    ]
+    for queries, evidence in tasks:
+        for nodes in [2, 10, None]:
+            qobj = AnytimeQuery(queries, evidence, fw, timeout=5, nodes=nodes)
+            qobj.ground(engine)
+            print(nodes, qobj.evaluate(engine), qobj.progress)
+
+if __name__ == "__main__":
+    _run_tests()
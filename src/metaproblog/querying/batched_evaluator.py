@@ -0,0 +1,128 @@
+from problog.evaluator import SemiringProbability
+from problog.constraint import ConstraintAD
+from problog.ddnnf_formula import SimpleDDNNFEvaluator
+
+class BatchedEvaluator:
+    """
+    Evaluates many query nodes against one evaluator, which has already been conditioned on the evidence.
+    For d-DNNFs under the probability semiring, all marginals come from one bottom-up and one top-down
+        (derivative) pass, instead of one pass over the whole circuit per query.
+    The root weight R is multilinear in the literal weights, so R = A*w_pos + B*w_neg + C for every atom,
+        with A, B the derivatives. Fixing the atom to true gives A*w_pos + C = R - B*w_neg (similarly for false).
+    Anything else falls back to evaluator.evaluate per node, which still conditions on the evidence only once.
+    """
+
+    @staticmethod
+    def evaluate_all(evaluator, nodes):
+        if BatchedEvaluator._supports(evaluator):
+            values = BatchedEvaluator._evaluate_ddnnf(evaluator, nodes)
+            if values is not None:
+                return values
+        return [evaluator.evaluate(node) for node in nodes]
+
+    @staticmethod
+    def _supports(evaluator):
+        return type(evaluator) is SimpleDDNNFEvaluator and type(evaluator.semiring) is SemiringProbability
+
+    """ Returns None if the circuit has a shape we don't handle, so the caller can fall back """
+    @staticmethod
+    def _evaluate_ddnnf(evaluator, nodes):
+        formula = evaluator.formula
+        semiring = evaluator.semiring
+        weights = evaluator.weights
+        n = len(formula)
+        if n == 0: # Every query is a constant
+            return None
+
+        def _literal_weight(lit):
+            w = weights.get(abs(lit))
+            return semiring.one() if w is None else w[lit < 0]
+
+        # Bottom-up: values of the positive internal nodes. Atoms are read off weights.
+        kinds = [None] * (n + 1)
+        children = [None] * (n + 1)
+        value = [None] * (n + 1)
+        for i in range(1, n + 1):
+            node = formula.get_node(i)
+            kind = type(node).__name__
+            kinds[i] = kind
+            if kind == "atom":
+                continue
+            elif kind not in ("conj", "disj"):
+                return None
+            child_values = []
+            for c in node.children:
+                if c == 0 or c is None or abs(c) >= i:
+                    return None # Constants and non-topological children are left to the evaluator
+                if kinds[abs(c)] == "atom":
+                    child_values.append(_literal_weight(c))
+                elif c < 0:
+                    return None
+                else:
+                    child_values.append(value[c][0])
+            children[i] = node.children
+            if kind == "conj":
+                v = semiring.one()
+                for cv in child_values:
+                    v = semiring.times(v, cv)
+            else:
+                v = semiring.zero()
+                for cv in child_values:
+                    v = semiring.plus(v, cv)
+            value[i] = (v, child_values)
+
+        def _node_value(i):
+            return _literal_weight(i) if kinds[i] == "atom" else value[i][0]
+
+        root_factor = weights[0][0] if weights.get(0) is not None else semiring.one()
+        root = semiring.times(_node_value(n), root_factor)
+
+        # Top-down: derivative of the root weight with respect to every node and literal.
+        derivative = [semiring.zero()] * (n + 1)
+        literal_derivative = {} # signed atom index -> derivative
+        derivative[n] = root_factor
+        if kinds[n] == "atom":
+            literal_derivative[n] = root_factor
+        for i in range(n, 0, -1):
+            d = derivative[i]
+            if kinds[i] == "atom" or semiring.is_zero(d):
+                continue
+            _v, child_values = value[i]
+            if kinds[i] == "conj":
+                # Product of the siblings, without division (values can be zero)
+                prefix = [semiring.one()]
+                for cv in child_values[:-1]:
+                    prefix.append(semiring.times(prefix[-1], cv))
+                suffix = semiring.one()
+                child_derivatives = [None] * len(child_values)
+                for k in range(len(child_values) - 1, -1, -1):
+                    child_derivatives[k] = semiring.times(d, semiring.times(prefix[k], suffix))
+                    suffix = semiring.times(suffix, child_values[k])
+            else:
+                child_derivatives = [d] * len(child_values)
+
+            for c, cd in zip(children[i], child_derivatives):
+                if kinds[abs(c)] == "atom":
+                    literal_derivative[c] = semiring.plus(literal_derivative.get(c, semiring.zero()), cd)
+                else:
+                    derivative[c] = semiring.plus(derivative[c], cd)
+
+        normalize = evaluator.has_evidence() or semiring.is_nsp() \
+                        or evaluator.has_constraints(ignore_type={ConstraintAD})
+        results = []
+        for node in nodes:
+            if node == 0 or node is None:
+                results.append(evaluator.evaluate(node))
+                continue
+            atom = abs(node)
+            if atom > n or kinds[atom] != "atom":
+                results.append(evaluator.evaluate(node))
+                continue
+            # Fix the atom to the query's sign by removing the models with the opposite literal
+            opposite = -node
+            removed = semiring.times(_literal_weight(opposite), literal_derivative.get(opposite, semiring.zero()))
+            result = min(max(root - removed, semiring.zero()), root)
+            if normalize:
+                result = semiring.normalize(result, root)
+            results.append(semiring.result(result, formula))
+        return results
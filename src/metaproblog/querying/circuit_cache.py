@@ -0,0 +1,170 @@
+from collections import OrderedDict
+
+from .compilation_scheduler import CompilationScheduler
+from metaproblog.interrupt_guard import InterruptGuard
+
+class CircuitCache:
+    """
+    LRU cache of ground LogicFormulas and their compiled circuits, shared across QuerySessions.
+    Keys are fingerprints computed by FormulaWrapper from the program and everything grounded into it.
+    Sizes are estimated from node counts, so max_bytes is a budget rather than an exact limit.
+    With a DiskCache attached, misses are looked up on disk and compiled circuits (and plans) are written through to it.
+    Updates of the entries and their size run in InterruptGuard.deferred sections, so an interrupt cannot split them.
+    """
+
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+    MAX_PLANS = 4096 # How the steps of a formula split into partitions; small, so only their number is bounded
+    BYTES_PER_NODE = 256 # Rough footprint of a formula node with its names, weights and index entries
+
+    class Entry:
+        def __init__(self, lf, theories, predicates):
+            self.lf = lf
+            self.theories = frozenset(theories) # TheoryKeys the formula was grounded from
+            self.predicates = predicates # Predicate names it depends on. None if it could be anything.
+            self.circuits = {} # target_class -> circuit
+            self.size = CircuitCache.estimate_size(lf)
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> Entry, least recently used first
+        self._size = 0
+        self._plans = OrderedDict() # fingerprint of steps -> their partitioning, see FormulaWrapper.components
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk = None
+
+    """ disk: a DiskCache, or None to only cache in memory """
+    def attach_disk(self, disk):
+        self.disk = disk
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._load_from_disk(key)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, lf, theories, predicates=None):
+        entry = CircuitCache.Entry(lf, theories, predicates)
+        with InterruptGuard.deferred():
+            self.remove(key)
+            self._entries[key] = entry
+            self._size += entry.size
+            self._evict()
+        return entry
+
+    def add_circuit(self, key, target_class, circuit):
+        entry = self._entries.get(key)
+        if entry is not None:
+            size = CircuitCache.estimate_size(circuit)
+            with InterruptGuard.deferred():
+                entry.circuits[target_class] = circuit
+                entry.size += size
+                self._size += size
+                self._evict()
+            if self.disk is not None: # Interruptible; the disk cache cleans up after itself
+                circuits = {circuit_class: circuit for circuit_class, circuit in entry.circuits.items() if CompilationScheduler.round_trips(circuit_class)}
+                self.disk.store_entry(key, entry.lf, entry.theories, entry.predicates, circuits)
+
+    """ Plans are keyed by fingerprints which cover the theories they were made from, so they never go stale; they only age out """
+    def get_plan(self, key):
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+        elif self.disk is not None:
+            plan = self.disk.load_plan(key)
+            if plan is not None:
+                self._remember_plan(key, plan)
+        return plan
+
+    def put_plan(self, key, plan):
+        self._remember_plan(key, plan)
+        if self.disk is not None:
+            self.disk.store_plan(key, plan)
+
+    def _remember_plan(self, key, plan):
+        with InterruptGuard.deferred():
+            self._plans[key] = plan
+            self._plans.move_to_end(key)
+            while len(self._plans) > CircuitCache.MAX_PLANS:
+                self._plans.popitem(last=False)
+
+    def _load_from_disk(self, key):
+        if self.disk is None:
+            return None
+        stored = self.disk.load_entry(key)
+        if stored is None:
+            return None
+        lf, theories, predicates, circuits = stored
+        entry = CircuitCache.Entry(lf, theories, predicates)
+        for circuit in circuits.values():
+            entry.size += CircuitCache.estimate_size(circuit)
+        entry.circuits.update(circuits)
+        with InterruptGuard.deferred():
+            self._entries[key] = entry
+            self._size += entry.size
+            self._evict()
+        return entry
+
+    def remove(self, key):
+        with InterruptGuard.deferred():
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry.size
+        return entry
+
+    """ Drops the entries affected by a change to the given theory, which defines the given predicates (None: anything).
+        Call this whenever a theory is added or removed. """
+    def invalidate_theory(self, theory_key, predicates=None):
+        def _affected(entry):
+            if theory_key in entry.theories or predicates is None or entry.predicates is None:
+                return True
+            return not entry.predicates.isdisjoint(predicates)
+
+        stale = [key for key, entry in self._entries.items() if _affected(entry)]
+        for key in stale:
+            self.remove(key)
+        return len(stale)
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        with InterruptGuard.deferred():
+            self._evict()
+
+    def clear(self):
+        with InterruptGuard.deferred():
+            self._entries.clear()
+            self._plans.clear()
+            self._size = 0
+
+    def stats(self):
+        stats = {
+            "entries": len(self._entries),
+            "size_bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+    """ Only call this in an InterruptGuard.deferred section """
+    def _evict(self):
+        # The newest entry stays even if it is over budget on its own; the caller is using it.
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+            self.evictions += 1
+
+    @staticmethod
+    def estimate_size(formula):
+        try:
+            return len(formula) * CircuitCache.BYTES_PER_NODE
+        except TypeError: # e.g. circuits which are not LogicFormulas
+            return CircuitCache.BYTES_PER_NODE
@@ -0,0 +1,183 @@
+from multiprocessing.connection import wait
+import multiprocessing
+import os
+import pickle
+import signal
+import time
+
+from problog.formula import LogicFormula
+
+
+class CompilationScheduler:
+    """
+    Compiles independent formulas (e.g. the partitions of a FormulaWrapper) into circuits, in parallel.
+    Each formula big enough to be worth it is compiled in a forked process of its own, with at most workers of them running;
+    the largest start first, so that a big one does not end up running alone at the end. Smaller ones are compiled here
+    in the meantime. An interrupt (or any error) kills the workers, and any compiler they started, before it is raised.
+    """
+
+    MIN_FORK_NODES = 50 # Formulas smaller than this compile faster than a process starts and sends back the circuit
+    POLL_SECONDS = 0.1 # Waits on workers are cut into pieces this long, so an interrupt raised in this thread gets through
+    _round_trips = {} # target_class -> whether its circuits survive pickling, i.e. can be sent back by a worker
+
+    """ Circuits for the formulas, in the same order. target_class is one class for all, or a list with one per formula.
+        timed: (circuit, seconds) instead """
+    @staticmethod
+    def compile_all(formulas, target_class, workers=1, timed=False):
+        target_classes = target_class if isinstance(target_class, (list, tuple)) else [target_class] * len(formulas)
+        if workers == "auto":
+            workers = os.cpu_count() or 1
+        if workers <= 1 or len(formulas) < 2 or not CompilationScheduler.can_fork():
+            return CompilationScheduler._compile_here(formulas, target_classes, range(len(formulas)), timed)
+
+        order = sorted(range(len(formulas)), key=lambda i: CompilationScheduler.size(formulas[i]), reverse=True)
+        forkable = [i for i in order if CompilationScheduler.size(formulas[i]) >= CompilationScheduler.MIN_FORK_NODES
+                        and CompilationScheduler.round_trips(target_classes[i])]
+        local = [i for i in order if i not in forkable]
+        if len(forkable) < 2: # Nothing to overlap
+            return CompilationScheduler._compile_here(formulas, target_classes, range(len(formulas)), timed)
+
+        context = multiprocessing.get_context("fork")
+        results = [None] * len(formulas)
+        running = {} # connection -> (process, index)
+        try:
+            while forkable or local or running:
+                while forkable and len(running) < workers:
+                    index = forkable.pop(0)
+                    receiver, process = CompilationScheduler._start(context, formulas[index], target_classes[index], True)
+                    running[receiver] = (process, index)
+
+                if local: # Keep busy while the workers run, and look in on them after every formula
+                    index = local.pop(0)
+                    results[index] = CompilationScheduler._compile_here(formulas, target_classes, [index], True)[0]
+                    ready = wait(list(running), timeout=0)
+                else:
+                    ready = CompilationScheduler._wait(list(running))
+
+                for receiver in ready:
+                    process, index = running.pop(receiver)
+                    results[index] = CompilationScheduler._receive(receiver, process)
+        except BaseException:
+            CompilationScheduler._kill(running)
+            raise
+        return results if timed else [circuit for circuit, _seconds in results]
+
+    """ Compiles formula in a worker, giving up after seconds: (finished, circuit, seconds taken).
+        The circuit is None if it gave up, or if the circuit cannot be sent back (see round_trips); use this to measure. """
+    @staticmethod
+    def compile_within(formula, target_class, seconds):
+        if not CompilationScheduler.can_fork():
+            raise RuntimeError("Compiling within a time limit needs processes to be forked")
+        start = time.time()
+        running = {}
+        try:
+            receiver, process = CompilationScheduler._start(multiprocessing.get_context("fork"), formula, target_class,
+                                                                CompilationScheduler.round_trips(target_class))
+            running[receiver] = (process, 0)
+            if not CompilationScheduler._wait([receiver], timeout=seconds):
+                CompilationScheduler._kill(running)
+                return False, None, time.time() - start
+            running.pop(receiver)
+            circuit, taken = CompilationScheduler._receive(receiver, process)
+            return True, circuit, taken
+        except BaseException:
+            CompilationScheduler._kill(running)
+            raise
+
+    @staticmethod
+    def can_fork():
+        return "fork" in multiprocessing.get_all_start_methods()
+
+    """ Whether circuits of target_class can be pickled and back (e.g. BDDs cannot), checked once on a tiny formula """
+    @staticmethod
+    def round_trips(target_class):
+        if target_class not in CompilationScheduler._round_trips:
+            lf = LogicFormula()
+            lf.add_name("q", lf.add_atom("q", 0.5), lf.LABEL_QUERY)
+            try:
+                pickle.loads(pickle.dumps(target_class.create_from(lf)))
+                CompilationScheduler._round_trips[target_class] = True
+            except Exception:
+                CompilationScheduler._round_trips[target_class] = False
+        return CompilationScheduler._round_trips[target_class]
+
+    @staticmethod
+    def size(formula):
+        try:
+            return len(formula)
+        except TypeError:
+            return 0
+
+    """ Like multiprocessing.connection.wait, but returning to Python now and then (see CellExecution) """
+    @staticmethod
+    def _wait(connections, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = CompilationScheduler.POLL_SECONDS if deadline is None else min(CompilationScheduler.POLL_SECONDS, deadline - time.time())
+            ready = wait(connections, timeout=max(remaining, 0))
+            if ready or (deadline is not None and time.time() >= deadline):
+                return ready
+
+    @staticmethod
+    def _compile_here(formulas, target_classes, indices, timed):
+        results = []
+        for index in indices:
+            start = time.time()
+            circuit = target_classes[index].create_from(formulas[index])
+            results.append((circuit, time.time() - start))
+        return results if timed else [circuit for circuit, _seconds in results]
+
+    @staticmethod
+    def _start(context, formula, target_class, send_circuit):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_compile_worker, args=(formula, target_class, sender, send_circuit), daemon=True)
+        process.start()
+        try:
+            os.setpgid(process.pid, process.pid) # Also done by the worker; whichever comes first
+        except (ProcessLookupError, PermissionError):
+            pass
+        sender.close()
+        return receiver, process
+
+    """ (circuit, seconds) from a worker """
+    @staticmethod
+    def _receive(receiver, process):
+        try:
+            ok, value, seconds = receiver.recv()
+        except EOFError:
+            raise RuntimeError("A compilation worker died (exit code %s)"%process.exitcode)
+        finally:
+            receiver.close()
+            process.join()
+        if not ok:
+            raise value
+        return value, seconds
+
+    @staticmethod
+    def _kill(running):
+        for receiver, (process, _index) in running.items():
+            try:
+                os.killpg(process.pid, signal.SIGKILL) # The worker leads its own process group, which includes its compiler
+            except (ProcessLookupError, PermissionError):
+                pass
+            process.kill()
+            process.join()
+            receiver.close()
+        running.clear()
+
+
+def _compile_worker(formula, target_class, sender, send_circuit=True):
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Interrupts are for the parent, which then kills us
+    start = time.time()
+    try:
+        circuit = target_class.create_from(formula)
+        result = (True, circuit if send_circuit else None, time.time() - start)
+    except Exception as e:
+        result = (False, e, time.time() - start)
+    try:
+        sender.send(result)
+    except Exception as e: # e.g. an exception which cannot be pickled
+        message = "%s: %s"%(type(result[1]).__name__, result[1]) if not result[0] else str(e)
+        sender.send((False, RuntimeError(message), result[2]))
+    sender.close()
@@ -0,0 +1,233 @@
+from sys import stderr as sys_stderr
+import heapq
+import math
+
+from problog import _evaluatables
+
+from .incremental_dd import IncrementalBDD, IncrementalSDD
+
+from .compilation_scheduler import CompilationScheduler
+
+
+class CompilerSelector:
+    """
+    Picks the knowledge compiler (target class) for each formula when the compiler is 'auto'.
+    No backend is best everywhere: d-DNNF (dsharp/c2d) is the safe default, SDDs and BDDs can be much faster on some
+    formulas and blow up on others (e.g. long chains). So the selector describes each formula by cheap structural
+    features (nodes, atoms, cycles, an upper bound on the treewidth) and learns, per backend, how long similar formulas
+    took to compile, and picks the one with the lowest predicted time.
+    A formula unlike any seen before is raced: each backend gets a short budget in a worker, then a longer one, until one
+    finishes, so a backend that blows up costs about as much as the one that does not. Backends with nothing known
+    near a formula are also tried on the side after it compiled (see trial), for a bounded time.
+    One selector lives as long as the kernel, so it keeps learning across sessions.
+    """
+
+    AUTO = "auto"
+    DEFAULT = "ddnnf"
+    BACKENDS = ("ddnnf", "sdd", "bdd") # Keys of problog._evaluatables
+    INCREMENTAL = {"sdd": IncrementalSDD, "bdd": IncrementalBDD} # Used instead, so later cells can extend the circuits
+
+    NEIGHBOURS = 3 # Observations a prediction is made from
+    RADIUS = 1.0 # Observations further than this (in feature space) say nothing about a formula
+    MAX_OBSERVATIONS = 256 # Per backend; the oldest are dropped
+    STOPPED_FACTOR = 2.0 # A backend stopped after t seconds is expected to need this many times t
+    MIN_RACE_NODES = 50 # Smaller formulas are compiled with the default rather than raced, when nothing is known
+    FIRST_BUDGET = 0.5 # Seconds each backend gets in the first round of a race...
+    BUDGET_GROWTH = 4.0 # ... and this many times more in each next round
+    TRIAL_FACTOR = 2.0 # A trial gets this many times what the chosen backend took...
+    MIN_TRIAL_SECONDS = 0.05 # ... but at least this
+    MAX_WIDTH = 64 # The treewidth estimate stops here
+    MAX_WIDTH_NODES = 20000 # Larger formulas are not eliminated at all; their width counts as MAX_WIDTH
+
+    def __init__(self, backends=BACKENDS):
+        self.backends = [name for name in backends if CompilerSelector.is_available(name)]
+        self._observations = {name: [] for name in self.backends} # name -> [(features, seconds, finished)]
+
+    """ The target class for a compiler name, or AUTO """
+    @staticmethod
+    def target_class(name):
+        name = str(name).lower()
+        if name == CompilerSelector.AUTO:
+            return CompilerSelector.AUTO
+        if name not in CompilerSelector.BACKENDS:
+            raise ValueError("Unknown compiler: %s. Use one of auto, %s"%(name, ", ".join(CompilerSelector.BACKENDS)))
+        if not CompilerSelector.is_available(name):
+            raise ValueError("The %s compiler is not available. Is its library installed?"%name)
+        return CompilerSelector.class_of(name)
+
+    @staticmethod
+    def class_of(name):
+        return CompilerSelector.INCREMENTAL.get(name, _evaluatables[name])
+
+    @staticmethod
+    def is_available(name):
+        is_available = getattr(_evaluatables[name], "is_available", None)
+        return is_available is None or is_available() # DDNNF does not say; it needs c2d or dsharp on the path
+
+    def name_of(self, target_class):
+        for name in self.backends:
+            if CompilerSelector.class_of(name) is target_class:
+                return name
+        return None
+
+    """ Any circuit, of a backend the selector may choose, from a {target_class: circuit} dict (e.g. a cache entry) """
+    def usable_circuit(self, circuits):
+        for target_class, circuit in circuits.items():
+            if self.name_of(target_class) is not None:
+                return circuit
+        return None
+
+    """ (features, target class to compile lf with). The class is None if lf should be raced instead. """
+    def choose(self, lf):
+        features = CompilerSelector.features(lf)
+        predictions = [(self.predict(name, features), name) for name in self.backends]
+        known = [(seconds, name) for seconds, name in predictions if seconds is not None]
+        if known:
+            return features, CompilerSelector.class_of(min(known)[1])
+        if features["nodes"] < CompilerSelector.MIN_RACE_NODES or len(self.backends) < 2 or not CompilationScheduler.can_fork():
+            return features, CompilerSelector.class_of(self._default())
+        return features, None
+
+    """ Compiles lf with whichever backend finishes first, in rounds of growing budgets: (target_class, circuit) """
+    def race(self, lf, features):
+        default = self._default()
+        contenders = [default] + [name for name in self.backends if name != default]
+        budget = CompilerSelector.FIRST_BUDGET
+        error = None
+        while contenders:
+            for name in list(contenders):
+                target_class = CompilerSelector.class_of(name)
+                try:
+                    finished, circuit, seconds = CompilationScheduler.compile_within(lf, target_class, budget)
+                except Exception as e: # This backend cannot handle it
+                    print("Compiling with %s failed: %s"%(name, e), file=sys_stderr)
+                    contenders.remove(name)
+                    error = e
+                    continue
+                self.observe(target_class, features, seconds, finished)
+                if finished:
+                    if circuit is None: # It cannot be sent back from the worker; now we know it is quick, compile it here
+                        circuit = target_class.create_from(lf)
+                    return target_class, circuit
+            budget *= CompilerSelector.BUDGET_GROWTH
+        raise error
+
+    """ A backend worth trying on a formula with these features, which compiled in seconds with chosen_class: (target_class, budget) or None """
+    def trial(self, features, chosen_class, seconds):
+        for name in self.backends:
+            if CompilerSelector.class_of(name) is not chosen_class and self.predict(name, features) is None:
+                return CompilerSelector.class_of(name), max(CompilerSelector.MIN_TRIAL_SECONDS, CompilerSelector.TRIAL_FACTOR * seconds)
+        return None
+
+    """ finished=False: it was stopped after seconds, so that is a lower bound """
+    def observe(self, target_class, features, seconds, finished=True):
+        name = self.name_of(target_class)
+        if name is None:
+            return
+        observations = self._observations[name]
+        observations.append((features, seconds, finished))
+        if len(observations) > CompilerSelector.MAX_OBSERVATIONS:
+            observations.pop(0)
+
+    """ Predicted compile time in seconds, from the nearest observations, or None if there are none near enough """
+    def predict(self, name, features):
+        nearby = []
+        stopped_after = 0.0
+        for observed, seconds, finished in self._observations.get(name, ()):
+            distance = CompilerSelector._distance(features, observed)
+            if distance > CompilerSelector.RADIUS:
+                continue
+            if finished:
+                nearby.append((distance, observed, seconds))
+            else:
+                stopped_after = max(stopped_after, seconds)
+        if not nearby:
+            return stopped_after * CompilerSelector.STOPPED_FACTOR if stopped_after else None
+        nearest = heapq.nsmallest(CompilerSelector.NEIGHBOURS, nearby, key=lambda item: item[0])
+        # Compile time grows at least linearly with the formula, so scale each observation to its size
+        log_seconds = [math.log(max(seconds, 1e-6) * max(features["nodes"], 1) / max(observed["nodes"], 1)) for _d, observed, seconds in nearest]
+        return max(math.exp(sum(log_seconds) / len(log_seconds)), stopped_after)
+
+    def _default(self):
+        return CompilerSelector.DEFAULT if CompilerSelector.DEFAULT in self.backends else self.backends[0]
+
+    def stats(self):
+        return {name: len(observations) for name, observations in self._observations.items()}
+
+    @staticmethod
+    def _distance(a, b):
+        return math.sqrt(
+            (math.log1p(a["nodes"]) - math.log1p(b["nodes"])) ** 2 +
+            (math.log1p(a["atoms"]) - math.log1p(b["atoms"])) ** 2 +
+            (math.log1p(a["cycles"]) - math.log1p(b["cycles"])) ** 2 +
+            ((a["width"] - b["width"]) / 4.0) ** 2
+        )
+
+    """ Cheap structural features of a LogicFormula: nodes, atoms, cycles (back edges) and width (a treewidth upper bound) """
+    @staticmethod
+    def features(lf):
+        children = {}
+        atoms = 0
+        for index, node, nodetype in lf:
+            if nodetype == "atom":
+                atoms += 1
+            else:
+                children[index] = [abs(child) for child in node.children if child]
+        return {
+            "nodes": len(lf),
+            "atoms": atoms,
+            "cycles": CompilerSelector._back_edges(children),
+            "width": CompilerSelector._width(children, len(lf)),
+        }
+
+    @staticmethod
+    def _back_edges(children):
+        count = 0
+        state = {} # node -> 1 on the stack, 2 done
+        for root in children:
+            if root in state:
+                continue
+            state[root] = 1
+            stack = [(root, iter(children[root]))]
+            while stack:
+                node, remaining = stack[-1]
+                child = next(remaining, None)
+                if child is None:
+                    state[node] = 2
+                    stack.pop()
+                elif state.get(child) == 1:
+                    count += 1
+                elif child not in state:
+                    state[child] = 1
+                    stack.append((child, iter(children.get(child, ()))))
+        return count
+
+    """ Min-degree elimination on the formula's graph (each node joined to its children) """
+    @staticmethod
+    def _width(children, size):
+        if size > CompilerSelector.MAX_WIDTH_NODES:
+            return CompilerSelector.MAX_WIDTH
+        graph = {}
+        for node, kids in children.items():
+            for child in kids:
+                if child != node:
+                    graph.setdefault(node, set()).add(child)
+                    graph.setdefault(child, set()).add(node)
+
+        width = 0
+        heap = [(len(neighbours), node) for node, neighbours in graph.items()]
+        heapq.heapify(heap)
+        while heap:
+            degree, node = heapq.heappop(heap)
+            neighbours = graph.get(node)
+            if neighbours is None or degree != len(neighbours): # Eliminated already, or a stale entry
+                continue
+            width = max(width, degree)
+            if width >= CompilerSelector.MAX_WIDTH:
+                return CompilerSelector.MAX_WIDTH
+            del graph[node]
+            for neighbour in neighbours:
+                graph[neighbour].discard(node)
+                graph[neighbour].update(n for n in neighbours if n != neighbour)
+                heapq.heappush(heap, (len(graph[neighbour]), neighbour))
+        return width
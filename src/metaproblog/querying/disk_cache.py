@@ -0,0 +1,161 @@
+from sys import stderr as sys_stderr
+import mmap
+import os
+import pickle
+import tempfile
+
+import problog
+
+
+class DiskCache:
+    """
+    Second level of the CircuitCache: ground formulas with their circuits, and partition plans, in files under a directory,
+    so they survive restarting the kernel. Keys are the fingerprints FormulaWrapper computes (content hashes of the program
+    it depends on, the queries and the evidence), so entries never go stale; the least recently used are removed once
+    the files take more than max_bytes.
+    Files are pickles (highest protocol), read through mmap. Only point it at a directory you trust: loading runs pickle.
+    """
+
+    FORMAT_VERSION = 1
+    DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+    SUFFIX = ".pblc"
+    EVICT_TO = 0.9 # Eviction frees files down to this fraction of max_bytes, so the next writes need not evict again
+
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = os.path.expanduser(path) if path is not None else DiskCache.default_path()
+        os.makedirs(self.path, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._total_bytes = None # Size of the files, counted on the first write and kept up to date after that
+
+    @staticmethod
+    def default_path():
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(base, "metaproblog", "circuits")
+
+    """ (lf, theories, predicates, circuits) stored under key, or None """
+    def load_entry(self, key):
+        return self._load("entry", key)
+
+    def store_entry(self, key, lf, theories, predicates, circuits):
+        self._store("entry", key, (lf, theories, predicates, circuits))
+
+    def load_plan(self, key):
+        return self._load("plan", key)
+
+    def store_plan(self, key, plan):
+        self._store("plan", key, plan)
+
+    def clear(self):
+        for path in self._files():
+            DiskCache._remove(path)
+        self._total_bytes = None
+
+    def stats(self):
+        files = list(self._files())
+        return {
+            "path": self.path,
+            "files": len(files),
+            "size_bytes": sum(DiskCache._size(path) for path in files),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+        }
+
+    def _file(self, kind, key):
+        return os.path.join(self.path, "%s-%s%s"%(kind, key, DiskCache.SUFFIX))
+
+    def _header(self):
+        return (DiskCache.FORMAT_VERSION, getattr(problog, "__version__", None))
+
+    def _load(self, kind, key):
+        path = self._file(kind, key)
+        try:
+            with open(path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    header, value = pickle.loads(data)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e: # Truncated, or written by something else
+            print("Ignoring unreadable disk cache file %s: %s"%(path, e), file=sys_stderr)
+            self._discard(path)
+            self.misses += 1
+            return None
+
+        if header != self._header(): # Another format or problog version
+            self._discard(path)
+            self.misses += 1
+            return None
+        os.utime(path) # Recently used
+        self.hits += 1
+        return value
+
+    def _store(self, kind, key, value):
+        try:
+            data = pickle.dumps((self._header(), value), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e: # e.g. weights which are not picklable; such formulas only live in memory
+            print("Not caching %s %s on disk: %s"%(kind, key, e), file=sys_stderr)
+            return
+        if self._total_bytes is None:
+            self._total_bytes = sum(DiskCache._size(path) for path in self._files())
+        path = self._file(kind, key)
+        replaced = DiskCache._size(path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path) # Readers see the old file or the new one, never half of one
+        except OSError as e:
+            print("Could not write to the disk cache: %s"%e, file=sys_stderr)
+            return
+        finally: # Gone once replaced; left behind by an error or an interrupt otherwise
+            DiskCache._remove(tmp_path)
+        self.writes += 1
+        self._total_bytes += len(data) - replaced
+        if self._total_bytes > self.max_bytes:
+            self._evict()
+
+    """ Removes the least recently used files until they take at most EVICT_TO of max_bytes. Only here are the files
+        looked at, which also corrects the running total for what other kernels sharing the directory wrote. """
+    def _evict(self):
+        files = []
+        for path in self._files():
+            try:
+                files.append((os.stat(path), path))
+            except OSError: # Removed in the meantime
+                pass
+        total = sum(st.st_size for st, _ in files)
+        for st, path in sorted(files, key=lambda item: item[0].st_mtime):
+            if total <= self.max_bytes * DiskCache.EVICT_TO:
+                break
+            DiskCache._remove(path)
+            total -= st.st_size
+        self._total_bytes = total
+
+    def _discard(self, path):
+        size = DiskCache._size(path)
+        DiskCache._remove(path)
+        if self._total_bytes is not None:
+            self._total_bytes = max(0, self._total_bytes - size)
+
+    def _files(self):
+        with os.scandir(self.path) as entries:
+            return [entry.path for entry in entries if entry.name.endswith(DiskCache.SUFFIX)]
+
+    @staticmethod
+    def _size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,31 +1,413 @@
 from sys import stderr as sys_stderr
+from collections import OrderedDict
+import hashlib
 
 from problog.formula import LogicFormula
 
+from metaproblog.profiler import Profiler
+from .compilation_scheduler import CompilationScheduler
+from .compiler_selector import CompilerSelector
+from .incremental_dd import IncrementalDD
+
 class FormulaWrapper:
-    def __init__(self, db):
+    """
+    Collects the groundings (steps) of the queries of a session and compiles them into circuits.
+    Steps are not compiled all together: they are partitioned first. Steps with different evidence never share a formula.
+    Steps with the same evidence share one only if their queries depend on a common probabilistic fact or annotated
+    disjunction, directly or through the evidence. Each partition is grounded and compiled on its own, so unrelated
+    queries cost the sum of small compilations rather than one big one. Steps asking the same thing share one grounding.
+    The partitions are compiled together on the first compile_to, over compile_workers processes (see CompilationScheduler),
+    each with the target class its queries ask for (see ground), or the one the compiler_selector picks for it. SDDs and BDDs of a partition which
+    extends a cached one (e.g. a cell re-run with a query more) are made by adding the new steps to the cached circuit.
+    """
+
+    EVIDENCE_KEY = ("_evidence",) # Stands for the facts under the evidence when grouping steps
+    MAX_EXTENSION_STEPS = 16 # Cached circuits are only extended by this many steps; shorter prefixes are not looked up
+
+    class Step:
+        def __init__(self, key, ground_fn, terms, evidence_key, version, target_class=None):
+            self.key = key # Describes the grounding fully, for the fingerprint
+            self.ground_fn = ground_fn # lf -> lf
+            self.terms = terms # Goals grounded, for the dependencies
+            self.evidence_key = evidence_key
+            self.version = version
+            self.target_class = target_class # What its query will compile_to, if known
+            self.lf = None # This step on its own, when it had to be grounded to find the partitions
+
+    class Partition:
+        def __init__(self, steps):
+            self.steps = steps
+            self.lf = None
+            self.circuits = {} # target_class -> circuit
+            self.cache_key = None
+
+    def __init__(self, db, circuit_cache=None, theory_manager=None, compile_workers=1, compiler_selector=None):
         self.db = db
-        self.lf = LogicFormula()
+        self.compile_workers = compile_workers
+        self.compiler_selector = compiler_selector if compiler_selector is not None else CompilerSelector()
         self._current_version = 0
-        self._compiled = {}
+
+        # With a circuit_cache, grounding is deferred to compile_to so a cache hit can skip it.
+        self.circuit_cache = circuit_cache
+        self.theory_manager = theory_manager
+        self._steps = []
+        self._step_of_version = {}
+        self._shared = {} # share_key -> version of the step that grounded it
+        self._clauses = {} # head signature -> clauses added to db for this formula only (e.g. transformed inline queries)
+        self._partitions = None # Made on the first compile_to after a step is added
+        self._partition_of_version = {}
 
     """ Use this if you want to be grounding stuff """
     def next_version(self):
         self._current_version += 1
         return self._current_version
 
+    """ The version of an earlier step grounded with the same share_key, if any. Its labels (and circuit) can be used instead. """
+    def shared_version(self, share_key):
+        return self._shared.get(share_key)
+
+    """ ground_fn(lf) grounds the goals in terms into lf for the current version and returns it.
+        step_key must describe it fully for the fingerprint. Steps are only compiled together if their evidence_key is equal.
+        target_class is what the step will be compiled to, so that partitions compiled ahead of time get the right one. """
+    def ground(self, step_key, ground_fn, terms=(), evidence_key=(), share_key=None, target_class=None):
+        step = FormulaWrapper.Step(step_key, ground_fn, list(terms), evidence_key, self._current_version, target_class)
+        self._steps.append(step)
+        self._step_of_version[step.version] = step
+        if share_key is not None:
+            self._shared[share_key] = step.version
+        self._partitions = None
+        if self.circuit_cache is None:
+            step.lf = ground_fn(LogicFormula())
+
+    """ Clauses added to db for this formula only (e.g. transformed inline queries) are part of the fingerprint of steps using them """
+    def note_clause(self, clause):
+        self._clauses.setdefault(clause.head.signature, []).append(clause)
+
+    @staticmethod
+    def evidence_key(evidence):
+        return tuple(sorted((str(term), bool(value)) for term, value in evidence))
+
+    def _clauses_for(self, steps):
+        return self.clauses_for(term for step in steps for term in step.terms)
+
+    """ The noted clauses defining any of terms """
+    def clauses_for(self, terms):
+        signatures = set(term.signature for term in terms)
+        return [clause for signature in sorted(signatures) for clause in self._clauses.get(signature, [])]
+
+    """ (TheoryKeys, predicate names or None) that the given steps (default: all) depend on """
+    def dependencies(self, steps=None):
+        if self.theory_manager is None:
+            return (), None
+        steps = self._steps if steps is None else steps
+        terms = [term for step in steps for term in step.terms] + [clause.body for clause in self._clauses_for(steps)]
+        return self.theory_manager.dependencies(terms)
+
+    def fingerprint(self, theories=None, steps=None):
+        steps = self._steps if steps is None else steps
+        h = hashlib.sha1()
+        if self.theory_manager is not None:
+            if theories is None:
+                theories, _predicates = self.dependencies(steps)
+            h.update(self.theory_manager.fingerprint(theories).encode())
+        for clause in self._clauses_for(steps):
+            h.update(("\nclause:%s"%str(clause)).encode())
+        for step in steps:
+            h.update(b"\n")
+            h.update(str(step.key).encode())
+        return h.hexdigest()
+
+    """ The circuit of the partition holding the step of target_version (default: the latest).
+        target_class can be CompilerSelector.AUTO, to let the compiler_selector pick one per partition. """
     def compile_to(self, target_class, target_version = None):
-        # TODO: Should we cache intermediate steps to save effort?
         if target_version is None:
             target_version = self._current_version
-        
-        if target_class not in self._compiled:
-            self._compiled[target_class] = (self._current_version, target_class.create_from(self.lf))
-        
-        version, target = self._compiled[target_class]
-        if version < target_version:
-            print("Outdated compilation. Recompiling.", file=sys_stderr)
-            self._compiled[target_class] = (self._current_version, target_class.create_from(self.lf))
-            version, target = self._compiled[target_class]
-        
+        partition = self._partition_for(target_version)
+        if target_class not in partition.circuits:
+            # In parallel, all partitions at once so they overlap. Else only this one, so its queries are answered sooner.
+            if self.compile_workers != 1:
+                for partition_class, partitions in self._partitions_by_target_class(target_class, partition).items():
+                    self._compile_partitions(partition_class, partitions)
+            else:
+                self._compile_partitions(target_class, [partition])
+        return partition.circuits[target_class]
+
+    """ {target class: the partitions with a step asking for it}, target_class first. Steps which did not say are taken
+        to ask for target_class, and so is partition, whatever its steps asked for. """
+    def _partitions_by_target_class(self, target_class, partition):
+        groups = OrderedDict([(target_class, [partition])])
+        for other in self._partitions:
+            for step in other.steps:
+                group = groups.setdefault(step.target_class if step.target_class is not None else target_class, [])
+                if other not in group:
+                    group.append(other)
+        return groups
+
+    """ Compiles every partition (default: all) which has no target_class circuit yet, taking what it can from the circuit cache """
+    def _compile_partitions(self, target_class, partitions=None):
+        auto = target_class == CompilerSelector.AUTO
+        partitions = self._partitions if partitions is None else partitions
+        pending = [partition for partition in partitions if target_class not in partition.circuits]
+        with Profiler.phase("compile", target=target_class if auto else target_class.__name__, partitions=len(pending), workers=self.compile_workers):
+            to_compile = []
+            cache_hits = 0
+            extended = 0
+            for partition in pending:
+                if self.circuit_cache is None:
+                    self._partition_lf(partition)
+                    to_compile.append(partition)
+                    continue
+                theories, predicates = self.dependencies(partition.steps)
+                partition.cache_key = self.fingerprint(theories, partition.steps)
+                entry = self.circuit_cache.get(partition.cache_key)
+                if entry is not None:
+                    cache_hits += 1
+                else:
+                    entry = self._extend_cached(partition, target_class, theories, predicates)
+                    if entry is not None:
+                        extended += 1
+                    else:
+                        entry = self.circuit_cache.put(partition.cache_key, self._partition_lf(partition), theories, predicates)
+                partition.lf = entry.lf # It belongs to the cache now, so it must not be grounded into any more.
+                circuit = self.compiler_selector.usable_circuit(entry.circuits) if auto else entry.circuits.get(target_class)
+                if circuit is not None:
+                    partition.circuits[target_class] = circuit
+                else:
+                    to_compile.append(partition)
+
+            if auto:
+                self._compile_auto(to_compile)
+            else:
+                circuits = CompilationScheduler.compile_all([partition.lf for partition in to_compile], target_class, self.compile_workers)
+                for partition, circuit in zip(to_compile, circuits):
+                    self._add_circuit(partition, target_class, circuit)
+
+            if self.circuit_cache is not None:
+                Profiler.annotate(cache_hits=cache_hits, extended=extended)
+            Profiler.annotate(compiled=len(to_compile))
+            Profiler.annotate(**FormulaWrapper._total_size([partition.lf for partition in pending], "formula"))
+            Profiler.annotate(**FormulaWrapper._total_size([partition.circuits[target_class] for partition in pending], "circuit"))
+
+    """ Compiles each partition with the backend the compiler_selector expects to be fastest (racing them on formulas
+        it cannot tell), then lets it try others on the side """
+    def _compile_auto(self, partitions):
+        choices = [self.compiler_selector.choose(partition.lf) for partition in partitions]
+        known = [i for i, (_features, target_class) in enumerate(choices) if target_class is not None]
+        results = CompilationScheduler.compile_all([partitions[i].lf for i in known], [choices[i][1] for i in known],
+                                                        self.compile_workers, timed=True)
+
+        trials = 0
+        for i, (circuit, seconds) in zip(known, results):
+            partition, (features, target_class) = partitions[i], choices[i]
+            self.compiler_selector.observe(target_class, features, seconds)
+            self._add_circuit(partition, target_class, circuit)
+            partition.circuits[CompilerSelector.AUTO] = circuit
+            trials += self._trial(partition, features, target_class, seconds)
+
+        raced = [i for i in range(len(partitions)) if i not in known]
+        used = set(choices[i][1] for i in known)
+        for i in raced:
+            target_class, circuit = self.compiler_selector.race(partitions[i].lf, choices[i][0])
+            self._add_circuit(partitions[i], target_class, circuit)
+            partitions[i].circuits[CompilerSelector.AUTO] = circuit
+            used.add(target_class)
+        Profiler.annotate(compilers=",".join(sorted(target_class.__name__ for target_class in used)), raced=len(raced), trials=trials)
+
+    def _trial(self, partition, features, target_class, seconds):
+        trial = self.compiler_selector.trial(features, target_class, seconds)
+        if trial is None or not CompilationScheduler.can_fork():
+            return 0
+        trial_class, budget = trial
+        try:
+            finished, trial_circuit, trial_seconds = CompilationScheduler.compile_within(partition.lf, trial_class, budget)
+        except Exception as e: # The backend cannot handle it; that only makes it a bad choice
+            print("Trying %s failed: %s"%(trial_class.__name__, e), file=sys_stderr)
+            finished, trial_circuit, trial_seconds = False, None, budget
+        self.compiler_selector.observe(trial_class, features, trial_seconds, finished)
+        if trial_circuit is not None:
+            self._add_circuit(partition, trial_class, trial_circuit)
+        return 1
+
+    """ The circuit cache entry for partition, made by extending the one of the longest prefix of its steps which is cached
+        with a circuit that can be (see IncrementalDD), or None. Only the steps after the prefix are grounded, into the
+        formula of the prefix, and only their nodes are compiled. That entry is taken out of the cache, since its formula
+        and circuit now hold more. """
+    def _extend_cached(self, partition, target_class, theories, predicates):
+        if target_class != CompilerSelector.AUTO and not issubclass(target_class, IncrementalDD):
+            return None
+        steps = partition.steps
+        for size in range(len(steps) - 1, max(0, len(steps) - 1 - FormulaWrapper.MAX_EXTENSION_STEPS), -1):
+            prefix_key = self.fingerprint(self.dependencies(steps[:size])[0], steps[:size])
+            prefix = self.circuit_cache.get(prefix_key)
+            if prefix is None:
+                continue
+            circuits = [(circuit_class, circuit) for circuit_class, circuit in prefix.circuits.items() if IncrementalDD.can_extend(circuit)
+                            and (circuit_class is target_class or target_class == CompilerSelector.AUTO)]
+            if not circuits:
+                return None
+            circuit_class, circuit = circuits[0]
+
+            self.circuit_cache.remove(prefix_key)
+            with Profiler.phase("ground (deferred)", steps=len(steps) - size):
+                lf = prefix.lf
+                for step in steps[size:]:
+                    lf = step.ground_fn(lf)
+            entry = self.circuit_cache.put(partition.cache_key, lf, theories, predicates)
+            with Profiler.phase("extend", target=circuit_class.__name__, steps=len(steps) - size):
+                if IncrementalDD.extend(circuit, lf):
+                    self.circuit_cache.add_circuit(partition.cache_key, circuit_class, circuit)
+                    Profiler.annotate(**Profiler.formula_size(circuit, "circuit"))
+            return entry
+        return None
+
+    def _add_circuit(self, partition, target_class, circuit):
+        partition.circuits[target_class] = circuit
+        if self.circuit_cache is not None:
+            self.circuit_cache.add_circuit(partition.cache_key, target_class, circuit)
+
+    @staticmethod
+    def _total_size(formulas, prefix):
+        total = {}
+        for formula in formulas:
+            for metric, value in Profiler.formula_size(formula, prefix).items():
+                total[metric] = total.get(metric, 0) + value
+        return total
+
+    def _partition_for(self, version):
+        if version not in self._step_of_version:
+            raise ValueError("Nothing was grounded for version %s"%version)
+        if self._partitions is None:
+            if self._partition_of_version:
+                print("New queries after compilation. Repartitioning.", file=sys_stderr)
+            self._make_partitions()
+        return self._partition_of_version[version]
+
+    def _make_partitions(self):
+        by_evidence = OrderedDict()
+        for step in self._steps:
+            by_evidence.setdefault(step.evidence_key, []).append(step)
+
+        self._partitions = []
+        for steps in by_evidence.values():
+            for component in self._components(steps):
+                self._partitions.append(FormulaWrapper.Partition([steps[i] for i in component]))
+        self._partition_of_version = {step.version: partition for partition in self._partitions for step in partition.steps}
+
+    """ Groups of positions in steps which have to be compiled together. Steps are grounded on their own to find out,
+        unless the circuit cache remembers the answer for these steps. """
+    def _components(self, steps):
+        if len(steps) == 1:
+            return [[0]]
+        plan_key = self.fingerprint(steps=steps) if self.circuit_cache is not None else None
+        plan = self.circuit_cache.get_plan(plan_key) if plan_key is not None else None
+        if plan is None:
+            with Profiler.phase("ground (deferred)", steps=len(steps)):
+                for step in steps:
+                    if step.lf is None:
+                        step.lf = step.ground_fn(LogicFormula())
+            plan = FormulaWrapper.components([step.lf for step in steps])
+            if plan_key is not None:
+                self.circuit_cache.put_plan(plan_key, plan)
+        return plan
+
+    """ The formula of partition's steps. If they were grounded on their own to find the partitions, those formulas are
+        used instead of grounding the steps again. """
+    def _partition_lf(self, partition):
+        if len(partition.steps) == 1 and partition.steps[0].lf is not None:
+            partition.lf = partition.steps[0].lf
+            return partition.lf
+        if all(step.lf is not None for step in partition.steps):
+            with Profiler.phase("merge", steps=len(partition.steps)):
+                lf = FormulaWrapper.merge([step.lf for step in partition.steps])
+            if lf is not None:
+                partition.lf = lf
+                return lf
+        with Profiler.phase("ground (deferred)", steps=len(partition.steps)):
+            lf = LogicFormula()
+            for step in partition.steps:
+                lf = step.ground_fn(lf)
+        partition.lf = lf
+        return lf
+
+    """ One formula with the nodes and names of all of lfs, as grounding their steps into it would make: atoms with the
+        same identifier (and so annotated disjunctions) are shared. None if any of them is cyclic, i.e. has a disjunction
+        whose children were added after it; those have to be grounded again. """
+    @staticmethod
+    def merge(lfs):
+        target = LogicFormula()
+        for lf in lfs:
+            mapping = {}
+            def _map(child):
+                return mapping[child] if child > 0 else target.negate(mapping[-child])
+            for index, node, nodetype in lf:
+                if nodetype == "atom":
+                    mapping[index] = target.add_atom(node.identifier, node.probability, node.group, node.name, node.source,
+                                                        is_extra=node.is_extra)
+                elif any(abs(child) >= index for child in node.children):
+                    return None
+                elif nodetype == "conj":
+                    mapping[index] = target.add_and([_map(child) for child in node.children], name=node.name)
+                else:
+                    mapping[index] = target.add_or([_map(child) for child in node.children], name=node.name)
+            for name, node, label in lf.get_names_with_label():
+                target.add_name(name, node if node == lf.TRUE or node == lf.FALSE else _map(node), label)
         return target
+
+    """ Partitions the formulas (one per step, all with the same evidence) into groups which share facts: lists of positions """
+    @staticmethod
+    def components(lfs):
+        parent = list(range(len(lfs)))
+
+        def _find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        owner = {}
+        for i, lf in enumerate(lfs):
+            query_facts, evidence_facts = FormulaWrapper.labelled_facts(lf)
+            keys = set(query_facts)
+            if not query_facts.isdisjoint(evidence_facts):
+                keys.add(FormulaWrapper.EVIDENCE_KEY)
+            for key in keys:
+                if key in owner:
+                    parent[_find(i)] = _find(owner[key])
+                else:
+                    owner[key] = i
+
+        groups = OrderedDict()
+        for i in range(len(lfs)):
+            groups.setdefault(_find(i), []).append(i)
+        return list(groups.values())
+
+    """ (facts under the queries, facts under the evidence) of lf. Facts are atom identifiers and annotated disjunction groups. """
+    @staticmethod
+    def labelled_facts(lf):
+        query_nodes, evidence_nodes = [], []
+        for _name, node, label in lf.get_names_with_label():
+            kind = label[-1] if isinstance(label, tuple) else label
+            if kind == LogicFormula.LABEL_QUERY:
+                query_nodes.append(node)
+            elif kind in (LogicFormula.LABEL_EVIDENCE_POS, LogicFormula.LABEL_EVIDENCE_NEG, LogicFormula.LABEL_EVIDENCE_MAYBE):
+                evidence_nodes.append(node)
+        return FormulaWrapper._facts_under(lf, query_nodes), FormulaWrapper._facts_under(lf, evidence_nodes)
+
+    @staticmethod
+    def _facts_under(lf, nodes):
+        facts = set()
+        seen = set()
+        stack = [abs(node) for node in nodes if node] # 0 is true and None is false; neither depends on anything
+        while stack:
+            index = stack.pop()
+            if index in seen:
+                continue
+            seen.add(index)
+            node = lf.get_node(index)
+            if type(node).__name__ == "atom":
+                facts.add(("atom", node.identifier))
+                if node.group is not None:
+                    facts.add(("group", node.group))
+            else:
+                stack.extend(abs(child) for child in node.children if child)
+        return facts
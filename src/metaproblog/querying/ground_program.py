@@ -0,0 +1,163 @@
+from problog.errors import InconsistentEvidenceError
+from problog.formula import LogicFormula, LogicDAG
+
+from metaproblog.querying.amc_query import AMCQuery
+from metaproblog.querying.sample_query import SampleQuery
+
+
+class GroundProgram:
+    """
+    The ground queries and evidence as a LogicDAG, flattened into arrays for the samplers and searches
+        which work on assignments to the probabilistic choices instead of compiling.
+    Every probabilistic fact is one variable, and so is every annotated disjunction (with ProbLog's extra atom as "none").
+    A variable's value is the index of its true member, or -1 for none.
+    """
+
+    def __init__(self, dag, clamped=None):
+        if clamped is None:
+            clamped = {}
+        n = len(dag)
+        self.n = n
+        self.kinds = [None] * (n + 1)
+        self.children = [()] * (n + 1)
+        self.parents = [[] for _ in range(n + 1)]
+
+        # Variables: (member atoms, their probabilities, probability that none of them is true, atom for "none" or None)
+        self.variables = []
+        self.clamped_value = [] # Per variable: the clamped value index or None
+        groups = {}
+        for i, node, kind in dag:
+            self.kinds[i] = kind
+            if kind == "atom" and node.is_extra: # The "none" choice of an annotated disjunction
+                groups.setdefault(node.group, ([], []))[1].append(i)
+            elif kind == "atom":
+                try:
+                    p = float(node.probability)
+                except (TypeError, ValueError, ArithmeticError):
+                    raise ValueError("Only facts with numeric probabilities are supported, not %s"%str(node.probability))
+                if node.group is None:
+                    self.variables.append(([i], [p], 1.0 - p, None))
+                    clamp = clamped.get(node.identifier)
+                    self.clamped_value.append(None if clamp is None else (0 if clamp else -1))
+                else:
+                    groups.setdefault(node.group, ([], []))[0].append((i, p, node.identifier))
+            else:
+                self.children[i] = tuple(node.children)
+                for c in node.children:
+                    if c is not None and c != 0:
+                        self.parents[abs(c)].append(i)
+
+        for members, extra in groups.values():
+            atoms = [i for i, _p, _id in members]
+            probs = [p for _i, p, _id in members]
+            self.variables.append((atoms, probs, max(0.0, 1.0 - sum(probs)), extra[0] if extra else None))
+            clamp = None
+            for k, (_i, _p, identifier) in enumerate(members):
+                if clamped.get(identifier) is True:
+                    clamp = k
+            self.clamped_value.append(clamp)
+
+        self.var_of_atom = {}
+        for var, (atoms, _probs, _none_prob, none_atom) in enumerate(self.variables):
+            for i in atoms:
+                self.var_of_atom[i] = var
+            if none_atom is not None:
+                self.var_of_atom[none_atom] = var
+
+        self.order = self._topological_order()
+        self.position = [0] * (n + 1)
+        for pos, i in enumerate(self.order):
+            self.position[i] = pos
+
+        self.evidence = {} # node -> required value
+        for name, node in dag.get_names(LogicFormula.LABEL_EVIDENCE_POS):
+            self._add_evidence(name, node, True)
+        for name, node in dag.get_names(LogicFormula.LABEL_EVIDENCE_NEG):
+            self._add_evidence(name, node, False)
+        self.evidence_names = {name: True for name, _ in dag.get_names(LogicFormula.LABEL_EVIDENCE_POS)}
+        self.evidence_names.update({name: False for name, _ in dag.get_names(LogicFormula.LABEL_EVIDENCE_NEG)})
+        self.queries = list(dag.get_names(LogicFormula.LABEL_QUERY)) # [(name, literal)]
+
+        # Per variable, made on first use: the program does not change, but samplers ask for these on every sweep
+        self._candidates = [None] * len(self.variables)
+        self._affected = [None] * len(self.variables)
+        self._checked = [None] * len(self.variables)
+
+    """ Grounds queries and evidence, and clamps the facts which evidence propagation fixes """
+    @staticmethod
+    def ground(engine, db, queries, evidence):
+        labels = (LogicFormula.LABEL_QUERY, LogicFormula.LABEL_EVIDENCE_POS, LogicFormula.LABEL_EVIDENCE_NEG)
+        lf = AMCQuery.ground_query_evidence(engine, db, queries, evidence, LogicFormula(), labels)
+        clamped = {}
+        if evidence:
+            _facts, ev_target = SampleQuery.do_propagate_evidence(engine, db, evidence)
+            for index, value in ev_target.lookup_evidence.items():
+                node = ev_target.get_node(index)
+                if type(node).__name__ == "atom" and (ev_target.is_true(value) or ev_target.is_false(value)):
+                    clamped[node.identifier] = ev_target.is_true(value)
+        return GroundProgram(LogicDAG.create_from(lf), clamped)
+
+    def _add_evidence(self, name, node, required):
+        if node == 0 or node is None:
+            if (node == 0) != required:
+                raise InconsistentEvidenceError(name)
+            return
+        self.evidence[abs(node)] = required if node > 0 else not required
+
+    def _topological_order(self):
+        order = []
+        visited = [False] * (self.n + 1)
+        for root in range(1, self.n + 1):
+            if visited[root]:
+                continue
+            stack = [(root, iter(self.children[root]))]
+            visited[root] = True
+            while stack:
+                i, it = stack[-1]
+                for c in it:
+                    if c is not None and c != 0 and not visited[abs(c)]:
+                        visited[abs(c)] = True
+                        stack.append((abs(c), iter(self.children[abs(c)])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(i)
+        return order
+
+    """ (value index, prior probability) for every value the variable can take. Shared: do not change it. """
+    def candidates(self, var):
+        candidates = self._candidates[var]
+        if candidates is None:
+            _atoms, probs, none_prob, _none_atom = self.variables[var]
+            if self.clamped_value[var] is not None:
+                candidates = [(self.clamped_value[var], 1.0)]
+            else:
+                candidates = [(k, p) for k, p in enumerate(probs) if p > 0]
+                if none_prob > 1e-12:
+                    candidates.append((-1, none_prob))
+            self._candidates[var] = candidates
+        return candidates
+
+    """ Internal nodes above the variable's atoms, in topological order. Shared: do not change it. """
+    def affected(self, var):
+        affected = self._affected[var]
+        if affected is None:
+            seen = set()
+            atoms, _probs, _none_prob, none_atom = self.variables[var]
+            pending = atoms + ([none_atom] if none_atom is not None else [])
+            while pending:
+                i = pending.pop()
+                for parent in self.parents[i]:
+                    if parent not in seen:
+                        seen.add(parent)
+                        pending.append(parent)
+            affected = self._affected[var] = sorted(seen, key=self.position.__getitem__)
+        return affected
+
+    """ The evidence nodes whose value the variable can change: affected ones, and its own atoms """
+    def checked(self, var):
+        checked = self._checked[var]
+        if checked is None:
+            checked = [i for i in self.affected(var) if i in self.evidence] + [a for a in self.variables[var][0] if a in self.evidence]
+            self._checked[var] = checked
+        return checked
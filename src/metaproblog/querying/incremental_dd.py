@@ -0,0 +1,86 @@
+from problog.bdd_formula import BDD
+from problog.dd_formula import DD
+from problog.formula import LogicFormula
+from problog.sdd_formula import SDD
+
+
+class IncrementalDD:
+    """
+    Decision diagrams (SDDs, BDDs) which can take more of the formula they were compiled from.
+    A DD builds the diagram of each of its nodes once, in a manager it keeps; so if nodes grounded into the formula later
+    are added to the same DD, only the diagrams of the new nodes are built. create_from copies the formula node by node
+    (rather than through a LogicDAG) and remembers which node became which, so that extend can do that.
+    This needs formulas whose nodes only refer to earlier nodes, i.e. which have no cycles to break; other formulas are
+    compiled the usual way, into a plain SDD or BDD which cannot be extended.
+    """
+
+    base_class = None # The DD class this makes incremental
+
+    @classmethod
+    def create_from(cls, obj, **kwdargs):
+        if not isinstance(obj, LogicFormula) or isinstance(obj, DD) or not IncrementalDD.is_topological(obj, 1):
+            return cls.base_class.create_from(obj, **kwdargs)
+        circuit = cls(**kwdargs)
+        if isinstance(circuit, SDD):
+            circuit.init_varcount = max(obj.atomcount, 1) # Balances the vtree over the atoms known now; more are added after the last
+        circuit._source_nodes = {} # index in the formula -> index in circuit
+        circuit._source_size = 0 # Nodes of the formula copied so far
+        IncrementalDD._add_nodes(circuit, obj)
+        return circuit
+
+    """ Adds the nodes (and names) grounded into lf since circuit was made from it, or last extended. lf must be the same
+        formula, grown. Returns False if circuit cannot be extended, or the new nodes have cycles; recompile then. """
+    @staticmethod
+    def extend(circuit, lf):
+        if getattr(circuit, "_source_nodes", None) is None or not IncrementalDD.is_topological(lf, circuit._source_size + 1):
+            return False
+        IncrementalDD._add_nodes(circuit, lf)
+        return True
+
+    @staticmethod
+    def can_extend(circuit):
+        return getattr(circuit, "_source_nodes", None) is not None
+
+    """ Whether the nodes of lf from index start on only have children before them """
+    @staticmethod
+    def is_topological(lf, start):
+        for index in range(start, len(lf) + 1):
+            node = lf.get_node(index)
+            if type(node).__name__ != "atom" and any(child is not None and abs(child) >= index for child in node.children):
+                return False
+        return True
+
+    @staticmethod
+    def _add_nodes(circuit, lf):
+        nodes = circuit._source_nodes
+
+        def _key(key):
+            if key is None or key == 0: # False and true
+                return key
+            return nodes[key] if key > 0 else -nodes[-key]
+
+        for index in range(circuit._source_size + 1, len(lf) + 1):
+            node = lf.get_node(index)
+            nodetype = type(node).__name__
+            if nodetype == "atom":
+                nodes[index] = circuit.add_atom(node.identifier, node.probability, group=node.group, name=lf.get_name(index),
+                                                    cr_extra=False, is_extra=node.is_extra)
+            elif nodetype == "conj":
+                nodes[index] = circuit.add_and([_key(child) for child in node.children], name=node.name)
+            elif nodetype == "disj":
+                nodes[index] = circuit.add_or([_key(child) for child in node.children], name=node.name)
+            else:
+                raise TypeError("Unknown node type: %s"%nodetype)
+        circuit._source_size = len(lf)
+
+        for name, key, label in lf.get_names_with_label():
+            circuit.add_name(name, _key(key), label)
+        circuit.build_dd() # Only builds the diagrams of nodes which do not have one yet (and the constraints)
+
+
+class IncrementalSDD(IncrementalDD, SDD):
+    base_class = SDD
+
+
+class IncrementalBDD(IncrementalDD, BDD):
+    base_class = BDD
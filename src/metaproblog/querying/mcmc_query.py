@@ -0,0 +1,176 @@
+from sys import stderr as sys_stderr
+import random
+
+from problog.errors import InconsistentEvidenceError
+
+from metaproblog.querying.query_base import QueryBase
+from metaproblog.querying.ground_program import GroundProgram
+
+
+class MCMCQuery(QueryBase):
+    """
+    Gibbs sampling over the probabilistic choices of the ground program (see GroundProgram), without compiling it.
+    A sweep resamples each variable from its prior restricted to the values which keep the evidence true,
+        re-evaluating only the nodes above it.
+    The start state is a prior sample, with the facts fixed by evidence propagation clamped, repaired by min-conflicts search.
+    As with any Gibbs sampler, strongly deterministic programs can keep the chain from mixing.
+    results is ([(query, estimate)], evidence_dict), like AMCQuery.
+    """
+
+    def __init__(self, queries, evidence, formula_wrapper, n_samples=1000, burnin=100, thin=1, seed=None, init_sweeps=100):
+        super().__init__(queries, evidence, formula_wrapper)
+        self.n_samples = n_samples
+        self.burnin = burnin
+        self.thin = max(1, thin)
+        self.seed = seed
+        self.init_sweeps = init_sweeps
+
+        self.program = None
+        self.results = None
+
+    def ground(self, engine):
+        self.program = GroundProgram.ground(engine, self.formula_wrapper.db, self.queries, self.evidence)
+
+    def evaluate(self, _engine):
+        chain = MCMCQuery.Chain(self.program, random.Random(self.seed))
+        q_nodes = self.program.queries
+        counts = [0] * len(q_nodes)
+        retained = 0
+        try:
+            chain.initialize(self.init_sweeps)
+            for _ in range(self.burnin):
+                chain.sweep()
+            while retained < self.n_samples:
+                for _ in range(self.thin):
+                    chain.sweep()
+                for i, (_name, node) in enumerate(q_nodes):
+                    counts[i] += chain.literal_value(node)
+                retained += 1
+        except KeyboardInterrupt:
+            print("MCMC interrupted after %d samples"%retained, file=sys_stderr)
+
+        self.results = ([(name, (count / retained) if retained else 0.0) for (name, _), count in zip(q_nodes, counts)],
+                            dict(self.program.evidence_names))
+        return self.results
+
+
+    class Chain:
+        """ The state of the Gibbs sampler over a GroundProgram """
+
+        def __init__(self, program, rng):
+            self.program = program
+            self.rng = rng
+            self.value = [False] * (program.n + 1)
+            self.state = [-1] * len(program.variables) # Index of the true member, -1 for none
+
+        def literal_value(self, lit):
+            if lit == 0:
+                return True
+            elif lit is None:
+                return False
+            return self.value[abs(lit)] != (lit < 0)
+
+        def _evaluate_node(self, i):
+            kind = self.program.kinds[i]
+            if kind == "conj":
+                return all(self.literal_value(c) for c in self.program.children[i])
+            elif kind == "disj":
+                return any(self.literal_value(c) for c in self.program.children[i])
+            return self.value[i]
+
+        def _set(self, var, k):
+            self.state[var] = k
+            atoms, _probs, _none_prob, none_atom = self.program.variables[var]
+            for m, atom in enumerate(atoms):
+                self.value[atom] = (m == k)
+            if none_atom is not None:
+                self.value[none_atom] = (k == -1)
+
+        def _violations(self, nodes):
+            evidence = self.program.evidence
+            return sum(1 for i in nodes if i in evidence and self.value[i] != evidence[i])
+
+        def _choose(self, weighted):
+            total = sum(w for _k, w in weighted)
+            r = self.rng.random() * total
+            for k, w in weighted:
+                r -= w
+                if r < 0:
+                    return k
+            return weighted[-1][0]
+
+        def _evaluate_all(self):
+            for i in self.program.order:
+                if self.program.kinds[i] != "atom":
+                    self.value[i] = self._evaluate_node(i)
+
+        def _try_values(self, var, candidates):
+            """ (candidate, weight, violations) for each value of var, given the rest of the state """
+            affected = self.program.affected(var)
+            checked = self.program.checked(var)
+            results = []
+            for k, w in candidates:
+                self._set(var, k)
+                for i in affected:
+                    self.value[i] = self._evaluate_node(i)
+                results.append((k, w, self._violations(checked)))
+            return results, affected
+
+        def _commit(self, var, k, affected):
+            self._set(var, k)
+            for i in affected:
+                self.value[i] = self._evaluate_node(i)
+
+        """ Prior sample, then min-conflicts sweeps until the evidence holds """
+        def initialize(self, max_sweeps):
+            n_vars = len(self.program.variables)
+            for var in range(n_vars):
+                self._set(var, self._choose(self.program.candidates(var)))
+            self._evaluate_all()
+            for _ in range(max_sweeps):
+                if self._violations(self.program.evidence) == 0:
+                    return
+                for var in range(n_vars):
+                    tried, affected = self._try_values(var, self.program.candidates(var))
+                    best = min(v for _k, _w, v in tried)
+                    self._commit(var, self._choose([(k, w) for k, w, v in tried if v == best]), affected)
+            if self._violations(self.program.evidence) > 0:
+                raise InconsistentEvidenceError(context=" (MCMC found no state consistent with the evidence in %d sweeps)"%max_sweeps)
+
+        def sweep(self):
+            for var in range(len(self.program.variables)):
+                candidates = self.program.candidates(var)
+                if len(candidates) == 1:
+                    continue
+                tried, affected = self._try_values(var, candidates)
+                allowed = [(k, w) for k, w, v in tried if v == 0]
+                self._commit(var, self._choose(allowed) if allowed else self.state[var], affected)
+
+
+# Devtime testing
+def _run_tests():
+    from problog.program import PrologString
+    from problog.engine import DefaultEngine
+    from problog.logic import Term
+    from problog import get_evaluatable
+    from .formula_wrapper import FormulaWrapper
+    program = """
+    0.01::burglary. 0.02::earthquake.
+    0.9::alarm :- burglary. 0.4::alarm :- earthquake.
+    0.3::a; 0.5::b.
+    c :- a. c :- \\+a, b.
+    """
+    p = PrologString(program)
+    engine = DefaultEngine()
+    fw = FormulaWrapper(engine.prepare(p))
+    for ev in [[(Term("alarm"), True)], [(Term("c"), True)]]:
+        queries = [Term("burglary"), Term("earthquake"), Term("a"), Term("b")]
+        qobj = MCMCQuery(queries, ev, fw, n_samples=20000, burnin=500, seed=1)
+        qobj.ground(engine)
+        print("mcmc ", qobj.evaluate(engine))
+        exact = PrologString(program + "\n" + "\n".join("query(%s)."%q for q in queries) + "\n"
+                                + "\n".join("evidence(%s, %s)."%(t, str(v).lower()) for t, v in ev))
+        print("exact", get_evaluatable().create_from(exact).evaluate())
+
+if __name__ == "__main__":
+    _run_tests()
@@ -4,6 +4,9 @@ from problog.evaluator import SemiringProbability
 from problog.tasks.mpe import SemiringMPEState, SemiringMinPEState
 
 from .sample_query import SampleQuery
+from .weighted_sample_query import WeightedSampleQuery
+from .mcmc_query import MCMCQuery
+from .anytime_query import AnytimeQuery
 from .amc_query import AMCQuery
 
 class QueryFactory:
@@ -12,6 +15,9 @@ class QueryFactory:
         MPE = 2
         MINPE = 3
         SAMPLE = 4
+        WEIGHTED_SAMPLE = 5
+        MCMC = 6
+        ANYTIME = 7
         # More coming?
     
     @staticmethod
@@ -24,6 +30,12 @@ class QueryFactory:
             return AMCQuery(queries, evidence, formula_wrapper, semiring = SemiringMinPEState(), **kwargs)
         elif query_type == QueryFactory.QueryType.SAMPLE:
             return SampleQuery(queries, evidence, formula_wrapper, **kwargs)
+        elif query_type == QueryFactory.QueryType.WEIGHTED_SAMPLE:
+            return WeightedSampleQuery(queries, evidence, formula_wrapper, **kwargs)
+        elif query_type == QueryFactory.QueryType.MCMC:
+            return MCMCQuery(queries, evidence, formula_wrapper, **kwargs)
+        elif query_type == QueryFactory.QueryType.ANYTIME:
+            return AnytimeQuery(queries, evidence, formula_wrapper, **kwargs)
         else:
             raise NotImplementedError("query_type not yet supported: %s"%str(query_type))
     
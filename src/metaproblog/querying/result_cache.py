@@ -0,0 +1,96 @@
+from collections import OrderedDict
+
+from problog.logic import Term, Var
+
+from metaproblog.interrupt_guard import InterruptGuard
+
+
+class ResultCache:
+    """
+    LRU cache of the results of exact queries (probability, mpe, minpe), shared across QuerySessions.
+    A query asked again, e.g. the same inline query in a cell run again after editing unrelated cells, is then answered
+    without grounding, compiling or evaluating anything.
+    Keys (see key) hold the query and evidence in a canonical form, so variable names and the name of the clause an
+    inline query was transformed into do not matter, the query type, and the version vector of the theories the
+    answers depend on: (theory key, content hash) for each. Any change to one of those theories changes the key; stale
+    entries are never hit and age out. Sampled and anytime results are not cached, they are not meant to be the same.
+    """
+
+    DEFAULT_MAX_ENTRIES = 1024
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (query functors, results), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    """ queries: the query terms; clauses: {query functor: the clause it was transformed into} for inline queries;
+        options: anything else the results depend on (e.g. the query type); versions: the version vector """
+    @staticmethod
+    def key(queries, evidence, clauses, options, versions):
+        query_keys = []
+        for query in queries:
+            clause = clauses.get(query.functor)
+            if clause is None:
+                query_keys.append(ResultCache.canonical(query))
+            else: # The head's name is made up per session; its arguments are the body's variables, in order
+                query_keys.append(("clause", ResultCache.canonical(Term("_head", *clause.head.args) << clause.body)))
+        evidence_keys = sorted((ResultCache.canonical(term), bool(value)) for term, value in evidence)
+        return tuple(query_keys), tuple(evidence_keys), options, tuple(versions)
+
+    """ str of term, with its variables renamed to the order they first appear in """
+    @staticmethod
+    def canonical(term):
+        class _Renaming(dict):
+            def __missing__(self, name):
+                self[name] = Var("V%d"%len(self))
+                return self[name]
+        return str(term.apply(_Renaming())) if isinstance(term, Term) else str(term)
+
+    """ The results cached for key, with the names of the queries' answers changed to those of queries, or None """
+    def get(self, key, queries):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        functors, (values, evidence) = entry
+        renamed = {old: new for old, new in zip(functors, (query.functor for query in queries)) if old != new}
+        if renamed:
+            values = [(Term(renamed[name.functor], *name.args) if isinstance(name, Term) and name.functor in renamed else name, value)
+                        for name, value in values]
+        return list(values), dict(evidence)
+
+    def put(self, key, queries, results):
+        if not self.max_entries:
+            return
+        values, evidence = results
+        entry = (tuple(query.functor for query in queries), (list(values), dict(evidence)))
+        with InterruptGuard.deferred():
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def resize(self, max_entries):
+        self.max_entries = max_entries
+        with InterruptGuard.deferred():
+            while len(self._entries) > max(max_entries, 0):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with InterruptGuard.deferred():
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,4 +1,8 @@
 from sys import stderr as sys_stderr
+import multiprocessing
+import os
+import random
+import time
 
 from problog.engine import DefaultEngine
 from problog.formula import LogicFormula
@@ -6,46 +10,178 @@ from problog.tasks.sample import FunctionStore, SampledFormula, verify_evidence
 
 
 from metaproblog.querying.query_base import QueryBase
+from metaproblog.querying.sample_set import SampleSet
+from metaproblog.querying.vectorized_sampler import VectorizedSampler
 
 
 class SampleQuery(QueryBase):
-    def __init__(self, queries, evidence, formula_wrapper, n_samples=1, propagate_evidence=False):
+
+    CHUNK_SIZE = 100 # Samples per seed / unit of work. Fixed, so results don't depend on the number of workers.
+    DEFAULT_MAX_SAMPLES = 100000 # For adaptive sampling (ci), without max_samples
+    CHECK_EVERY = 100 # Fewest samples drawn between checks of the intervals in adaptive sampling
+
+    """ vectorized: ground the queries once and draw the samples from that, with numpy (see VectorizedSampler).
+        Much faster, but only for programs whose grounding is finite; those with continuous distributions are still
+        sampled per sample. Evidence is then only rejected on, and workers are not used.
+        raw: show every sample, not just their frequencies (see HTMLOutput); confidence: of the intervals shown with those.
+        ci: width or (width, confidence), to sample adaptively instead of n_samples: until the confidence interval of
+        every estimate is at most width wide, or max_samples are drawn, or timeout seconds have passed. How that went is
+        in the SampleSet's convergence. Adaptive sampling does not use workers.
+        results is (SampleSet, evidence_dict). """
+    def __init__(self, queries, evidence, formula_wrapper, n_samples=1, propagate_evidence=False, workers=1, seed=None, vectorized=False,
+                    raw=False, confidence=SampleSet.DEFAULT_CONFIDENCE, ci=None, max_samples=None, timeout=None):
         super().__init__(queries, evidence, formula_wrapper)
         self.n_samples = n_samples
         self.propagate_evidence = propagate_evidence
+        self.workers = (os.cpu_count() or 1) if workers == "auto" else workers
+        self.seed = seed
+        self.vectorized = vectorized
+        self.raw = raw
+        self.confidence = float(confidence)
+        self.ci = None
+        if ci is not None:
+            width, self.confidence = (ci, self.confidence) if not isinstance(ci, (tuple, list)) else (tuple(ci) + (self.confidence,))[:2]
+            self.ci = float(width)
+            self.confidence = float(self.confidence)
+            self.n_samples = int(max_samples) if max_samples is not None else SampleQuery.DEFAULT_MAX_SAMPLES
+        self.timeout = None if timeout is None else float(timeout)
 
         self.propagated_ev_facts = []
         self.propagated_ev_target = None
+        self.vectorized_formula = None
 
     def ground(self, engine):
+        if self.vectorized:
+            if not VectorizedSampler.is_available():
+                raise ImportError("Vectorized sampling needs numpy")
+            lf = VectorizedSampler.ground(engine, self.formula_wrapper.db, self.queries, self.evidence)
+            if VectorizedSampler.is_supported(lf) and self.n_samples > 0:
+                self.vectorized_formula = lf
+                return
+            print("Not all facts have a plain probability; sampling without vectorization", file=sys_stderr)
         if self.propagate_evidence:
             self.propagated_ev_facts, self.propagated_ev_target = \
                 SampleQuery.do_propagate_evidence(engine, self.formula_wrapper.db,  self.evidence)
     
 
     def evaluate(self, engine):
-        sample_result = list(SampleQuery.sample(
-            DefaultEngine(), self.formula_wrapper.db,
-            self.queries, self.evidence, self.n_samples,
-            (self.propagated_ev_facts, self.propagated_ev_target)))
-        
-        sampled_terms = [r[0] for r in sample_result]
-        ev_result = {}
+        if self.ci is not None:
+            self.results = self.evaluate_adaptive()
+            return self.results
 
-        if self.propagate_evidence:
-            ev_read_formula = self.propagated_ev_target
-        elif len(sample_result) > 0:
-            ev_read_formula = sample_result[0][1]
+        if self.vectorized_formula is not None:
+            sampled_terms, rejected = VectorizedSampler(self.vectorized_formula, self.queries).sample(self.n_samples, self.seed)
+            print("Rejected samples: %s" % rejected, file=sys_stderr)
+            self.results = (sampled_terms, SampleQuery.read_evidence(self.vectorized_formula))
+            return self.results
+
+        propagated = (self.propagated_ev_facts, self.propagated_ev_target)
+        if self.n_samples > 0 and (self.workers > 1 or self.seed is not None):
+            sampled_terms, ev_result = SampleQuery.sample_chunked(
+                self.formula_wrapper.db, self.queries, self.evidence, self.n_samples,
+                propagated, self.workers, self.seed, samples=SampleSet())
+            if self.propagate_evidence:
+                ev_result = SampleQuery.read_evidence(self.propagated_ev_target)
+            self.results = (sampled_terms, ev_result)
+            return self.results
+
+        sampled_terms = SampleSet()
+        first_target = None # Only the first sample's formula is kept, to read the evidence from
+        for sample_dict, target in SampleQuery.sample(
+                DefaultEngine(), self.formula_wrapper.db,
+                self.queries, self.evidence, self.n_samples,
+                propagated):
+            sampled_terms.append(sample_dict)
+            if first_target is None:
+                first_target = target
+
+        ev_read_formula = self.propagated_ev_target if self.propagate_evidence else first_target
+
+        self.results = (sampled_terms, SampleQuery.read_evidence(ev_read_formula))
+
+        return self.results
+
+    """ Samples in steps until the widest interval is at most ci wide (see SampleSet.max_interval_width). Each step
+        is as many samples as that would take if the width shrinks with the square root of their number, but at least
+        CHECK_EVERY and at most as many as there are already. """
+    def evaluate_adaptive(self):
+        samples = SampleSet()
+        counters = {"rejected": 0}
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        start = time.time()
+        first_target = [] # The first sample's formula, to read the evidence from
+        random_state = None
+
+        if self.vectorized_formula is not None:
+            sampler = VectorizedSampler(self.vectorized_formula, self.queries)
+            rng = VectorizedSampler.rng(self.seed)
+            draw = lambda n: sampler.extend(samples, n, rng, counters, deadline)
+            ev_read_formula = self.vectorized_formula
         else:
+            if self.seed is not None: # problog samples with the global random; it is left as it was (see below)
+                random_state = random.getstate()
+                random.seed(self.seed)
+            generator = SampleQuery.sample(DefaultEngine(), self.formula_wrapper.db, self.queries, self.evidence, 0,
+                                            (self.propagated_ev_facts, self.propagated_ev_target), counters)
+            def draw(n):
+                for i in range(n):
+                    if deadline is not None and time.time() >= deadline:
+                        return i
+                    try:
+                        sample_dict, target = next(generator)
+                    except StopIteration: # It only stops on an interrupt
+                        raise KeyboardInterrupt
+                    samples.append(sample_dict)
+                    if not first_target:
+                        first_target.append(target)
+                return n
             ev_read_formula = None
 
+        stopped = "max_samples"
+        width = None
+        try:
+            while True:
+                width = samples.max_interval_width(self.confidence)
+                if width is not None and width <= self.ci:
+                    stopped = "converged"
+                    break
+                if len(samples) >= self.n_samples:
+                    stopped = "max_samples"
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    stopped = "timeout"
+                    break
+                needed = len(samples) * (width / self.ci) ** 2 - len(samples) if width is not None else 0
+                step = min(max(int(needed) + 1, SampleQuery.CHECK_EVERY), max(len(samples), SampleQuery.CHECK_EVERY),
+                            self.n_samples - len(samples))
+                if draw(step) == 0 and (deadline is None or time.time() < deadline): # No sample satisfies the evidence
+                    stopped = "evidence"
+                    break
+        except KeyboardInterrupt:
+            stopped = "interrupted"
+        finally:
+            if self.vectorized_formula is None:
+                generator.close()
+            if random_state is not None:
+                random.setstate(random_state)
+        width = samples.max_interval_width(self.confidence)
+
+        print("Rejected samples: %s" % counters["rejected"], file=sys_stderr)
+        samples.convergence = {"stopped": stopped, "width": width, "target_width": self.ci, "confidence": self.confidence,
+                                "samples": len(samples), "rejected": counters["rejected"], "seconds": time.time() - start}
+        if self.propagate_evidence:
+            ev_read_formula = self.propagated_ev_target
+        elif ev_read_formula is None and first_target:
+            ev_read_formula = first_target[0]
+        return samples, SampleQuery.read_evidence(ev_read_formula)
+
+    @staticmethod
+    def read_evidence(ev_read_formula):
+        ev_result = {}
         if ev_read_formula is not None:
             ev_result.update({name:True for name,_ in ev_read_formula.get_names(LogicFormula.LABEL_EVIDENCE_POS)})
             ev_result.update({name:False for name,_ in ev_read_formula.get_names(LogicFormula.LABEL_EVIDENCE_NEG)})
-        
-        self.results = (sampled_terms, ev_result)
-
-        return self.results
+        return ev_result
     
     @staticmethod
     def do_propagate_evidence(engine, db, evidence, ev_target=None):
@@ -83,7 +219,7 @@ class SampleQuery(QueryBase):
             return verify_evidence_propagated(engine, db, ev_target, q_target)
     
     @staticmethod
-    def sample(engine, db, queries, evidence, n_samples, propagated_facts_target=([], None)):
+    def sample(engine, db, queries, evidence, n_samples, propagated_facts_target=([], None), counters=None):
         ev_facts, ev_target = propagated_facts_target
         i = 0
         r = 0
@@ -109,10 +245,85 @@ class SampleQuery(QueryBase):
                 engine.previous_result = result
         except KeyboardInterrupt:
             pass
-        
-        print("Rejected samples: %s" % r, file=sys_stderr)
+        finally: # Also when the caller stops early (see evaluate_adaptive)
+            if counters is None:
+                print("Rejected samples: %s" % r, file=sys_stderr)
+            else:
+                counters["rejected"] = r
         return None
 
+    """ Draws n_samples in fixed-size chunks, each with its own seed derived from seed.
+        With workers > 1 the chunks are spread over a pool of forked processes, which inherit db instead of copying it per chunk.
+        Samples come back in chunk order, so the result only depends on seed. On an interrupt, only the chunks finished
+        before it are kept: a prefix of what the full run gives. Returns (sample_dicts, evidence_dict).
+        sampler has the signature of SampleQuery.sample; its fifth argument is passed through as propagated_facts_target.
+        samples: what to extend with the samples (e.g. a SampleSet), a new list by default.
+    """
+    @staticmethod
+    def sample_chunked(db, queries, evidence, n_samples, propagated_facts_target=([], None), workers=1, seed=None, sampler=None, samples=None):
+        if sampler is None:
+            sampler = SampleQuery.sample
+        if seed is None:
+            seed = random.getrandbits(64)
+        chunks = [(i, "%s:%d"%(seed, i), min(SampleQuery.CHUNK_SIZE, n_samples - start))
+                    for i, start in enumerate(range(0, n_samples, SampleQuery.CHUNK_SIZE))]
+
+        state = (sampler, db, queries, evidence, propagated_facts_target)
+        results = []
+        if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            pool = multiprocessing.get_context("fork").Pool(min(workers, len(chunks)), _init_sample_worker, (state,))
+            try:
+                # imap keeps the chunk order; an interrupt keeps whatever prefix of whole chunks has arrived
+                for chunk_result in pool.imap(_sample_chunk, chunks):
+                    if not chunk_result[3]:
+                        raise KeyboardInterrupt
+                    results.append(chunk_result)
+                pool.close()
+            except KeyboardInterrupt:
+                pool.terminate()
+            finally:
+                pool.join()
+        else:
+            _init_sample_worker(state)
+            try:
+                for chunk in chunks:
+                    chunk_result = _sample_chunk(chunk)
+                    if not chunk_result[3]: # The sampler stops early on an interrupt, and swallows it
+                        break
+                    results.append(chunk_result)
+            except KeyboardInterrupt:
+                pass
+
+        samples = [] if samples is None else samples
+        ev_result = {}
+        rejected = 0
+        for chunk_samples, chunk_rejected, chunk_ev, _complete in results:
+            samples.extend(chunk_samples)
+            rejected += chunk_rejected
+            if not ev_result:
+                ev_result = chunk_ev
+        print("Rejected samples: %s" % rejected, file=sys_stderr)
+        return samples, ev_result
+
+_sample_worker_state = None
+
+def _init_sample_worker(state):
+    global _sample_worker_state
+    _sample_worker_state = state
+
+def _sample_chunk(chunk):
+    _index, chunk_seed, n_samples = chunk
+    sampler, db, queries, evidence, propagated_facts_target = _sample_worker_state
+    random_state = random.getstate() # problog samples with the global random; in-process chunks leave it as it was
+    random.seed(chunk_seed)
+    counters = {}
+    try:
+        sample_result = list(sampler(DefaultEngine(), db, queries, evidence, n_samples, propagated_facts_target, counters))
+    finally:
+        random.setstate(random_state)
+    ev_result = SampleQuery.read_evidence(sample_result[0][1]) if sample_result else {}
+    return [r[0] for r in sample_result], counters["rejected"], ev_result, len(sample_result) == n_samples
+
 # Devtime testing
 def run_tests_with_static_methods():
     for PROPAGATE in [True, False]:
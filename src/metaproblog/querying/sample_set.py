@@ -0,0 +1,166 @@
+from math import erf, sqrt
+
+try:
+    import numpy
+except ImportError: # Only used to take columns from numpy arrays (see add_columns)
+    numpy = None
+
+
+class SampleSet:
+    """
+    The samples of a SampleQuery, stored by column rather than as one dict per sample.
+    Each atom that appears in a sample (a query answer, or a query with no answer) is interned once in atoms, and has a
+    column of one byte per sample: ABSENT, FALSE, TRUE, or OTHER for a value which is not a bool (e.g. of a continuous
+    distribution), kept aside in a dict. 100k samples of ten atoms take about a MB, instead of 100k dicts of Terms.
+    It still reads as the list of sample dicts it replaces (iteration, len, indexing), for code which wants raw samples,
+    but aggregates (frequencies, marginals) are counted on the columns without building those dicts.
+    convergence: how adaptive sampling (see SampleQuery, ci) ended, e.g. {"stopped": "converged", "width": 0.0098, ...}
+    """
+
+    ABSENT, FALSE, TRUE, OTHER = 0, 1, 2, 3 # Codes in the columns
+    DEFAULT_CONFIDENCE = 0.95
+    _z_scores = {} # confidence -> z_score(confidence)
+
+    def __init__(self, samples=()):
+        self.atoms = [] # Interned atoms, in the order they first appeared
+        self._index = {} # atom -> its index in atoms
+        self._columns = [] # bytearray per atom
+        self._values = {} # (atom index, sample index) -> value, for those coded OTHER
+        self._count = 0
+        self.convergence = None
+        self.extend(samples)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._sample(i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._sample(j) for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("sample index out of range")
+        return self._sample(i)
+
+    def __bool__(self):
+        return self._count > 0
+
+    def __repr__(self):
+        return "SampleSet(%d samples of %s)"%(self._count, ", ".join(str(atom) for atom in self.atoms))
+
+    """ Adds a sample dict (see SampledFormula.to_dict) """
+    def append(self, sample):
+        row = self._count
+        for atom, value in sample.items():
+            column = self._columns[self._intern(atom)]
+            if value is True or value is False:
+                column.append(SampleSet.TRUE if value else SampleSet.FALSE)
+            else:
+                column.append(SampleSet.OTHER)
+                self._values[(self._index[atom], row)] = value
+        self._count += 1
+        for column in self._columns:
+            if len(column) < self._count: # Not in this sample
+                column.append(SampleSet.ABSENT)
+
+    def extend(self, samples):
+        if isinstance(samples, SampleSet):
+            columns = {atom: samples._columns[i] for i, atom in enumerate(samples.atoms)}
+            values = {(samples.atoms[i], row): value for (i, row), value in samples._values.items()}
+            self._add(len(samples), columns, values)
+        else:
+            for sample in samples:
+                self.append(sample)
+
+    """ Adds count samples at once. columns: {atom: codes for the count samples}, as bytes or a numpy array of them """
+    def add_columns(self, count, columns):
+        self._add(count, {atom: codes.astype(numpy.uint8).tobytes() if numpy is not None and isinstance(codes, numpy.ndarray) else codes
+                            for atom, codes in columns.items()})
+
+    def _add(self, count, columns, values=None):
+        start = self._count
+        for atom, codes in columns.items():
+            self._columns[self._intern(atom)].extend(codes)
+        self._count += count
+        for column in self._columns:
+            if len(column) < self._count:
+                column.extend(bytes(self._count - len(column)))
+        for (atom, row), value in (values or {}).items():
+            self._values[(self._index[atom], start + row)] = value
+
+    def _intern(self, atom):
+        index = self._index.get(atom)
+        if index is None:
+            index = self._index[atom] = len(self.atoms)
+            self.atoms.append(atom)
+            self._columns.append(bytearray(self._count))
+        return index
+
+    def _sample(self, row):
+        sample = {}
+        for index, (atom, column) in enumerate(zip(self.atoms, self._columns)):
+            code = column[row]
+            if code == SampleSet.TRUE:
+                sample[atom] = True
+            elif code == SampleSet.FALSE:
+                sample[atom] = False
+            elif code == SampleSet.OTHER:
+                sample[atom] = self._values[(index, row)]
+        return sample
+
+    """ [(atom, number of samples in which it is true)] of the ground atoms with only bool values. A query with no answer
+        in a sample shows up in it as itself, False (see SampledFormula.to_dict); for a non-ground query that is no atom
+        to count. Atoms with other values (e.g. x of normal(0,1)::x) have no frequency either. """
+    def frequencies(self):
+        return [(atom, column.count(SampleSet.TRUE)) for atom, column in zip(self.atoms, self._columns)
+                    if atom.is_ground() and column.find(SampleSet.OTHER) < 0]
+
+    """ [(atom, estimate, (low, high))]: the fraction of samples each atom is true in, with its Wilson score interval """
+    def marginals(self, confidence=DEFAULT_CONFIDENCE):
+        return [(atom, count / self._count if self._count else 0.0, SampleSet.wilson_interval(count, self._count, confidence))
+                    for atom, count in self.frequencies()]
+
+    """ The width of the widest interval of anything estimated from the samples: the marginals, and how often each
+        non-ground query has no answer. None if there are no samples or nothing to estimate. """
+    def max_interval_width(self, confidence=DEFAULT_CONFIDENCE):
+        widths = []
+        for atom, column in zip(self.atoms, self._columns):
+            if column.find(SampleSet.OTHER) >= 0:
+                continue
+            successes = column.count(SampleSet.TRUE) if atom.is_ground() else column.count(SampleSet.FALSE)
+            low, high = SampleSet.wilson_interval(successes, self._count, confidence)
+            widths.append(high - low)
+        return max(widths) if widths and self._count else None
+
+    """ Wilson score interval of a proportion of successes out of n; unlike the normal approximation, it stays within
+        [0, 1] and is not empty when successes is 0 or n """
+    @staticmethod
+    def wilson_interval(successes, n, confidence=DEFAULT_CONFIDENCE):
+        if n == 0:
+            return 0.0, 1.0
+        z = SampleSet.z_score(confidence)
+        p = successes / n
+        denominator = 1 + z * z / n
+        center = (p + z * z / (2 * n)) / denominator
+        margin = z * sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+        return (0.0 if successes == 0 else max(0.0, center - margin)), (1.0 if successes == n else min(1.0, center + margin))
+
+    """ The z for which a standard normal variable is within [-z, z] with probability confidence, by bisection on erf
+        (statistics.NormalDist, which has inv_cdf, needs Python 3.8) """
+    @staticmethod
+    def z_score(confidence):
+        z = SampleSet._z_scores.get(confidence)
+        if z is None:
+            low, high = 0.0, 40.0
+            for _ in range(64):
+                middle = (low + high) / 2
+                if erf(middle / sqrt(2)) < confidence:
+                    low = middle
+                else:
+                    high = middle
+            z = SampleSet._z_scores[confidence] = (low + high) / 2
+        return z
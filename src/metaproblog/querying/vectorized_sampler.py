@@ -0,0 +1,225 @@
+from sys import stderr as sys_stderr
+import hashlib
+import time
+
+from problog.formula import LogicDAG, LogicFormula
+from problog.engine_unify import subsumes, UnifyError
+from problog.logic import Term
+
+from metaproblog.querying.sample_set import SampleSet
+
+try:
+    import numpy
+except ImportError: # Only needed for vectorized sampling
+    numpy = None
+
+
+class VectorizedSampler:
+    """
+    Samples from a formula grounded once, instead of grounding the program again for every sample (see SampleQuery.sample).
+    The queries and evidence are grounded into one LogicFormula, made acyclic (LogicDAG), and then the probabilistic
+    facts of a whole batch of samples are drawn at once as numpy arrays: one row per fact, one column per sample.
+    The and/or nodes are evaluated row by row in topological order, and samples which violate the evidence are
+    rejected, as SampleQuery.sample does. The samples have the same distribution, and go into a SampleSet as the same dicts would.
+    This needs a program whose ground formula is finite and whose facts all have a plain probability: continuous
+    distributions (e.g. normal(0,1)::x) are only sampled by grounding per sample (see is_supported).
+    """
+
+    MAX_BATCH = 65536 # Samples evaluated at once...
+    BATCH_BYTES = 64 * 1024 * 1024 # ... fewer if the formula is so big that their node values would take more than this
+    MAX_DRAWS_FACTOR = 1000 # Give up when this many times n_samples were drawn and not enough were accepted
+
+    def __init__(self, lf, queries):
+        self.lf = lf
+        self.dag = LogicDAG.create_from(lf, avoid_name_clash=True, keep_named=True)
+        self.order = VectorizedSampler._topological_order(self.dag)
+        self.size = len(self.dag)
+        self._index_atoms()
+        self.names = [(name, node) for name, node in self.dag.queries()] # Ground queries (or failed ones) and their nodes
+        self.query_names = [[(i, name) for i, (name, _node) in enumerate(self.names) if VectorizedSampler._answers(query, name)]
+                                for query in queries]
+        self.queries = queries
+        self.evidence = [(node, True) for _name, node in self.dag.get_names(LogicFormula.LABEL_EVIDENCE_POS)] + \
+                        [(node, False) for _name, node in self.dag.get_names(LogicFormula.LABEL_EVIDENCE_NEG)]
+
+    """ The queries and evidence grounded into one formula, labelled for this """
+    @staticmethod
+    def ground(engine, db, queries, evidence):
+        return engine.ground_all(db, queries=queries, evidence=evidence)
+
+    @staticmethod
+    def is_available():
+        return numpy is not None
+
+    """ Whether every probabilistic fact of lf has a plain probability """
+    @staticmethod
+    def is_supported(lf):
+        for _index, node, nodetype in lf:
+            if nodetype == "atom" and not node.is_extra and VectorizedSampler._probability(node.probability) is None:
+                return False
+        return True
+
+    """ (SampleSet, rejected). Stops early, keeping what it has, on an interrupt. """
+    def sample(self, n_samples, seed=None):
+        samples = SampleSet()
+        counters = {"rejected": 0}
+        try:
+            self.extend(samples, n_samples, VectorizedSampler.rng(seed), counters)
+        except KeyboardInterrupt:
+            pass
+        return samples, counters["rejected"]
+
+    """ Adds n_samples samples to samples (a SampleSet), fewer if deadline (a time.time()) passes first or if none of
+        MAX_DRAWS_FACTOR times as many satisfy the evidence. Counts the rejected ones in counters["rejected"].
+        Returns how many were added. """
+    def extend(self, samples, n_samples, rng, counters, deadline=None):
+        batch = max(1, min(VectorizedSampler.MAX_BATCH, VectorizedSampler.BATCH_BYTES // max(self.size + 1, 1)))
+        added = 0
+        drawn = 0
+        rejected = 0
+        while added < n_samples:
+            if drawn >= VectorizedSampler.MAX_DRAWS_FACTOR * n_samples and not added:
+                print("No sample drawn so far satisfies the evidence; giving up after %d"%drawn, file=sys_stderr)
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+            wanted = n_samples - added
+            size = min(batch, max(wanted, rejected)) # Draws more at once while most are rejected
+            query_values, accepted = self.draw(size, rng)
+            drawn += size
+            columns = numpy.flatnonzero(accepted)[:wanted]
+            rejected += int(size - accepted.sum())
+            counters["rejected"] = counters.get("rejected", 0) + int(size - accepted.sum())
+            self._add_to(samples, query_values, columns)
+            added += len(columns)
+        return added
+
+    @staticmethod
+    def rng(seed=None):
+        return numpy.random.default_rng(VectorizedSampler._seed(seed))
+
+    """ Values of the query nodes (one row per name) in n samples, and which samples satisfy the evidence """
+    def draw(self, n, rng):
+        values = numpy.zeros((self.size + 1, n), dtype=bool)
+        if len(self.fact_nodes):
+            values[self.fact_nodes] = rng.random((len(self.fact_nodes), n)) < self.fact_probabilities[:, None]
+        if len(self.choice_nodes):
+            drawn = rng.random((self.group_count, n))[self.choice_groups]
+            values[self.choice_nodes] = (drawn >= self.choice_low[:, None]) & (drawn < self.choice_high[:, None])
+        for index, nodetype, children in self.order:
+            rows = [self._literal(values, child, n) for child in children]
+            if nodetype == "conj":
+                values[index] = numpy.logical_and.reduce(rows) if rows else True
+            else:
+                values[index] = numpy.logical_or.reduce(rows) if rows else False
+
+        accepted = numpy.ones(n, dtype=bool)
+        for node, value in self.evidence:
+            accepted &= self._literal(values, node, n) == value
+        query_values = numpy.array([self._literal(values, node, n) for _name, node in self.names]).reshape(len(self.names), n)
+        return query_values, accepted
+
+    """ Adds the samples in columns to samples (a SampleSet), as the dicts SampledFormula.to_dict gives would be:
+        the true answers of each query, or the query itself as False if it has none """
+    def _add_to(self, samples, query_values, columns):
+        rows = query_values[:, columns]
+        codes = {}
+        for query, names in zip(self.queries, self.query_names):
+            if not names:
+                codes[query] = numpy.full(len(columns), SampleSet.FALSE)
+            elif query.is_ground() and len(names) == 1:
+                codes[names[0][1]] = numpy.where(rows[names[0][0]], SampleSet.TRUE, SampleSet.FALSE)
+            else:
+                answers = rows[[i for i, _name in names]]
+                for answer, (_i, name) in zip(answers, names):
+                    codes[name] = numpy.where(answer, SampleSet.TRUE, SampleSet.ABSENT)
+                codes[query] = numpy.where(answers.any(axis=0), SampleSet.ABSENT, SampleSet.FALSE)
+        samples.add_columns(len(columns), codes)
+
+    @staticmethod
+    def _literal(values, node, n):
+        if node is None: # False
+            return numpy.zeros(n, dtype=bool)
+        if node == 0: # True
+            return numpy.ones(n, dtype=bool)
+        return values[node] if node > 0 else ~values[-node]
+
+    """ Facts to draw on their own, and the choices of annotated disjunctions: one uniform draw per group, choice i is
+        true if it falls in [sum of the probabilities before i, that + its own) """
+    def _index_atoms(self):
+        fact_nodes, fact_probabilities = [], []
+        groups = {}
+        choices = [] # (node, group row, low, high)
+        for index, node, nodetype in self.dag:
+            if nodetype != "atom":
+                continue
+            probability = VectorizedSampler._probability(node.probability)
+            if node.is_extra: # The no-choice placeholder of a group, only used by constraints
+                continue
+            if node.group is None:
+                fact_nodes.append(index)
+                fact_probabilities.append(probability)
+            else:
+                row, low = groups.get(node.group, (len(groups), 0.0))
+                choices.append((index, row, low, low + probability))
+                groups[node.group] = (row, low + probability)
+        self.fact_nodes = numpy.array(fact_nodes, dtype=int)
+        self.fact_probabilities = numpy.array(fact_probabilities, dtype=float)
+        self.group_count = len(groups)
+        self.choice_nodes = numpy.array([c[0] for c in choices], dtype=int)
+        self.choice_groups = numpy.array([c[1] for c in choices], dtype=int)
+        self.choice_low = numpy.array([c[2] for c in choices], dtype=float)
+        self.choice_high = numpy.array([c[3] for c in choices], dtype=float)
+
+    """ (index, type, children) of the and/or nodes, children first """
+    @staticmethod
+    def _topological_order(dag):
+        order = []
+        done = set()
+        for root in range(1, len(dag) + 1):
+            if root in done:
+                continue
+            stack = [(root, False)]
+            while stack:
+                index, expanded = stack.pop()
+                if index in done:
+                    continue
+                node = dag.get_node(index)
+                nodetype = type(node).__name__
+                if nodetype == "atom":
+                    done.add(index)
+                elif expanded:
+                    done.add(index)
+                    order.append((index, nodetype, list(node.children)))
+                else:
+                    stack.append((index, True))
+                    stack.extend((abs(child), False) for child in node.children if child and abs(child) not in done)
+        return order
+
+    @staticmethod
+    def _probability(probability):
+        if probability is True or probability is None:
+            return 1.0
+        if isinstance(probability, (int, float)):
+            return float(probability)
+        if isinstance(probability, Term) and probability.is_constant():
+            try:
+                return float(probability)
+            except (TypeError, ValueError):
+                return None
+        return None
+
+    @staticmethod
+    def _answers(query, name):
+        if query.is_ground():
+            return query == name
+        try:
+            return subsumes(query, name)
+        except UnifyError:
+            return False
+
+    @staticmethod
+    def _seed(seed):
+        if seed is None or isinstance(seed, int):
+            return seed
+        return int(hashlib.sha1(str(seed).encode()).hexdigest()[:16], 16)
@@ -0,0 +1,232 @@
+from sys import stderr as sys_stderr
+import random
+
+from problog import get_evaluatable
+from problog.engine import DefaultEngine
+from problog.logic import Term
+from problog.tasks.sample import FunctionStore, SampledFormula
+
+from metaproblog.querying.sample_query import SampleQuery
+from metaproblog.querying.sample_set import SampleSet
+from metaproblog.querying.vectorized_sampler import VectorizedSampler
+
+
+class WeightedSampledFormula(SampledFormula):
+    """
+    SampledFormula for likelihood weighting: facts in clamped are set to the given value instead of being sampled,
+        and weight is multiplied by the probability of that value given the choices made so far.
+    Clamped choices of an annotated disjunction are weighted with their probability relative to what remains in the group,
+        which is how SampledFormula samples them. The other choices of a group with a clamped true choice are clamped false.
+    """
+    def __init__(self, clamped=None, **kwargs):
+        SampledFormula.__init__(self, **kwargs)
+        self.clamped = clamped if clamped is not None else {} # identifier -> bool
+        self.clamped_groups = {identifier[:-1] for identifier, value in self.clamped.items()
+                                    if value and isinstance(identifier, tuple)}
+        self.weight = 1.0
+
+    def add_atom(self, identifier, probability, group=None, name=None, source=None, cr_extra=True, is_extra=False):
+        if identifier in self.clamped:
+            value = self.clamped[identifier]
+        elif group is not None and identifier[:-1] in self.clamped_groups:
+            value = False
+        else:
+            value = None
+        if value is None or probability is None or identifier in self.facts or not self._is_simple_probability(probability):
+            return SampledFormula.add_atom(self, identifier, probability, group, name, source, cr_extra, is_extra)
+
+        p = float(probability)
+        if group is None:
+            self.weight *= p if value else (1 - p)
+        else:
+            origin = identifier[:-1]
+            r = self.groups.get(origin, 1.0) # remaining probability in the group. None if another choice was made.
+            if r is None or r < 1e-8:
+                self.weight *= 0.0 if value else 1.0
+            else:
+                self.weight *= (p / r) if value else (1 - p / r)
+            if value:
+                self.groups[origin] = None
+            elif r is not None:
+                self.groups[origin] = r - p
+
+        if value:
+            self.probability *= p
+        result_node = self.TRUE if value else self.FALSE
+        self.facts[identifier] = result_node
+        return result_node
+
+
+class WeightedSampleQuery(SampleQuery):
+    """
+    Likelihood weighting. The facts which the evidence determines (by propagation on the ground evidence) are clamped
+        rather than sampled, and every sample carries the probability of the clamped values as its weight.
+    The rest of the evidence (e.g. on a derived atom) is weighted rather than checked: the ground evidence is compiled
+        once, and each sample's weight is multiplied by P(evidence | the facts that sample drew), evaluated on that
+        circuit with those facts set (see evidence_likelihood). Facts the sample did not draw are summed out.
+    Only if the evidence cannot be compiled (e.g. it depends on continuous distributions) is it checked per sample,
+        with weight 0 for a sample which violates it. Either way, n_samples groundings are all it costs.
+    results is (SampleSet, evidence_dict, weights).
+    """
+
+    EVIDENCE_NAME = Term("_pbl_evidence") # Of the conjunction of the evidence, in the compiled evidence
+
+    def __init__(self, queries, evidence, formula_wrapper, n_samples=1, workers=1, seed=None, **kwargs):
+        if kwargs.get("ci") is not None:
+            raise ValueError("Adaptive sampling (ci) is not supported with weighted sampling")
+        super().__init__(queries, evidence, formula_wrapper, n_samples=n_samples, workers=workers, seed=seed, **kwargs)
+        self.clamped_facts = {}
+        self.evidence_model = None
+
+    def ground(self, engine):
+        self.propagated_ev_facts, self.propagated_ev_target = \
+            SampleQuery.do_propagate_evidence(engine, self.formula_wrapper.db, self.evidence)
+        self.clamped_facts = WeightedSampleQuery.clamped_from_propagated(self.propagated_ev_target)
+        self.evidence_model = WeightedSampleQuery.compile_evidence(engine, self.formula_wrapper.db, self.evidence)
+
+    def evaluate(self, engine):
+        weighting = (self.clamped_facts, self.evidence_model)
+        if self.n_samples > 0 and (self.workers > 1 or self.seed is not None):
+            weighted_terms, _ev_result = SampleQuery.sample_chunked(
+                self.formula_wrapper.db, self.queries, self.evidence, self.n_samples,
+                weighting, self.workers, self.seed, sampler=WeightedSampleQuery.sample)
+        else:
+            weighted_terms = [r[0] for r in WeightedSampleQuery.sample(
+                DefaultEngine(), self.formula_wrapper.db, self.queries, self.evidence, self.n_samples, weighting)]
+
+        sampled_terms = SampleSet(sample_dict for sample_dict, _weight in weighted_terms)
+        weights = [weight for _sample_dict, weight in weighted_terms]
+        self.results = (sampled_terms, SampleQuery.read_evidence(self.propagated_ev_target), weights)
+        return self.results
+
+    """ Weighted estimate of P(term | evidence) for every term that occurs in the samples. None if all weights are 0. """
+    @staticmethod
+    def estimate(sampled_terms, weights):
+        total = sum(weights)
+        if total == 0:
+            return None
+        estimates = {}
+        for sample_dict, weight in zip(sampled_terms, weights):
+            for term, value in sample_dict.items():
+                estimates[term] = estimates.get(term, 0.0) + (weight if value else 0.0)
+        return {term: w / total for term, w in estimates.items()}
+
+    """ Kish's effective sample size: how many unweighted samples the weighted ones are worth """
+    @staticmethod
+    def effective_sample_size(weights):
+        sq = sum(w * w for w in weights)
+        return (sum(weights) ** 2 / sq) if sq > 0 else 0.0
+
+    """ identifier -> bool for the atoms whose value the evidence propagation determined """
+    @staticmethod
+    def clamped_from_propagated(ev_target):
+        clamped = {}
+        for index, value in ev_target.lookup_evidence.items():
+            node = ev_target.get_node(index)
+            if type(node).__name__ != "atom":
+                continue
+            if ev_target.is_true(value):
+                clamped[node.identifier] = True
+            elif ev_target.is_false(value):
+                clamped[node.identifier] = False
+        return clamped
+
+    """ The evidence compiled for evidence_likelihood: (circuit, its atoms as (index, identifier, probability, group),
+        likelihood), where likelihood is the constant P(evidence) if there is no circuit: 1.0 without evidence, 0.0 if it
+        cannot hold. None if the evidence cannot be compiled. """
+    @staticmethod
+    def compile_evidence(engine, db, evidence):
+        if not evidence:
+            return None, [], 1.0
+        lf = engine.ground_all(db, queries=[term for term, _value in evidence], evidence=[])
+        if not VectorizedSampler.is_supported(lf):
+            print("The evidence depends on continuous distributions; samples which violate it get weight 0", file=sys_stderr)
+            return None
+        nodes = dict(lf.queries())
+        conjunction = lf.add_and([nodes[term] if value else lf.negate(nodes[term]) for term, value in evidence])
+        if conjunction == lf.TRUE or conjunction == lf.FALSE:
+            return None, [], 1.0 if conjunction == lf.TRUE else 0.0
+        lf.add_query(WeightedSampleQuery.EVIDENCE_NAME, conjunction)
+        circuit = get_evaluatable().create_from(lf)
+        atoms = [(index, node.identifier, float(node.probability), node.group)
+                    for index, node, nodetype in circuit if nodetype == "atom" and not node.is_extra]
+        return circuit, atoms, None
+
+    """ P(evidence | the facts target drew) on the compiled evidence. A drawn fact is set to its value. An unsampled choice
+        of an annotated disjunction gets its probability given the choices of its group drawn already (as in
+        SampledFormula.add_atom); the probability of none of them is worked out from those by the circuit's constraint. """
+    @staticmethod
+    def evidence_likelihood(evidence_model, target):
+        circuit, atoms, likelihood = evidence_model
+        if circuit is None:
+            return likelihood
+        weights = {}
+        for index, identifier, probability, group in atoms:
+            value = target.facts.get(identifier, -1) # TRUE is 0, FALSE is None
+            if value != -1:
+                weights[index] = 1.0 if value == target.TRUE else 0.0
+            elif group is not None and identifier[:-1] in target.groups:
+                r = target.groups[identifier[:-1]] # None if another choice of the group was made
+                weights[index] = 0.0 if r is None or r < 1e-8 else min(probability / r, 1.0)
+        node = circuit.get_node_by_name(WeightedSampleQuery.EVIDENCE_NAME)
+        return circuit.evaluate(index=node, weights=weights)
+
+    """ Like SampleQuery.sample, but yields ((sample_dict, weight), target).
+        weighting: (clamped facts, compiled evidence) (see clamped_from_propagated, compile_evidence). Without compiled
+        evidence, samples violating the evidence have weight 0. """
+    @staticmethod
+    def sample(engine, db, queries, evidence, n_samples, weighting=({}, None), counters=None):
+        clamped_facts, evidence_model = weighting
+        i = 0
+        r = 0
+        labelled_queries = [(SampledFormula.LABEL_QUERY, q) for q in queries]
+        try:
+            while i < n_samples or n_samples==0:
+                target = WeightedSampledFormula(clamped_facts)
+                engine.functions = FunctionStore(target=target, database=db, engine=engine)
+
+                engine.ground_queries(db, target, labelled_queries)
+                if evidence_model is not None:
+                    weight = target.weight * WeightedSampleQuery.evidence_likelihood(evidence_model, target)
+                # Grounding the evidence can clamp facts the queries did not reach, so the weight is read after it.
+                elif SampleQuery.verify_evidence_wrapper(engine, db, None, target, evidence):
+                    weight = target.weight
+                else:
+                    weight = 0.0
+                if weight == 0:
+                    r += 1
+                yield (target.to_dict(), weight), target
+                i += 1
+                engine.previous_result = target
+        except KeyboardInterrupt:
+            pass
+
+        if counters is None:
+            print("Zero-weight samples: %s" % r, file=sys_stderr)
+        else:
+            counters["rejected"] = r
+        return None
+
+
+# Devtime testing
+def _run_tests():
+    from problog.program import PrologString
+    from problog.logic import Term
+    from .formula_wrapper import FormulaWrapper
+    p = PrologString("""
+    0.01::burglary. 0.02::earthquake.
+    0.9::alarm :- burglary. 0.4::alarm :- earthquake.
+    0.3::a; 0.5::b.
+    """)
+    engine = DefaultEngine()
+    fw = FormulaWrapper(engine.prepare(p))
+    random.seed(1)
+    for ev in [[(Term("alarm"), True)], [(Term("b"), True)], [(Term("a"), False)]]:
+        qobj = WeightedSampleQuery([Term("burglary"), Term("a"), Term("b")], ev, fw, 2000)
+        qobj.ground(engine)
+        samples, ev_result, weights = qobj.evaluate(engine)
+        print(ev_result, WeightedSampleQuery.estimate(samples, weights),
+                "ESS=%.1f"%WeightedSampleQuery.effective_sample_size(weights))
+
+if __name__ == "__main__":
+    _run_tests()
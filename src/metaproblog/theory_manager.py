@@ -1,20 +1,37 @@
 import sys
+import hashlib
 from problog.clausedb import ClauseDB
 from problog.logic import Term
 
+from metaproblog.dependency_graph import DependencyGraph
+
 from sys import stderr as sys_stderr
 
 class TheoryManager:
     _static_instance = None
 
+    DEFAULT_COMPACTION_RATIO = 0.5
+
     @staticmethod
-    def initialize(db):
-        TheoryManager._static_instance = TheoryManager(db)
+    def initialize(db, compaction_ratio=DEFAULT_COMPACTION_RATIO):
+        TheoryManager._static_instance = TheoryManager(db, compaction_ratio)
         return TheoryManager._static_instance
 
-    def __init__(self, db):
+    def __init__(self, db, compaction_ratio=DEFAULT_COMPACTION_RATIO):
         self._db = db
         self._range = {} # TheoryKey -> (StartNode, EndNode)
+        self._statements = {} # TheoryKey -> statement_list. Needed to rebuild the db on compaction.
+        self._hashes = {} # TheoryKey -> content hash of the statement_list
+        self._listeners = [] # Called with (TheoryKey, names it defines) whenever a theory is added or removed
+        self.dependency_graph = DependencyGraph()
+        self._base_size = len(db)
+        self._dead_nodes = 0
+        self._removed_heads = set() # (functor, arity) of clauses which were erased
+        self.compaction_ratio = compaction_ratio # None disables automatic compaction
+
+    @property
+    def db(self):
+        return self._db
 
     def theory_exists(self, theory_key):
         assert( theory_key is not None )
@@ -28,6 +45,10 @@ class TheoryManager:
                 self._db.add_statement(stmt)
             end = len(self._db)
             self._range[theory_key] = (start, end)
+            self._statements[theory_key] = list(statement_list)
+            self._hashes[theory_key] = TheoryManager.content_hash(statement_list)
+            self.dependency_graph.add_theory(theory_key, statement_list)
+            self._notify(theory_key)
             return True
         else: # Fail
             print("Trying to add to a theory that already exists: %s"%str(theory_key), file=sys_stderr)
@@ -39,18 +60,99 @@ class TheoryManager:
             return isinstance(node, ClauseDB._clause) or isinstance(node, ClauseDB._fact)
 
         if theory_key in self._range:
+            self._notify(theory_key)
             start, end = self._range[theory_key]
             for idx in range(start, end):
                 node = self._db.get_node(idx)
                 if _is_impl_node(node):
-                    template_node = Term(node.functor, node.args)
+                    template_node = Term(node.functor, *node.args)
                     define_idx = self._db.find(template_node)
                     if define_idx is not None:
                         define_node = self._db.get_node(define_idx)
                         define_node.children.erase( {idx} )
+                        self._removed_heads.add( (node.functor, len(node.args)) )
 
             self._range.pop(theory_key)
+            self._statements.pop(theory_key)
+            self._hashes.pop(theory_key)
+            self.dependency_graph.remove_theory(theory_key)
+            self._dead_nodes += end - start
             return True
         else:
             print("Trying to remove a theory that doesn't exist: %s"%str(theory_key), file=sys_stderr)
             return False
+
+    def theory_hash(self, theory_key):
+        return self._hashes[theory_key]
+
+    """ Stable hash over the content of the given theories (default: all live theories) """
+    def fingerprint(self, theory_keys=None):
+        if theory_keys is None:
+            theory_keys = self._hashes
+        h = hashlib.sha1()
+        for theory_key in sorted(theory_keys, key=str):
+            h.update(("%s:%s\n"%(theory_key, self._hashes[theory_key])).encode())
+        return h.hexdigest()
+
+    """ (TheoryKeys, predicate names) that answers to the given terms may depend on. Names are None if it could be anything. """
+    def dependencies(self, terms):
+        return self.dependency_graph.dependencies(terms)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, theory_key):
+        defined = self.dependency_graph.defined_by(theory_key)
+        for listener in self._listeners:
+            listener(theory_key, defined)
+
+    @staticmethod
+    def content_hash(statement_list):
+        h = hashlib.sha1()
+        for stmt in statement_list:
+            h.update(str(stmt).encode())
+            h.update(b".\n")
+        return h.hexdigest()
+
+    """ Node counts of the db. Dead nodes belong to removed theories and are only reclaimed by compact """
+    def stats(self):
+        total = len(self._db)
+        live = sum(end - start for (start, end) in self._range.values())
+        return {
+            "theories": len(self._range),
+            "total_nodes": total,
+            "base_nodes": self._base_size,
+            "live_nodes": live,
+            "dead_nodes": self._dead_nodes,
+            "untracked_nodes": total - self._base_size - live - self._dead_nodes, # e.g. added by directives
+            "dead_ratio": (self._dead_nodes / total) if total else 0.0,
+        }
+
+    def needs_compaction(self):
+        if self.compaction_ratio is None or self._dead_nodes == 0:
+            return False
+        return self.stats()["dead_ratio"] >= self.compaction_ratio
+
+    """ Rebuilds the live theories into new_db (a freshly prepared, empty ClauseDB) and switches to it.
+        Directives of the live theories are re-added too, so the caller should prepare the returned db.
+    """
+    def compact(self, new_db):
+        # Predicates whose clauses were all removed should still fail quietly instead of becoming unknown.
+        # Their define nodes go in first, so the calls compiled below link to them.
+        for functor, arity in self._removed_heads:
+            if not functor.startswith(ClauseDB.FUNCTOR_BODY + "_"):
+                new_db._add_head(Term(functor, *([None] * arity)))
+
+        new_range = {}
+        for theory_key in sorted(self._range, key=lambda k: self._range[k][0]):
+            start = len(new_db)
+            for stmt in self._statements[theory_key]:
+                new_db.add_statement(stmt)
+            new_range[theory_key] = (start, len(new_db))
+
+        self._db = new_db
+        self._range = new_range
+        self._base_size = len(new_db) - sum(end - start for (start, end) in new_range.values())
+        self._dead_nodes = 0
+        self._removed_heads = set()
+        return new_db